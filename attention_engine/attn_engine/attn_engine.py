@@ -1,18 +1,54 @@
 import torch
 from core.transform.core import CustomIO, SymbolicArray, SymbolScalar, Var
+from core.transform.serialize import serialize_attention, structural_hash
+from core.transform.dynamic_mask import DynamicBlockMask
 
 from autotuner.decider import decider
-from autotuner.arch import H100
+from autotuner.arch import H100, CPU, device_arch
+from autotuner.online_tune import online_tuner
+from autotuner.tune_db import tune_db, current_arch
 
 import importlib.util
 import tempfile
 import os
 import os.path as osp
 import hashlib
+from collections import OrderedDict
 from functools import partial
 from typing import Optional, Callable, Union
 
 
+def load_generated_module(code: str, module_name: str):
+    """
+    write generated code to attn_engine/cache/<md5>.py and import it
+    """
+    code_hash = hashlib.md5(code.encode()).hexdigest()
+    cache_dir = os.path.join(os.path.dirname(__file__), "cache")
+    file_path = os.path.join(cache_dir, f"{code_hash}.py")
+    os.makedirs(cache_dir, exist_ok=True)
+    if not os.path.exists(file_path):
+        with open(file_path, "w") as f:
+            f.write(code)
+            f.flush()
+    spec = importlib.util.spec_from_file_location(module_name, file_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def attention_hash(score_mod, mask_mod, online_func, custom_fwd_inputs, mask_value="-inf"):
+    """
+    structural hash of an attention definition, None for definitions that can
+    not be serialized or traced, e.g. mask_mods capturing tensors or branching
+    on indices. engines without it are not shared through the compile cache
+    """
+    try:
+        return structural_hash(serialize_attention(
+            score_mod, mask_mod, online_func, custom_fwd_inputs, mask_value))
+    except Exception:
+        return None
+
+
 class OnlineFunc:
     """
     __init__: define online_rowscales and final_rowscales
@@ -93,20 +129,38 @@ class OnlineFunc:
 
 
 class AttentionEngine:
+    # compiled kernels of engines with the same definition&problem,
+    # e.g. the same attention in every layer is lowered and compiled once.
+    # LRU of compile_cache_size entries, 0 disables it
+    _compile_cache = OrderedDict()
+    compile_cache_size = 32
+
     def __init__(self, qkv_meta, custom_fwd_inputs, score_mod, mask_mod,
-                 online_func, mask_value="-inf", device=H100(), backend="tl", 
+                 online_func, mask_value="-inf", device=None, backend="tl", 
                  tune=False, tune_file="", 
                  tune_bwd=False, tune_file_bwd="",
+                 tune_transfer="",
+                 tune_strategy="",
+                 tune_joint=False,
+                 tune_online=0.01,
+                 online_configs=None,
                  infer_mask=False,
                  kernel_template=None):
-        # tunner
-        # need_engine_fuse, fuse_config = decider(qkv_meta, device)
-        
         # if dynamic shape
         # TODO: 111
 
+        # stable identity of the attention definition, independent of varnames
+        self.structural_hash = attention_hash(
+            score_mod, mask_mod, online_func, custom_fwd_inputs, mask_value)
+        self.online_tuner = None
+        # config of the compiled module in the keys of tuned_config, the incumbent of online tuning
+        self.tuned_config = None
+
         # backend
         if backend == "tl":
+            if device is None:
+                # the live device, H100 to lower without one
+                device = device_arch() if torch.cuda.is_available() else H100()
             self._compile_tl(
                 qkv_meta,
                 custom_fwd_inputs,
@@ -118,6 +172,38 @@ class AttentionEngine:
                 tune_file=tune_file,
                 tune_bwd=tune_bwd,
                 tune_file_bwd=tune_file_bwd,
+                tune_transfer=tune_transfer,
+                tune_strategy=tune_strategy,
+                tune_joint=tune_joint,
+                device=device,
+                kernel_template=kernel_template)
+
+        elif backend == "torch":
+            # blocked pytorch implementation, cpu fallback & reference
+            self._compile_torch(
+                qkv_meta,
+                custom_fwd_inputs,
+                score_mod,
+                mask_mod,
+                online_func,
+                mask_value,
+                kernel_template=kernel_template)
+
+        elif backend == "cpu":
+            # torch backend, (batch, head, q tile) grid over a thread pool
+            if not isinstance(device, CPU):
+                device = CPU()
+            from core.lower.lower_torch import cpu_tile_config
+            tuned_config = cpu_tile_config(
+                qkv_meta[0].shape[3], qkv_meta[2].shape[3], device)
+            self._compile_torch(
+                qkv_meta,
+                custom_fwd_inputs,
+                score_mod,
+                mask_mod,
+                online_func,
+                mask_value,
+                tuned_config=tuned_config.__dict__,
                 kernel_template=kernel_template)
 
         elif backend == "cute":
@@ -147,10 +233,25 @@ class AttentionEngine:
                 cute_attn.flash_attn_func,
                 causal=True if mask_mod is not None else False)
 
+        if online_configs:
+            # serve with the compiled config, time online_configs on tune_online of the calls
+            if backend == "tl":
+                compile_fn = partial(self._compile_tl, qkv_meta, custom_fwd_inputs, score_mod, mask_mod,
+                                     online_func, mask_value, infer_mask=infer_mask,
+                                     device=device, kernel_template=kernel_template)
+            elif backend in ("torch", "cpu"):
+                compile_fn = partial(self._compile_torch, qkv_meta, custom_fwd_inputs, score_mod, mask_mod,
+                                     online_func, mask_value, kernel_template=kernel_template)
+            else:
+                raise NotImplementedError(f"online tuning is not supported by {backend} backend")
+            self._compile_online(compile_fn, online_configs, qkv_meta,
+                                 tune_online, tune_file)
+
     def _select_lower_template(self, qkv_meta, custom_fwd_inputs, score_mod, mask_mod,
                     online_func, mask_value="-inf", tuned_config=None, infer_mask=False,
                     tune=False, tune_file="",
-                    tune_bwd=False, tune_file_bwd="",
+                    tune_bwd=False, tune_file_bwd="", tune_transfer="", tune_strategy="",
+                    tune_joint=False, device=None,
                     kernel_template=None):
         tl_dtype_map = {
             torch.float16: "float16",
@@ -231,13 +332,16 @@ class AttentionEngine:
                                 mask_value,
                                 tuned_config, infer_mask, 
                                 tune=tune, tune_file=tune_file,
-                                tune_bwd=tune_bwd, tune_file_bwd=tune_file_bwd)
+                                tune_bwd=tune_bwd, tune_file_bwd=tune_file_bwd,
+                                tune_transfer=tune_transfer, tune_strategy=tune_strategy,
+                                tune_joint=tune_joint, hardware_meta=device)
             return tl_code, block_mask
             
     def _compile_tl(self, qkv_meta, custom_fwd_inputs, score_mod, mask_mod,
                     online_func, mask_value="-inf", tuned_config=None, infer_mask=False,
                     tune=False, tune_file="",
-                    tune_bwd=False, tune_file_bwd="",
+                    tune_bwd=False, tune_file_bwd="", tune_transfer="", tune_strategy="",
+                    tune_joint=False, device=None,
                     kernel_template=None):
         tl_dtype_map = {
             torch.float16: "float16",
@@ -247,6 +351,13 @@ class AttentionEngine:
         kv_len = qkv_meta[2].shape[2]
         head = qkv_meta[0].shape[1]
         head_kv = qkv_meta[2].shape[1]
+        compile_key = (self.structural_hash,
+                       tuple((tuple(t.shape), t.dtype) for t in qkv_meta),
+                       str(tuned_config), infer_mask,
+                       tune, tune_file, tune_bwd, tune_file_bwd, tune_transfer, tune_strategy,
+                       tune_joint, device.name if device is not None else None, kernel_template)
+        if self._cache_lookup(compile_key):
+            return
         block_mask = None
         tl_code, block_mask = self._select_lower_template(
             qkv_meta,
@@ -259,35 +370,116 @@ class AttentionEngine:
             tune_file=tune_file,
             tune_bwd=tune_bwd,
             tune_file_bwd=tune_file_bwd,
+            tune_transfer=tune_transfer,
+            tune_strategy=tune_strategy,
+            tune_joint=tune_joint,
+            device=device,
             kernel_template=kernel_template
         )
         self.tl_code = tl_code  
         # for debug
         # with open("generated_tl.py","w") as f:
         #      f.write(tl_code)
-        code_hash = hashlib.md5(tl_code.encode()).hexdigest()
-        cache_dir = os.path.join(os.path.dirname(__file__), "cache")
-        file_path = os.path.join(cache_dir, f"{code_hash}.py")
-        os.makedirs(cache_dir, exist_ok=True)
-        if not os.path.exists(file_path):
-            with open(file_path, "w") as f:
-                f.write(tl_code)
-                f.flush()
         # replace code
         # file_path = "/home/aiscuser/cfy/AttentionEngine/attn_script/generated_tl_code_attention.py"
-        spec = importlib.util.spec_from_file_location("tl_attn", file_path)
-        tl_attn = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(tl_attn)
+        tl_attn = load_generated_module(tl_code, "tl_attn")
         self.attention = tl_attn.attention
+        self.tuned_config = self._module_config(tl_attn, tuned_config)
         if infer_mask:
             self.block_mask = block_mask
         else:
             self.block_mask = None
+        self._cache_store(compile_key)
 
-    def __call__(self, *args, **kargs):
-        if self.block_mask is not None:
-            o = self.attention(*args, self.block_mask, **kargs)
+    def _compile_torch(self, qkv_meta, custom_fwd_inputs, score_mod, mask_mod,
+                       online_func, mask_value="-inf", tuned_config=None,
+                       kernel_template=None):
+        if kernel_template is not None:
+            raise NotImplementedError(
+                f"kernel_template {kernel_template} is not supported by torch backend")
+        # generated code is shape agnostic, only head dims are static
+        compile_key = ("torch", self.structural_hash,
+                       qkv_meta[0].shape[3], qkv_meta[2].shape[3],
+                       str(tuned_config))
+        if self._cache_lookup(compile_key):
+            return
+        from core.lower.lower_torch import lower_torch
+        torch_code = lower_torch(score_mod,
+                                 mask_mod,
+                                 online_func,
+                                 custom_fwd_inputs,
+                                 mask_value,
+                                 tuned_config)
+        self.tl_code = torch_code  # for debug
+        torch_attn = load_generated_module(torch_code, "torch_attn")
+        self.attention = torch_attn.attention
+        self.block_mask = None
+        self.tuned_config = tuned_config
+        self._cache_store(compile_key)
+
+    def _cache_lookup(self, compile_key):
+        if self.structural_hash is None or compile_key not in AttentionEngine._compile_cache:
+            return False
+        AttentionEngine._compile_cache.move_to_end(compile_key)
+        self.tl_code, self.attention, self.block_mask, self.tuned_config = AttentionEngine._compile_cache[compile_key]
+        return True
+
+    def _cache_store(self, compile_key):
+        if self.structural_hash is None or AttentionEngine.compile_cache_size <= 0:
+            return
+        AttentionEngine._compile_cache[compile_key] = (self.tl_code, self.attention, self.block_mask,
+                                                       self.tuned_config)
+        AttentionEngine._compile_cache.move_to_end(compile_key)
+        while len(AttentionEngine._compile_cache) > AttentionEngine.compile_cache_size:
+            AttentionEngine._compile_cache.popitem(last=False)
+
+    def _compile_online(self, compile_fn, online_configs, qkv_meta,
+                        sample_rate, tune_file=""):
+        """
+        compile every config of online_configs and serve through an OnlineTuner
+        starting from the compiled module, promoted configs go to tune_file
+        """
+        incumbent = (self.tl_code, self.attention, self.block_mask, self.tuned_config)
+        candidates = [(self.tuned_config, partial(self._run, self.attention, self.block_mask))]
+        for config in online_configs:
+            compile_fn(tuned_config=config)
+            candidates.append((config, partial(self._run, self.attention, self.block_mask)))
+        self.tl_code, self.attention, self.block_mask, self.tuned_config = incumbent
+        problem = {"shapes": [list(t.shape) for t in qkv_meta]}
+        code_hash = self.structural_hash or hashlib.md5(self.tl_code.encode()).hexdigest()
+        self.online_tuner = online_tuner(candidates, sample_rate, tune_db(tune_file) if tune_file else None,
+                                         "attn_online", problem, current_arch(), str(qkv_meta[0].dtype),
+                                         code_hash)
+
+    @staticmethod
+    def _module_config(tl_attn, tuned_config):
+        """
+        fwd config a generated tl module compiled, tuned or lowered, tuned_config
+        if the template does not expose it
+        """
+        config = getattr(tl_attn, "tuned_config", None)
+        if not isinstance(config, dict):
+            return tuned_config
+        return {"block_M": str(config["block_M"]), "block_N": str(config["block_N"]),
+                "stages": str(config["num_stages"]), "thread_num": str(config["thread_num"]),
+                "shared_fuse": str(config["shared_fuse"])}
+
+    @staticmethod
+    def _run(attention, block_mask, *args, **kargs):
+        if isinstance(block_mask, DynamicBlockMask):
+            # mask_mod reads custom_fwd_inputs, e.g. doc_ids of packed sequences
+            o = attention(*args, *block_mask(*args), **kargs)
+        elif isinstance(block_mask, tuple):
+            # block masks of fwd and bwd
+            o = attention(*args, *block_mask, **kargs)
+        elif block_mask is not None:
+            o = attention(*args, block_mask, **kargs)
         else:
-            o = self.attention(*args, **kargs)
+            o = attention(*args, **kargs)
         return o
 
+    def __call__(self, *args, **kargs):
+        if self.online_tuner is not None:
+            return self.online_tuner(*args, **kargs)
+        return self._run(self.attention, self.block_mask, *args, **kargs)
+
@@ -1,4 +1,7 @@
 from core.lower.lower_linear import lower_tl
+from .attn_engine import load_generated_module
+from autotuner.online_tune import online_tuner
+from autotuner.tune_db import tune_db, current_arch
 
 
 import importlib.util
@@ -9,18 +12,47 @@ import hashlib
 
 class LinearAttentionEngine:
     def __init__(self, qkv_meta, q_mod=None, k_mod=None, v_mod=None, decay_mod=None, custom_io=None,
-                 tune=False, tune_filename="tune_result", tune_bwd=False):
-        self._compile_tl(qkv_meta, q_mod, k_mod, v_mod, decay_mod, custom_io, tune=tune, tune_filename=tune_filename, tune_bwd=tune_bwd)
+                 tune=False, tune_filename="tune_result", tune_bwd=False, backend="tl", tune_transfer="",
+                 tune_strategy="", tune_joint=False, tune_online=0.01, online_configs=None):
+        self.online_tuner = None
+        if backend == "tl":
+            self._compile_tl(qkv_meta, q_mod, k_mod, v_mod, decay_mod, custom_io, tune=tune, tune_filename=tune_filename, tune_bwd=tune_bwd,
+                             tune_transfer=tune_transfer, tune_strategy=tune_strategy,
+                             tune_joint=tune_joint)
+        elif backend == "torch":
+            # chunked pytorch implementation, cpu fallback & reference
+            self._compile_torch(qkv_meta, q_mod, k_mod, v_mod, decay_mod, custom_io)
+        else:
+            raise NotImplementedError(f"backend {backend} is not supported")
 
+        if online_configs:
+            # serve with the compiled config, time online_configs on tune_online of the calls
+            compile_fn = self._compile_tl if backend == "tl" else self._compile_torch
+            incumbent = (self.tl_code, self.attention)
+            candidates = [(None, self.attention)]
+            for config in online_configs:
+                compile_fn(qkv_meta, q_mod, k_mod, v_mod, decay_mod, custom_io, tuned_config=config)
+                candidates.append((config, self.attention))
+            self.tl_code, self.attention = incumbent
+            code_hash = hashlib.md5("".join(line for line in self.tl_code.splitlines(True)
+                                            if not line.startswith("TUNE")).encode()).hexdigest()
+            problem = {"shapes": [list(t.shape) for t in qkv_meta]}
+            self.online_tuner = online_tuner(candidates, tune_online,
+                                             tune_db(tune_filename) if tune_filename else None,
+                                             "linear_online", problem, current_arch(), str(qkv_meta[0].dtype),
+                                             code_hash)
 
-    def __call__(self, *args, **kargs):
 
+    def __call__(self, *args, **kargs):
+        if self.online_tuner is not None:
+            return self.online_tuner(*args, **kargs)
         o = self.attention(*args, **kargs)
         return o
 
     def _compile_tl(self, qkv_meta, q_mod, k_mod, v_mod, decay_mod,
                     custom_io, tuned_config=None,
-                    tune=False, tune_filename="", tune_bwd=False):
+                    tune=False, tune_filename="", tune_bwd=False, tune_transfer="", tune_strategy="",
+                    tune_joint=False):
         tl_code = lower_tl(
             qkv_meta,
             q_mod,
@@ -31,22 +63,30 @@ class LinearAttentionEngine:
             tuned_config,
             tune=tune,
             tune_filename=tune_filename,
-            tune_bwd=tune_bwd,)
+            tune_bwd=tune_bwd,
+            tune_transfer=tune_transfer,
+            tune_strategy=tune_strategy,
+            tune_joint=tune_joint)
         self.tl_code = tl_code  # for debug
         # local_vars = {}
         # exec(tl_code, globals(), local_vars)
         # globals().update(local_vars)
         # self.attention = local_vars["attention"]
-        code_hash = hashlib.md5(tl_code.encode()).hexdigest()
-        cache_dir = os.path.join(os.path.dirname(__file__), "cache")
-        file_path = os.path.join(cache_dir, f"{code_hash}.py")
-        os.makedirs(cache_dir, exist_ok=True)
-        if not os.path.exists(file_path):
-            with open(file_path, "w") as f:
-                f.write(tl_code)
-                f.flush()
         # file_path = "/home/aiscuser/cfy/AttentionEngine/attn_script/retention_linear_tlcode1.py"
-        spec = importlib.util.spec_from_file_location("tl_attn", file_path)
-        tl_attn = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(tl_attn)
+        tl_attn = load_generated_module(tl_code, "tl_attn")
         self.attention = tl_attn.linear_attention
+
+    def _compile_torch(self, qkv_meta, q_mod, k_mod, v_mod, decay_mod,
+                       custom_io, tuned_config=None):
+        from core.lower.lower_torch import lower_torch_linear
+        torch_code = lower_torch_linear(
+            qkv_meta,
+            q_mod,
+            k_mod,
+            v_mod,
+            decay_mod,
+            custom_io,
+            tuned_config)
+        self.tl_code = torch_code  # for debug
+        torch_attn = load_generated_module(torch_code, "torch_attn")
+        self.attention = torch_attn.linear_attention
@@ -6,6 +6,7 @@ class A100(Arch):
         self.reg_cap = 65536  # 32768
         self.register_per_thread = 255
         self.smem_cap = 163 * 1024  # 164*1024
+        self.max_smem_usage = 163 * 1024
         self.mma_primitive = [16, 8, 16]
         self.threads_per_mma = 32
         self.threads_cap = 1024
@@ -16,5 +17,6 @@ class A100(Arch):
         self.sm_partition = 4
         self.transaction_size = [32, 128]   # in bytes
         self.bandwidth = [1319, 16308]
+        self.tensor_core_tflops = 312  # dense fp16/bf16
         self.platform = "CUDA"
         self.compute_capability = "80"
@@ -0,0 +1,28 @@
+from .arch_base import Arch
+
+import os
+
+
+def _read_l2_cache_bytes(default=1024 * 1024):
+    # linux sysfs, e.g. "2048K"
+    cache_dir = "/sys/devices/system/cpu/cpu0/cache"
+    try:
+        for index in sorted(os.listdir(cache_dir)):
+            with open(os.path.join(cache_dir, index, "level")) as f:
+                if f.read().strip() != "2":
+                    continue
+            with open(os.path.join(cache_dir, index, "size")) as f:
+                size = f.read().strip()
+            unit = {"K": 1024, "M": 1024 * 1024}.get(size[-1], 1)
+            return int(size.rstrip("KM")) * unit
+    except (OSError, ValueError):
+        pass
+    return default
+
+
+class CPU(Arch):
+    def __init__(self, num_cores=None, l2_cache_bytes=None):
+        self.compute_max_core = num_cores if num_cores is not None else (os.cpu_count() or 1)
+        self.l2_cache_bytes = l2_cache_bytes if l2_cache_bytes is not None else _read_l2_cache_bytes()
+        self.platform = "CPU"
+        self.compute_capability = "cpu"
@@ -11,6 +11,7 @@ class RTX4090(Arch):
         self.transaction_size = [32, 128]   # in bytes
         self.max_smem_usage = 100 * 1024
         self.bandwidth = [1008, 0]  # TODO: 1
+        self.tensor_core_tflops = 165  # dense fp16/bf16
         self.platform = "CUDA"
         self.compute_capability = "89"
         self.register_per_thread = 255
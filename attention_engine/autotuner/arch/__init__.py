@@ -1,10 +1,14 @@
-from .arch_base import Arch
+from .arch_base import Arch, ARCH_SCHEMA
 from .A100 import *
 from .RTX4090 import *
 from .H100 import *
+from .CPU import *
 
 AttnDevice = {
     (8,0): A100,
     (8,9): RTX4090,
     (9,0): H100,
 }
+
+from .virtual import VirtualArch, VIRTUAL_ARCHS, load_arch, save_arch
+from .device import device_arch, arch_from_device_properties
@@ -1,3 +1,23 @@
+# fields of gpu archs and their types, checked by Arch.validate
+ARCH_SCHEMA = {
+    "reg_cap": int,                 # registers per SM
+    "register_per_thread": int,
+    "smem_cap": int,                # shared memory per thread block in bytes
+    "max_smem_usage": int,
+    "mma_primitive": list,          # [m, n, k] of a tensor core instruction
+    "threads_per_mma": int,         # threads issuing one mma_primitive
+    "threads_cap": int,             # threads per thread block
+    "compute_max_core": int,        # SMs
+    "warp_size": int,
+    "sm_partition": int,
+    "transaction_size": list,       # in bytes
+    "bandwidth": list,              # [global memory, L2] in GB/s
+    "tensor_core_tflops": (int, float),  # dense fp16/bf16
+    "platform": str,
+    "compute_capability": str,
+}
+
+
 class Arch:
     def __init__(self) -> None:
         self.reg_cap = 0
@@ -8,6 +28,49 @@ class Arch:
         self.transaction_size = [0, 0]
         self.max_smem_usage = 0
         self.bandwidth = [0, 0]
+        self.tensor_core_tflops = 0
         self.platform = "unknown"
         self.compute_capability = "unknown"
         self.register_per_thread = 0
+        self.mma_primitive = [0, 0, 0]
+        self.threads_per_mma = 0
+        self.threads_cap = 0
+
+    @property
+    def name(self):
+        return self.__dict__.get("_name", type(self).__name__)
+
+    def to_dict(self):
+        """
+        the ARCH_SCHEMA fields and the name, the json of a virtual arch
+        """
+        return {"name": self.name, **{key: getattr(self, key, None) for key in ARCH_SCHEMA}}
+
+    def validate(self):
+        """
+        self, raises ValueError if a field of ARCH_SCHEMA is missing or invalid
+        """
+        errors = []
+        for key, types in ARCH_SCHEMA.items():
+            if not hasattr(self, key):
+                errors.append(f"{key} is missing")
+                continue
+            value = getattr(self, key)
+            if not isinstance(value, types) or isinstance(value, bool):
+                errors.append(f"{key} is {value!r}, expected {types}")
+            elif isinstance(value, (int, float)) and value <= 0:
+                errors.append(f"{key} is {value}, expected a positive value")
+        if not errors:
+            if len(self.mma_primitive) != 3 or not all(isinstance(x, int) and x > 0 for x in self.mma_primitive):
+                errors.append(f"mma_primitive is {self.mma_primitive}, expected 3 positive ints")
+            if len(self.transaction_size) != 2 or not all(x > 0 for x in self.transaction_size):
+                errors.append(f"transaction_size is {self.transaction_size}, expected 2 positive sizes")
+            if len(self.bandwidth) != 2 or self.bandwidth[0] <= 0 or self.bandwidth[1] < 0:
+                errors.append(f"bandwidth is {self.bandwidth}, expected [global memory > 0, L2 >= 0]")
+            if self.max_smem_usage > self.smem_cap:
+                errors.append(f"max_smem_usage {self.max_smem_usage} exceeds smem_cap {self.smem_cap}")
+            if self.register_per_thread * self.threads_per_mma > self.reg_cap:
+                errors.append("reg_cap is less than the registers of one mma_primitive")
+        if errors:
+            raise ValueError(f"invalid arch {self.name}: " + "; ".join(errors))
+        return self
@@ -0,0 +1,81 @@
+"""
+Arch of the live device.
+
+SMs, shared memory, registers, threads and memory bandwidth are queried
+from the device. The fields the driver does not report (mma_primitive,
+sm_partition, tensor core throughput, ...) come from the arch class of the
+nearest compute capability, tensor_core_tflops scaled by the SMs.
+
+    python -m autotuner.arch.device > my_gpu.json
+
+writes the arch of the current device as a virtual arch.
+"""
+import json
+import warnings
+
+import torch
+
+from .virtual import VirtualArch
+
+
+def _arch_classes():
+    from . import AttnDevice
+    return AttnDevice
+
+
+def nearest_arch_class(capability):
+    """
+    arch class of the highest compute capability <= capability, else of the lowest
+    """
+    archs = _arch_classes()
+    lower = [cap for cap in archs if cap <= tuple(capability)]
+    return archs[max(lower) if lower else min(archs)]
+
+
+def arch_from_device_properties(props):
+    """
+    VirtualArch of torch.cuda.get_device_properties(device)
+    """
+    capability = (props.major, props.minor)
+    reference = nearest_arch_class(capability)()
+    fields = reference.to_dict()
+    fields["name"] = props.name
+    fields["compute_max_core"] = props.multi_processor_count
+    # torch versions differ in the reported properties
+    smem_cap = getattr(props, "shared_memory_per_block_optin", 0) or reference.smem_cap
+    fields["smem_cap"] = fields["max_smem_usage"] = smem_cap
+    fields["reg_cap"] = getattr(props, "regs_per_multiprocessor", 0) or reference.reg_cap
+    fields["warp_size"] = getattr(props, "warp_size", 0) or reference.warp_size
+    fields["threads_cap"] = getattr(props, "max_threads_per_block", 0) or reference.threads_cap
+    memory_clock_khz = getattr(props, "memory_clock_rate", 0)
+    memory_bus_width = getattr(props, "memory_bus_width", 0)
+    if memory_clock_khz and memory_bus_width:
+        # double data rate
+        fields["bandwidth"] = [round(2 * memory_clock_khz * 1e3 * memory_bus_width / 8 / 1e9), reference.bandwidth[1]]
+    fields["tensor_core_tflops"] = round(
+        reference.tensor_core_tflops * props.multi_processor_count / reference.compute_max_core, 1)
+    if capability not in _arch_classes():
+        fields["compute_capability"] = f"{props.major}{props.minor}"
+    return VirtualArch(fields)
+
+
+def device_arch(device=None):
+    """
+    arch of a cuda device: its arch class if there is one for its compute capability,
+    else queried from the device, with a warning
+    """
+    if device is None:
+        device = torch.cuda.current_device()
+    props = torch.cuda.get_device_properties(device)
+    capability = (props.major, props.minor)
+    archs = _arch_classes()
+    if capability in archs:
+        return archs[capability]()
+    warnings.warn(f"no arch class for {props.name} (sm_{props.major}{props.minor}), queried from the device, "
+                  f"unreported fields from {nearest_arch_class(capability).__name__}")
+    return arch_from_device_properties(props)
+
+
+if __name__ == "__main__":
+    props = torch.cuda.get_device_properties(torch.cuda.current_device())
+    print(json.dumps(arch_from_device_properties(props).to_dict(), indent=4))
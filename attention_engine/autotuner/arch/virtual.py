@@ -0,0 +1,50 @@
+"""
+Archs described by json files, to exercise cost models and config
+generators for GPUs this machine does not have:
+
+    {"name": "L40S", "reg_cap": 65536, "smem_cap": 101376, ...}
+
+with every field of ARCH_SCHEMA. load_arch("L40S") loads
+autotuner/arch/virtual/L40S.json, see VIRTUAL_ARCHS.
+"""
+import json
+import os
+
+from .arch_base import Arch, ARCH_SCHEMA
+
+VIRTUAL_ARCH_DIR = os.path.join(os.path.dirname(__file__), "virtual")
+VIRTUAL_ARCHS = sorted(os.path.splitext(f)[0] for f in os.listdir(VIRTUAL_ARCH_DIR) if f.endswith(".json"))
+
+
+class VirtualArch(Arch):
+    def __init__(self, fields):
+        super().__init__()
+        unknown = set(fields) - set(ARCH_SCHEMA) - {"name"}
+        if unknown:
+            raise ValueError(f"unknown arch fields {sorted(unknown)}")
+        self._name = fields.get("name", "virtual")
+        for key, value in fields.items():
+            if key != "name":
+                setattr(self, key, value)
+        self.validate()
+
+
+def load_arch(name_or_path) -> Arch:
+    """
+    arch of an arch class (A100, H100, ...), a virtual arch of VIRTUAL_ARCHS or a json file
+    """
+    from autotuner import arch as arch_module
+
+    builtin = getattr(arch_module, name_or_path, None)
+    if isinstance(builtin, type) and issubclass(builtin, Arch):
+        return builtin()
+    path = name_or_path
+    if name_or_path in VIRTUAL_ARCHS:
+        path = os.path.join(VIRTUAL_ARCH_DIR, f"{name_or_path}.json")
+    with open(path, "r", encoding="utf-8") as file:
+        return VirtualArch(json.load(file))
+
+
+def save_arch(arch: Arch, path):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(arch.to_dict(), file, indent=4)
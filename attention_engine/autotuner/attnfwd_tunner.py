@@ -1,9 +1,11 @@
 from itertools import product
 import os
-import json
+from autotuner.tune_db import tune_db, current_arch, function_hash
+from autotuner.parallel_compile import compile_configs, compile_cache_root, tl_lower_to_library, load_tl_library
+from autotuner.tune_strategy import make_strategy, tl_profiler_measure
 from benchmark.bench_utils import bench_sigmoidattn_fwd, bench_attention_fwd
 
-import concurrent.futures
+import functools
 import traceback
 
 import torch
@@ -11,24 +13,6 @@ import tilelang as tl
 import tilelang.language as T
 
 
-def cache_module(tuned_config, kernel, output_idx_list,
-                 BATCH, H, N_CTX, D_HEAD, D_HEADV):
-    try:  # cache
-        mod = tl.profiler.cached(
-            kernel,
-            output_idx_list,
-            BATCH,
-            H,
-            N_CTX,
-            D_HEAD,
-            D_HEADV,
-            *tuned_config.values())
-        return mod, tuned_config
-    except Exception as e:
-        print(traceback.format_exc())
-        return None, tuned_config
-
-
 class AttnFwdTunner:
     def __init__(self, DK, DV, block_M, block_N, num_threads, stages):
         self.DK = DK
@@ -59,23 +43,18 @@ class AttnFwdTunner:
         return tuned_configs
 
     def tune(self, kernel, BATCH, H, N_CTX, D_HEAD, D_HEADV, tuned_configs, output_idx_list=[
-             4,], bench_func=bench_sigmoidattn_fwd, file_path="tuned_result.json"):
+             4,], bench_func=bench_sigmoidattn_fwd, file_path="tuned_result.jsonl", num_workers=None,
+             strategy=None):
 
         problem_keys = {
             "B": BATCH, "H": H, "N_CTX": N_CTX, "D_HEAD": D_HEAD, "D_HEADV": D_HEADV, "causal": True
         }
-        # cache
-        if os.path.exists(file_path):
-            with open(file_path, "r", encoding='utf-8') as file:
-                data = json.load(file)
-            for item in data:
-                if all(item.get(key) == value for key,
-                       value in problem_keys.items()):
-                    tuned_config = item.get('tuned_config')
-                    return tuned_config
-        else:
-            with open(file_path, "w", encoding='utf-8') as file:
-                json.dump([], file, ensure_ascii=False, indent=4)
+        # tuned by any tuner sharing the database, for the source of kernel
+        code_hash = function_hash(kernel)
+        db = tune_db(file_path)
+        record = db.lookup("attn_fwd", problem_keys, current_arch(), code_hash=code_hash)
+        if record is not None:
+            return record.config
 
         output_idx_list = output_idx_list  # [4]
         best_latency = 1e6
@@ -85,31 +64,28 @@ class AttnFwdTunner:
         best_output_dict = {}
         latencys = []
         configs_out = []
-        log_file = file_path.replace(".json", ".log")
+        log_file = os.path.splitext(file_path)[0] + ".log"
         log = open(log_file, "a")
 
-        # Step 1: Cache modules in parallel
+        # Step 1: Compile modules in parallel processes
         cached_results = []
-
-        # with concurrent.futures.ProcessPoolExecutor() as executor:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = {
-                executor.submit(
-                    cache_module,
-                    config,
-                    kernel,
-                    output_idx_list,
-                    BATCH,
-                    H,
-                    N_CTX,
-                    D_HEAD,
-                    D_HEADV): config for config in tuned_configs}
-
-            for future in concurrent.futures.as_completed(futures):
-                mod, tuned_config = future.result()
-                if mod is not None:
-                    cached_results.append((mod, tuned_config))
-        # Step 2: Benchmark serially
+        compile_fn = functools.partial(
+            tl_lower_to_library, kernel, (BATCH, H, N_CTX, D_HEAD, D_HEADV))
+        # the libraries are loaded before their directory is removed
+        with compile_cache_root() as cache_root:
+            for result in compile_configs(compile_fn, tuned_configs, num_workers, cache_root):
+                if result.error is not None:
+                    print(result.error)
+                    continue
+                mod, params = load_tl_library(result.artifact)
+                cached_results.append(
+                    (tl.Profiler(mod, params, output_idx_list), result.config))
+        # Step 2: Benchmark serially, with a strategy only its best config
+        strategy = make_strategy(strategy)
+        if strategy is not None:
+            result = strategy.run(range(len(cached_results)), tl_profiler_measure(
+                [mod for mod, _ in cached_results]))
+            cached_results = [] if result.config is None else [cached_results[result.config]]
         for mod, tuned_config in cached_results:
             try:
                 # mod = tl.profiler.cached(kernel, output_idx_list, BATCH, H, N_CTX, D_HEAD, D_HEADV, *tuned_config.values())
@@ -165,8 +141,6 @@ class AttnFwdTunner:
             # new_entry['ref_tflops'] = ref_tflops
             new_entry.update(best_output_dict)
 
-            with open(file_path, "r+", encoding='utf-8') as file:
-                data = json.load(file)
-                data.append(new_entry)
-                file.seek(0)
-                json.dump(data, file, ensure_ascii=False, indent=4)
+            db.append("attn_fwd", problem_keys, new_entry.pop('tuned_config'),
+                      new_entry.pop('latency', best_latency), current_arch(), code_hash=code_hash,
+                      **{k: v for k, v in new_entry.items() if k not in problem_keys})
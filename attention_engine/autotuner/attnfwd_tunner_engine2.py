@@ -1,9 +1,13 @@
 from itertools import product
 import os
-import json
+from autotuner.tune_db import tune_db, current_arch, function_hash
+from autotuner.parallel_compile import compile_configs, compile_cache_root, tl_lower_to_library, load_tl_library
+from autotuner.tune_strategy import make_strategy, tl_profiler_measure
 from benchmark.bench_utils import bench_sigmoidattn_fwd, bench_attention_fwd
+from autotuner.arch import H100
+from autotuner.cost_model import AttnProblem, prune_configs
 
-import concurrent.futures
+import functools
 import traceback
 
 import torch
@@ -11,35 +15,24 @@ import tilelang as tl
 import tilelang.language as T
 
 
-def cache_module(tuned_config, kernel, output_idx_list, problem_keys):
-    try:  # cache
-        # mod = tl.profiler.cached(kernel, output_idx_list, BATCH, H, N_CTX, D_HEAD, D_HEADV, *tuned_config.values())
-        program = kernel(*problem_keys.values(), *tuned_config.values())
-        mod, params = tl.lower(program)
-        return mod, params, tuned_config
-    except Exception as e:
-        print(traceback.format_exc())
-        return None, None, tuned_config
-
-
 def tl_tune(kernel, problem_keys, tuned_configs,
-            output_idx_list=[4,], file_path="tuned_result.json"):
+            output_idx_list=[4,], file_path="tuned_result.jsonl",
+            top_k=None, arch=H100(), num_workers=None, strategy=None):
 
     # problem_keys = {
     #     "B": BATCH, "H": H, "N_CTX": N_CTX, "D_HEAD": D_HEAD, "D_HEADV": D_HEADV, "causal":True
     # }
-    # cache
-    if os.path.exists(file_path):
-        with open(file_path, "r", encoding='utf-8') as file:
-            data = json.load(file)
-        for item in data:
-            if all(item.get(key) == value for key,
-                   value in problem_keys.items()):
-                tuned_config = item.get('tuned_config')
-                return tuned_config, item.get('latency')
-    else:
-        with open(file_path, "w", encoding='utf-8') as file:
-            json.dump([], file, ensure_ascii=False, indent=4)
+    # tuned by any tuner sharing the database, for the source of kernel
+    code_hash = function_hash(kernel)
+    db = tune_db(file_path)
+    record = db.lookup("attn_fwd", problem_keys, current_arch(), code_hash=code_hash)
+    if record is not None:
+        return record.config, record.latency
+
+    # compile&measure only the top_k configs of the cost model
+    if top_k is not None:
+        tuned_configs = prune_configs(
+            tuned_configs, AttnProblem.from_problem_keys(problem_keys), arch, top_k)
 
     output_idx_list = output_idx_list  # [4]
     best_latency = 1e6
@@ -49,28 +42,29 @@ def tl_tune(kernel, problem_keys, tuned_configs,
     best_output_dict = {}
     latencys = []
     configs_out = []
-    log_file = file_path.replace(".json", ".log")
+    log_file = os.path.splitext(file_path)[0] + ".log"
     log = open(log_file, "a")
 
-    # Step 1: Cache modules in parallel
+    # Step 1: Compile modules in parallel processes
     cached_results = []
-
-    # with concurrent.futures.ProcessPoolExecutor() as executor:
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {
-            executor.submit(
-                cache_module,
-                config,
-                kernel,
-                output_idx_list,
-                problem_keys): config for config in tuned_configs}
-
-        for future in concurrent.futures.as_completed(futures):
-            mod, params, tuned_config = future.result()
-            if mod is not None:
-                cached_results.append((mod, params, tuned_config))
+    compile_fn = functools.partial(
+        tl_lower_to_library, kernel, tuple(problem_keys.values()))
+    # the libraries are loaded before their directory is removed
+    with compile_cache_root() as cache_root:
+        for result in compile_configs(compile_fn, tuned_configs, num_workers, cache_root):
+            if result.error is not None:
+                print(result.error)
+                continue
+            mod, params = load_tl_library(result.artifact)
+            cached_results.append((mod, params, result.config))
     # print(cached_results)
-    # Step 2: Benchmark serially
+    # Step 2: Benchmark serially, with a strategy only its best config
+    strategy = make_strategy(strategy)
+    if strategy is not None:
+        result = strategy.run(range(len(cached_results)), tl_profiler_measure(
+            [tl.Profiler(mod, params, output_idx_list, tl.TensorSupplyType.Randn)
+             for mod, params, _ in cached_results]))
+        cached_results = [] if result.config is None else [cached_results[result.config]]
     for mod, params, tuned_config in cached_results:
         try:
             # mod = tl.profiler.cached(kernel, output_idx_list, BATCH, H, N_CTX, D_HEAD, D_HEADV, *tuned_config.values())
@@ -106,7 +100,7 @@ def tl_tune(kernel, problem_keys, tuned_configs,
         print(tuned_config)
         latencys.append(latency)
         configs_out.append(configs_out)
-        log.write(f"Latency: {latency}, Config: {tuned_config}\n")
+        log.write(f"Latency: {latency}, Config: {tuned_config}, Problem: {problem_keys}\n")
         log.flush()
 
     # for tuned_config in tuned_configs:
@@ -135,11 +129,9 @@ def tl_tune(kernel, problem_keys, tuned_configs,
         # new_entry['ref_tflops'] = ref_tflops
         new_entry.update(best_output_dict)
 
-        with open(file_path, "r+", encoding='utf-8') as file:
-            data = json.load(file)
-            data.append(new_entry)
-            file.seek(0)
-            json.dump(data, file, ensure_ascii=False, indent=4)
+        db.append("attn_fwd", problem_keys, new_entry.pop('tuned_config'),
+                  new_entry.pop('latency', best_latency), current_arch(), code_hash=code_hash,
+                  **{k: v for k, v in new_entry.items() if k not in problem_keys})
 
     return best_config, best_latency
 
@@ -175,7 +167,9 @@ class AttnFwdTunner:
         return tuned_configs
 
     def tl_tune(self, kernel, problem_keys, tuned_configs,
-                output_idx_list=[4,], file_path="tuned_result.json"):
+                output_idx_list=[4,], file_path="tuned_result.jsonl",
+                top_k=None, arch=H100(), num_workers=None, strategy=None):
 
         return tl_tune(kernel, problem_keys, tuned_configs,
-                       output_idx_list, file_path)[0]
+                       output_idx_list, file_path, top_k, arch, num_workers,
+                       strategy)[0]
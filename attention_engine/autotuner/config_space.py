@@ -0,0 +1,98 @@
+"""
+Config spaces evaluated as arrays.
+
+A ConfigSpace is the product of named axes. Derived values (e.g. shared
+memory) and constraints are functions of a dict of broadcast tensors, one
+tensor dim per axis, so the feasibility of the whole product is a few
+tensor ops instead of a python call per config:
+
+    space = ConfigSpace({"block_M": [64, 128], "num_threads": [128, 256]})
+    space.add_constraint("warp rows", lambda c: c["block_M"] % (c["num_threads"] // 128 * 64) == 0)
+    space.configs()
+
+Axes of lists, e.g. mem levels [1, 1, 0], are tensors with a trailing dim
+of the list, c["qk_mem_level"][..., 1]. Configs are in the order of
+itertools.product over the axes.
+"""
+from typing import Callable, Dict, List
+
+import torch
+
+
+class ConfigSpace:
+    def __init__(self, axes: Dict[str, list]):
+        self.axes = {name: list(values) for name, values in axes.items()}
+        self.derived = {}
+        self.integer = set()
+        self.constraints = []
+
+    def add_derived(self, name, fn: Callable, integer=False):
+        """
+        value of configs computed from the axes&previous derived values, in the output configs
+        """
+        self.derived[name] = fn
+        if integer:
+            self.integer.add(name)
+        return self
+
+    def add_constraint(self, name, fn: Callable):
+        """
+        fn(c) -> bool tensor, True for the configs to keep
+        """
+        self.constraints.append((name, fn))
+        return self
+
+    @property
+    def size(self):
+        size = 1
+        for values in self.axes.values():
+            size *= len(values)
+        return size
+
+    def _tensors(self):
+        ndim = len(self.axes)
+        tensors = {}
+        for i, (name, values) in enumerate(self.axes.items()):
+            value = torch.tensor(values, dtype=torch.float64)
+            shape = [1] * ndim + list(value.shape[1:])
+            shape[i] = len(values)
+            tensors[name] = value.reshape(shape)
+        return tensors
+
+    def evaluate(self):
+        """
+        (values, mask): axes&derived values broadcast to the product shape, mask of feasible configs
+        """
+        shape = [len(values) for values in self.axes.values()]
+        c = self._tensors()
+        for name, fn in self.derived.items():
+            c[name] = fn(c)
+        mask = torch.ones(shape, dtype=torch.bool)
+        for _, fn in self.constraints:
+            mask &= torch.as_tensor(fn(c)).expand(shape)
+        return c, mask
+
+    def counts(self) -> Dict[str, int]:
+        """
+        configs each constraint rejects on its own, to see which constraints bind
+        """
+        shape = [len(values) for values in self.axes.values()]
+        c = self._tensors()
+        for name, fn in self.derived.items():
+            c[name] = fn(c)
+        return {name: int((~torch.as_tensor(fn(c)).expand(shape)).sum()) for name, fn in self.constraints}
+
+    def configs(self) -> List[dict]:
+        if self.size == 0:
+            return []
+        c, mask = self.evaluate()
+        shape = mask.shape
+        indices = mask.nonzero().tolist()
+        derived = {name: c[name].expand(shape)[mask].tolist() for name in self.derived}
+        configs = []
+        for j, index in enumerate(indices):
+            config = {name: values[i] for (name, values), i in zip(self.axes.items(), index)}
+            for name, values in derived.items():
+                config[name] = int(values[j]) if name in self.integer else values[j]
+            configs.append(config)
+        return configs
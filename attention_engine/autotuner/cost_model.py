@@ -0,0 +1,265 @@
+"""
+Roofline cost model of attention forward tile configs.
+
+Compiling and benchmarking every config that fits in shared memory and
+registers takes tens of minutes per shape. The model estimates the latency
+of a config from the arch description and only the top_k are measured:
+
+- tiles: batch * heads * ceil(seqlen_q / block_M) thread blocks
+- kv blocks of a tile: up to the diagonal if causal, else the density of
+  the block mask (BlockMaskInfo) of all of them, block sparse kernels skip
+  the empty ones
+- occupancy: thread blocks per SM from shared memory, registers and threads
+- wave quantization: tiles run in ceil(tiles / (SMs * occupancy)) waves
+- roofline of a wave: tensor core time of the two gemms padded to
+  mma_primitive vs. global memory time of Q, the K/V reloads and O,
+  overlapped only with software pipelining (stages > 1), plus a fixed
+  cost per kv block iteration
+
+The estimate is only used to rank configs of one problem.
+
+    python -m autotuner.cost_model tuned_result.log --arch H100
+
+reports the rank correlation of the model against the latencies tl_tune logged.
+"""
+from autotuner.decider import memory_usage
+
+import argparse
+import ast
+import math
+import re
+from dataclasses import dataclass
+
+import torch
+
+# resident warps per SM partition to hide the latency of the tensor cores
+_WARPS_PER_PARTITION = 2
+# registers per thread besides the fragments: indices, pointers, rowscales
+_BASE_REGISTERS = 32
+_THREADS_PER_SM = 2048
+# seconds per kv block of a tile besides the gemms: row max/sum reductions, barriers
+_ITERATION_OVERHEAD = 0.2e-6
+# latency tl_tune logs for configs that failed to compile or run
+_FAILED_LATENCY = 1e6
+
+
+@dataclass
+class AttnProblem:
+    batch: int
+    heads: int
+    seqlen_q: int
+    seqlen_kv: int
+    dim: int
+    dimv: int
+    dtype: torch.dtype = torch.float16
+    is_causal: bool = False
+    num_score_fragments: int = 1
+    # fraction of nonzero blocks of the block mask
+    density: float = 1.0
+
+    @classmethod
+    def from_qkv_meta(cls, qkv_meta, is_causal=False, num_score_fragments=1, block_mask_info=None):
+        """
+        block_mask_info: BlockMaskInfo of the block mask of block sparse kernels, its
+        is_causal and density override is_causal
+        """
+        batch, seqlen_q, heads, dim = qkv_meta[0].shape
+        density = 1.0
+        if block_mask_info is not None:
+            is_causal = block_mask_info.is_causal
+            # causal tiles already stop at the diagonal
+            density = 1.0 if is_causal else block_mask_info.density
+        return cls(batch, heads, seqlen_q, qkv_meta[1].shape[1], dim, qkv_meta[2].shape[3],
+                   qkv_meta[0].dtype, is_causal, num_score_fragments, density)
+
+    @classmethod
+    def from_problem_keys(cls, problem_keys):
+        # problem_keys of tl_tune: B, H, N_CTX, D_HEAD, D_HEADV, causal
+        return cls(problem_keys["B"], problem_keys["H"], problem_keys["N_CTX"], problem_keys["N_CTX"],
+                   problem_keys["D_HEAD"], problem_keys["D_HEADV"],
+                   is_causal=bool(problem_keys.get("causal", False)))
+
+
+def _tile(config):
+    # decider: num_threads/stages, tl templates: thread_num/num_stages
+    num_threads = config.get("num_threads", config.get("thread_num"))
+    stages = config.get("stages", config.get("num_stages", 1))
+    return config["block_M"], config["block_N"], num_threads, stages
+
+
+def _pad(x, y):
+    return -(-x // y) * y
+
+
+def estimate_latency(config, problem: AttnProblem, arch) -> float:
+    """
+    estimated latency in ms, inf if the config does not fit on arch
+    """
+    p = problem
+    block_M, block_N, num_threads, stages = _tile(config)
+    shared_mem, reg_num = memory_usage(
+        block_M, block_N, p.dim, p.dimv,
+        config.get("qk_mem_level", [1, 0, 0]), config.get("acco_mem_level", [1, 0, 0]),
+        num_threads, stages, p.dtype, p.num_score_fragments)
+    if shared_mem > arch.smem_cap or reg_num > arch.register_per_thread:
+        return math.inf
+
+    # occupancy
+    registers = min(math.ceil(reg_num) + _BASE_REGISTERS, arch.register_per_thread)
+    blocks_per_sm = min(arch.smem_cap // max(shared_mem, 1),
+                        arch.reg_cap // (registers * num_threads),
+                        _THREADS_PER_SM // num_threads)
+    if blocks_per_sm == 0:
+        return math.inf
+    blocks_per_wave = arch.compute_max_core * blocks_per_sm
+    num_q_tiles = math.ceil(p.seqlen_q / block_M)
+    waves = math.ceil(p.batch * p.heads * num_q_tiles / blocks_per_wave)
+
+    # kv blocks of a tile, causal tiles stop at the diagonal, sparse ones skip empty blocks
+    if p.is_causal:
+        kv_blocks = sum(math.ceil(min((bx + 1) * block_M, p.seqlen_kv) / block_N)
+                        for bx in range(num_q_tiles)) / num_q_tiles
+    else:
+        kv_blocks = max(1.0, p.density * math.ceil(p.seqlen_kv / block_N))
+
+    # S = QK^T [block_M, block_N, dim], O += PV [block_M, dimv, block_N]
+    mma_m, mma_n, mma_k = arch.mma_primitive
+    flops = 2 * _pad(block_M, mma_m) * kv_blocks * (
+        _pad(block_N, mma_n) * _pad(p.dim, mma_k) + _pad(p.dimv, mma_n) * _pad(block_N, mma_k))
+    resident_warps = blocks_per_sm * num_threads // arch.warp_size
+    efficiency = min(1.0, resident_warps / (arch.sm_partition * _WARPS_PER_PARTITION))
+    sm_flops = arch.tensor_core_tflops * 1e12 / arch.compute_max_core * efficiency
+    compute_time = blocks_per_sm * flops / sm_flops
+
+    # Q, K/V reloaded by every tile, O
+    tile_bytes = p.dtype.itemsize * (
+        block_M * p.dim + kv_blocks * block_N * (p.dim + p.dimv) + block_M * p.dimv)
+    memory_time = blocks_per_wave * tile_bytes / (arch.bandwidth[0] * 1e9)
+
+    wave_time = max(compute_time, memory_time) if stages > 1 else compute_time + memory_time
+    wave_time += kv_blocks * _ITERATION_OVERHEAD
+    return waves * wave_time * 1e3
+
+
+def rank_configs(configs, problem: AttnProblem, arch):
+    """
+    configs sorted by estimated latency, configs that do not fit are dropped
+    """
+    latencies = [estimate_latency(config, problem, arch) for config in configs]
+    order = sorted(range(len(configs)), key=lambda i: latencies[i])
+    return [configs[i] for i in order if latencies[i] < math.inf]
+
+
+def prune_configs(configs, problem: AttnProblem, arch, top_k):
+    """
+    the top_k configs of the cost model, best first
+    """
+    if top_k is None:
+        return configs
+    ranked = rank_configs(configs, problem, arch)
+    # keep the candidates if the model rejects all of them
+    return (ranked or configs)[:top_k]
+
+
+def _ranks(values):
+    # ties get their mean rank
+    order = sorted(range(len(values)), key=lambda i: values[i])
+    ranks = [0.0] * len(values)
+    i = 0
+    while i < len(order):
+        j = i
+        while j + 1 < len(order) and values[order[j + 1]] == values[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = (i + j) / 2
+        i = j + 1
+    return ranks
+
+
+def spearman(x, y) -> float:
+    """
+    spearman rank correlation, nan if either is constant
+    """
+    rx, ry = _ranks(x), _ranks(y)
+    mx, my = sum(rx) / len(rx), sum(ry) / len(ry)
+    cov = sum((a - mx) * (b - my) for a, b in zip(rx, ry))
+    var_x = sum((a - mx) ** 2 for a in rx)
+    var_y = sum((b - my) ** 2 for b in ry)
+    if var_x == 0 or var_y == 0:
+        return math.nan
+    return cov / math.sqrt(var_x * var_y)
+
+
+_LOG_LINE = re.compile(r"^Latency: (?P<latency>\S+), Config: (?P<config>\{.*?\})(, Problem: (?P<problem>\{.*\}))?$")
+
+
+def load_tune_log(path):
+    """
+    (problem_keys, config, latency) of the lines tl_tune logged,
+    lines without problem keys are skipped
+    """
+    records = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            match = _LOG_LINE.match(line.strip())
+            if match is None or match.group("problem") is None:
+                continue
+            records.append((ast.literal_eval(match.group("problem")),
+                            ast.literal_eval(match.group("config")),
+                            float(match.group("latency"))))
+    return records
+
+
+def evaluate(records, arch, top_k=8):
+    """
+    per problem: spearman correlation of estimated and measured latencies and
+    whether the measured best config is in the top_k of the model
+    """
+    problems = {}
+    for problem_keys, config, latency in records:
+        if latency >= _FAILED_LATENCY:
+            continue
+        key = tuple(sorted(problem_keys.items()))
+        problems.setdefault(key, (problem_keys, []))[1].append((config, latency))
+
+    results = []
+    for problem_keys, measured in problems.values():
+        if len(measured) < 2:
+            continue
+        problem = AttnProblem.from_problem_keys(problem_keys)
+        configs = [config for config, _ in measured]
+        latencies = [latency for _, latency in measured]
+        estimated = [estimate_latency(config, problem, arch) for config in configs]
+        best = min(range(len(configs)), key=lambda i: latencies[i])
+        results.append({
+            "problem": problem_keys,
+            "num_configs": len(configs),
+            "spearman": spearman(estimated, latencies),
+            "best_in_top_k": configs[best] in prune_configs(configs, problem, arch, top_k),
+        })
+    return results
+
+
+def main(argv=None):
+    from autotuner.arch import load_arch
+
+    parser = argparse.ArgumentParser(description="rank correlation of the cost model against tl_tune logs")
+    parser.add_argument("logs", nargs="+")
+    parser.add_argument("--arch", default="H100", help="arch class, virtual arch or arch json file")
+    parser.add_argument("--top-k", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    records = [record for path in args.logs for record in load_tune_log(path)]
+    results = evaluate(records, load_arch(args.arch), args.top_k)
+    for result in results:
+        print(f"{result['problem']}: configs {result['num_configs']}, "
+              f"spearman {result['spearman']:.3f}, best in top {args.top_k}: {result['best_in_top_k']}")
+    correlations = [result["spearman"] for result in results if not math.isnan(result["spearman"])]
+    if correlations:
+        print(f"mean spearman {sum(correlations) / len(correlations):.3f}, "
+              f"best in top {args.top_k}: {sum(result['best_in_top_k'] for result in results)}/{len(results)}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Online tuning while serving.
+
+An OnlineTuner serves calls with the incumbent of precompiled candidates of
+one problem, e.g. the modules of an engine compiled with several tuned
+configs. sample_rate of the calls are timed, in turns on the incumbent and
+routed to the first undecided challenger. Once both have min_samples
+timings, a challenger whose median latency is win_margin below the
+incumbent's is promoted, else it is dropped. The incumbent is persisted to
+the TuneDB on every promotion and when all challengers are decided; after
+that no call is timed.
+
+Timed calls synchronize the device, the overhead is bounded by sample_rate
+times the cost of a synchronized call. Calls are sampled by an accumulated
+credit instead of at random, so exactly every 1 / sample_rate-th call is
+timed.
+
+timer(fn, *args, **kwargs) -> (output, latency in ms), cuda_event_timer on
+gpus, wall_timer else; tests pass a fake timer.
+"""
+import json
+import statistics
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Callable
+
+import torch
+
+
+def cuda_event_timer(fn, *args, **kwargs):
+    start = torch.cuda.Event(enable_timing=True)
+    end = torch.cuda.Event(enable_timing=True)
+    start.record()
+    output = fn(*args, **kwargs)
+    end.record()
+    end.synchronize()
+    return output, start.elapsed_time(end)
+
+
+def wall_timer(fn, *args, **kwargs):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    output = fn(*args, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return output, (time.perf_counter() - start) * 1e3
+
+
+def default_timer():
+    return cuda_event_timer if torch.cuda.is_available() else wall_timer
+
+
+@dataclass
+class Candidate:
+    config: object
+    fn: Callable
+    samples: list = field(default_factory=list)
+
+
+class OnlineTuner:
+    def __init__(self, candidates, sample_rate=0.01, min_samples=20, win_margin=0.05, timer=None,
+                 db=None, kind="", problem=None, arch="", dtype="", code_hash=""):
+        """
+        candidates: [(config, fn)], the first is the incumbent. db, kind, problem, arch,
+        dtype, code_hash: the TuneDB key the incumbent is persisted to, not persisted without db
+        """
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f"sample_rate {sample_rate} is not in [0, 1]")
+        candidates = [Candidate(config, fn) for config, fn in candidates]
+        if not candidates:
+            raise ValueError("no candidates")
+        self.incumbent = candidates[0]
+        self.challengers = candidates[1:]
+        self.sample_rate = sample_rate
+        self.min_samples = min_samples
+        self.win_margin = win_margin
+        self.timer = timer or default_timer()
+        self.db = db
+        self.key = (kind, problem or {}, arch, dtype, code_hash)
+        self.calls = 0
+        self.timed_calls = 0
+        # (config, incumbent median, challenger median, decision)
+        self.history = []
+        self._credit = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return not self.challengers
+
+    def _schedule(self):
+        # candidate to time for this call, None for an untimed call of the incumbent
+        with self._lock:
+            self.calls += 1
+            if not self.challengers:
+                return None
+            self._credit += self.sample_rate
+            if self._credit < 1:
+                return None
+            self._credit -= 1
+            self.timed_calls += 1
+            challenger = self.challengers[0]
+            if len(self.incumbent.samples) <= len(challenger.samples):
+                return self.incumbent
+            return challenger
+
+    def __call__(self, *args, **kwargs):
+        candidate = self._schedule()
+        if candidate is None:
+            return self.incumbent.fn(*args, **kwargs)
+        if candidate is self.incumbent:
+            output, latency = self.timer(candidate.fn, *args, **kwargs)
+        else:
+            try:
+                output, latency = self.timer(candidate.fn, *args, **kwargs)
+            except Exception:
+                print(traceback.format_exc())
+                self._drop(candidate)
+                return self.incumbent.fn(*args, **kwargs)
+        self._record(candidate, latency)
+        return output
+
+    def _drop(self, challenger):
+        with self._lock:
+            if challenger in self.challengers:
+                self.challengers.remove(challenger)
+                self.history.append((challenger.config, None, None, "failed"))
+                self._decided()
+
+    def _record(self, candidate, latency):
+        with self._lock:
+            candidate.samples.append(float(latency))
+            if not self.challengers:
+                return
+            challenger = self.challengers[0]
+            if min(len(self.incumbent.samples), len(challenger.samples)) < self.min_samples:
+                return
+            self.challengers.pop(0)
+            incumbent_latency = statistics.median(self.incumbent.samples)
+            challenger_latency = statistics.median(challenger.samples)
+            promoted = challenger_latency < incumbent_latency * (1 - self.win_margin)
+            self.history.append((challenger.config, incumbent_latency, challenger_latency,
+                                 "promoted" if promoted else "kept"))
+            # the next challenger is timed in turns with the incumbent from scratch
+            self.incumbent.samples.clear()
+            if promoted:
+                challenger.samples.clear()
+                self.incumbent = challenger
+            if promoted or not self.challengers:
+                self._persist(challenger_latency if promoted else incumbent_latency)
+
+    def _decided(self):
+        if not self.challengers:
+            latency = statistics.median(self.incumbent.samples) if self.incumbent.samples else None
+            self._persist(latency)
+
+    def _persist(self, latency):
+        if self.db is None:
+            return
+        kind, problem, arch, dtype, code_hash = self.key
+        self.db.append(kind, problem, self.incumbent.config, latency, arch, dtype, code_hash,
+                       online=True, complete=not self.challengers)
+
+
+def online_tuner(candidates, sample_rate=0.01, db=None, kind="", problem=None, arch="", dtype="", code_hash="",
+                 **kwargs) -> OnlineTuner:
+    """
+    OnlineTuner of candidates that starts from the config persisted for the key in db:
+    it is the incumbent, and no challenger is timed if all were decided
+    """
+    candidates = list(candidates)
+    record = db.lookup(kind, problem, arch, dtype, code_hash) if db is not None else None
+    if record is not None and record.extra.get("online"):
+        configs = [json.dumps(config, sort_keys=True) for config, _ in candidates]
+        persisted = json.dumps(record.config, sort_keys=True)
+        if persisted in configs:
+            i = configs.index(persisted)
+            candidates = [candidates[i]] + candidates[:i] + candidates[i + 1:]
+            if record.extra.get("complete"):
+                candidates = candidates[:1]
+    return OnlineTuner(candidates, sample_rate, db=db, kind=kind, problem=problem, arch=arch, dtype=dtype,
+                       code_hash=code_hash, **kwargs)
@@ -0,0 +1,145 @@
+"""
+Compile tune configs in a pool of processes.
+
+Lowering a tilelang program is mostly python (the TVM passes), so compiling
+configs in threads is serialized by the GIL. compile_configs runs
+compile_fn(config, cache_dir) in worker processes; every worker has its own
+cache directory, so the compilers of the workers never race on one cache.
+The artifacts (e.g. exported libraries) come back to the caller, which
+benchmarks them serially on the device; artifacts that are files live in
+cache_root, a compile_cache_root() that is removed once they are loaded.
+"""
+import concurrent.futures
+import contextlib
+import hashlib
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import traceback
+import warnings
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Optional
+
+_worker_cache_dir = None
+
+
+@dataclass
+class CompileResult:
+    config: dict
+    artifact: object = None
+    error: Optional[str] = None
+    seconds: float = 0.0
+
+
+def _worker_init(cache_root):
+    global _worker_cache_dir
+    _worker_cache_dir = os.path.join(cache_root, f"worker{os.getpid()}")
+    os.makedirs(_worker_cache_dir, exist_ok=True)
+    # caches&temporary files of the compilers in this worker
+    os.environ["TILELANG_CACHE_DIR"] = os.path.join(_worker_cache_dir, "tilelang")
+    os.environ["TMPDIR"] = _worker_cache_dir
+    tempfile.tempdir = None
+
+
+def _compile(compile_fn, config, cache_dir):
+    start = time.perf_counter()
+    try:
+        artifact = compile_fn(config, cache_dir)
+        return CompileResult(config, artifact, None, time.perf_counter() - start)
+    except Exception:
+        return CompileResult(config, None, traceback.format_exc(), time.perf_counter() - start)
+
+
+def _worker_compile(compile_fn, config):
+    return _compile(compile_fn, config, _worker_cache_dir)
+
+
+@contextlib.contextmanager
+def compile_cache_root(cache_root=None):
+    """
+    cache_root of compile_configs, a temporary directory removed on exit if None
+    """
+    if cache_root is not None:
+        os.makedirs(cache_root, exist_ok=True)
+        yield cache_root
+        return
+    cache_root = tempfile.mkdtemp(prefix="attn_engine_compile_")
+    try:
+        yield cache_root
+    finally:
+        shutil.rmtree(cache_root, ignore_errors=True)
+
+
+def compile_configs(compile_fn, configs, num_workers=None, cache_root=None, mp_context="spawn"):
+    """
+    [CompileResult] in the order of configs.
+    compile_fn(config, cache_dir) -> picklable artifact, a module level function (or a partial
+    of one) so that spawned workers can import it.
+    num_workers: processes, os.cpu_count() by default, 0 compiles in this process.
+    cache_root: directory of the worker cache dirs, a temporary one removed before
+    returning if None, pass one for artifacts that are files in cache_dir.
+    spawn is the default context, forked workers of a process using CUDA are unsafe.
+    compile_fn that can not be pickled, e.g. kernels of generated modules that are
+    not importable by name, compile in this process
+    """
+    if cache_root is None:
+        with compile_cache_root() as cache_root:
+            return compile_configs(compile_fn, configs, num_workers, cache_root, mp_context)
+    configs = list(configs)
+    os.makedirs(cache_root, exist_ok=True)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(configs))
+    if num_workers > 0:
+        try:
+            pickle.dumps(compile_fn)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            warnings.warn(f"compiling in this process, {compile_fn} can not be sent to workers: {e}")
+            num_workers = 0
+    if num_workers == 0:
+        cache_dir = os.path.join(cache_root, "main")
+        os.makedirs(cache_dir, exist_ok=True)
+        return [_compile(compile_fn, config, cache_dir) for config in configs]
+
+    results = [None] * len(configs)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=multiprocessing.get_context(mp_context),
+            initializer=_worker_init, initargs=(cache_root,)) as executor:
+        futures = {executor.submit(_worker_compile, compile_fn, config): i for i, config in enumerate(configs)}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool:
+                # a worker crashed in the compiler, the pool fails the pending configs
+                results[i] = CompileResult(configs[i], None, traceback.format_exc())
+    return results
+
+
+def tl_lower_to_library(kernel, problem_args, config, cache_dir):
+    """
+    compile_fn of tilelang programs kernel(*problem_args, *config.values()):
+    the lowered module is exported to a shared library in cache_dir, load it with load_tl_library
+    """
+    import tilelang as tl
+
+    program = kernel(*problem_args, *config.values())
+    mod, params = tl.lower(program)
+    name = hashlib.md5(repr((problem_args, config)).encode()).hexdigest()
+    path = os.path.join(cache_dir, f"{name}.so")
+    mod.export_library(path)
+    return path, params
+
+
+def load_tl_library(artifact):
+    """
+    (mod, params) of an artifact of tl_lower_to_library, like tl.lower
+    """
+    from tilelang import tvm
+
+    path, params = artifact
+    return tvm.runtime.load_module(path), params
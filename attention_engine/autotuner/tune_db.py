@@ -0,0 +1,506 @@
+"""
+Tuning database shared by all tuners.
+
+One json line per tuned kernel, keyed by (kind, problem, arch, dtype, code_hash,
+toolchain):
+
+    {"kind": "attn_fwd", "problem": {"batch": 4, "heads": 32, ...}, "arch": "sm_90",
+     "dtype": "float16", "code_hash": "...", "toolchain": "tilelang==0.1.0",
+     "config": [128, 128, 2, 256, false], "latency": 0.31, "extra": {}}
+
+kind names the tuned kernel, see KINDS. code_hash is the source_hash of the
+generated module, so records of other templates or score_mods are not
+looked up. toolchain is the compiler version of the process that tuned the
+record, a TuneDB only looks up the records of its own toolchain. `gc`
+rewrites the database without the records no lookup reaches. Appends write whole lines under an
+exclusive flock and never rewrite the file, so tuners of many processes, or
+hosts sharing the file, can append to one database. Lookups go through an
+in-memory index that only reads the lines appended since the last lookup.
+The last record of a key wins.
+
+Untuned problems can take the config of the nearest tuned problems
+(TuneDB.nearest) and be tuned in the background (lookup_or_tune). The
+kernels of a training step are tuned together by joint_tune, the *_step
+kinds record their combined latency. The *_online kinds are the configs
+engines promote while serving, see online_tune.
+"""
+import argparse
+import fcntl
+import functools
+import hashlib
+import importlib
+import importlib.metadata
+import importlib.util
+import inspect
+import itertools
+import json
+import math
+import os
+import subprocess
+import threading
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+
+import torch
+
+KINDS = ("attn_fwd", "attn_bwd", "linear_h", "linear_o", "linear_dh", "linear_dqkg", "linear_dv", "decode",
+         "attn_step", "linear_step", "attn_online", "linear_online")
+
+# problem keys tuned configs do not transfer across: tile sizes and smem depend on them
+EXACT_KEYS = ("dim", "dimv", "D_HEAD", "D_HEADV", "BT")
+
+# fields of the json tune files of the tuners before TuneDB that are not problem keys
+_LEGACY_METRICS = ("latency", "tuned_latency", "tflops", "ref_tflops", "tflops_ref")
+
+
+@dataclass
+class TuneRecord:
+    kind: str
+    problem: dict
+    config: object
+    latency: Optional[float] = None
+    arch: str = ""
+    dtype: str = ""
+    code_hash: str = ""
+    extra: dict = field(default_factory=dict)
+    toolchain: str = ""
+
+    @property
+    def key(self):
+        return _key(self.kind, self.problem, self.arch, self.dtype, self.code_hash, self.toolchain)
+
+
+def _key(kind, problem, arch, dtype, code_hash, toolchain):
+    return (kind, json.dumps(problem, sort_keys=True), arch, dtype, code_hash, toolchain)
+
+
+def _problem_distance(x, y, exact_keys):
+    """
+    None if x and y differ in exact_keys or in values that are not positive numbers
+    """
+    distance = 0.0
+    for key, value in x.items():
+        other = y[key]
+        numeric = all(isinstance(v, (int, float)) and not isinstance(v, bool) and v > 0
+                      for v in (value, other))
+        if key in exact_keys or not numeric:
+            if value != other:
+                return None
+            continue
+        distance += (math.log2(value) - math.log2(other)) ** 2
+    return math.sqrt(distance)
+
+
+def current_arch() -> str:
+    """
+    arch key of the current device, e.g. sm_90
+    """
+    if torch.cuda.is_available():
+        major, minor = torch.cuda.get_device_capability()
+        return f"sm_{major}{minor}"
+    return "cpu"
+
+
+def source_hash(path) -> str:
+    """
+    md5 of a generated kernel module without its TUNE* settings, so engines
+    that only differ in their tune files share records
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        lines = [line for line in file if not line.startswith("TUNE")]
+    return hashlib.md5("".join(lines).encode()).hexdigest()
+
+
+def function_hash(fn) -> str:
+    """
+    source_hash of the file defining fn, e.g. the kernel of a tuner script,
+    md5 of its bytecode if the source is not available
+    """
+    fn = inspect.unwrap(fn)
+    try:
+        return source_hash(inspect.getsourcefile(fn))
+    except (TypeError, OSError):
+        code = getattr(fn, "__code__", None)
+        if code is None:
+            return ""
+        return hashlib.md5(code.co_code + repr(code.co_consts).encode()).hexdigest()
+
+
+def _git_revision(path) -> str:
+    try:
+        result = subprocess.run(["git", "-C", path, "rev-parse", "--short=12", "HEAD"],
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return ""
+    return result.stdout.strip() if result.returncode == 0 else ""
+
+
+@functools.lru_cache(maxsize=None)
+def toolchain_version() -> str:
+    """
+    version of the kernel compiler, e.g. tilelang==0.1.0 of an installed package.
+    a source checkout on PYTHONPATH like the 3rd_parties/tilelang submodule has no
+    package metadata: tilelang.__version__ and its git revision, e.g. tilelang==0.1.0+g1234abcd5678.
+    empty without tilelang
+    """
+    try:
+        return f"tilelang=={importlib.metadata.version('tilelang')}"
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    spec = importlib.util.find_spec("tilelang")
+    if spec is None or spec.origin is None:
+        return ""
+    try:
+        version = str(importlib.import_module("tilelang").__version__)
+    except Exception:
+        version = "source"
+    revision = _git_revision(os.path.dirname(os.path.dirname(spec.origin)))
+    return f"tilelang=={version}" + (f"+g{revision}" if revision else "")
+
+
+class TuneDB:
+    def __init__(self, path, toolchain=None):
+        self.path = path
+        self.toolchain = toolchain_version() if toolchain is None else toolchain
+        self._index = {}
+        self._offset = 0
+        self._inode = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        # read the lines appended since the last refresh
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            fcntl.flock(file, fcntl.LOCK_SH)
+            try:
+                stat = os.fstat(file.fileno())
+                size = stat.st_size
+                if size < self._offset or stat.st_ino != self._inode:
+                    # rewritten by export_records, gc or by hand
+                    self._index.clear()
+                    self._offset = 0
+                    self._inode = stat.st_ino
+                file.seek(self._offset)
+                data = file.read(size - self._offset)
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+        if self._offset == 0 and data.lstrip()[:1] == b"[":
+            raise ValueError(f"{self.path} is a json tune file, convert it with TuneDB.import_legacy")
+        # a partial last line is read again by the next refresh
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                record = TuneRecord(**json.loads(line))
+            except (ValueError, TypeError):
+                continue
+            self._index[record.key] = record
+        self._offset += end
+
+    def _write(self, records):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data = "".join(json.dumps(asdict(record), sort_keys=True) + "\n" for record in records).encode()
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # the file was replaced by gc while waiting for the lock
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    continue
+                while data:
+                    data = data[os.write(fd, data):]
+                return
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def lookup(self, kind, problem, arch="", dtype="", code_hash="") -> Optional[TuneRecord]:
+        with self._lock:
+            self._refresh()
+            return self._index.get(_key(kind, problem, arch, dtype, code_hash, self.toolchain))
+
+    def append(self, kind, problem, config, latency=None, arch="", dtype="", code_hash="", **extra) -> TuneRecord:
+        record = TuneRecord(kind, dict(problem), config, latency, arch, dtype, code_hash, extra, self.toolchain)
+        with self._lock:
+            self._write([record])
+        return record
+
+    def records(self, kind=None) -> list:
+        """
+        the current record of every key
+        """
+        with self._lock:
+            self._refresh()
+            return [record for record in self._index.values() if kind is None or record.kind == kind]
+
+    def nearest(self, kind, problem, arch="", dtype="", code_hash="", k=3,
+                exact_keys=EXACT_KEYS) -> Optional[TuneRecord]:
+        """
+        record of the nearest tuned problems for an untuned problem. candidates
+        have the same kind, arch, dtype, code_hash, toolchain, problem keys and equal
+        exact_keys and non numeric values. the distance is the euclidean distance of
+        log2 of the other values. of the k nearest, the config with the most 1 / (1 + distance) weight wins
+        """
+        neighbors = []
+        for record in self.records(kind):
+            if record.arch != arch or record.dtype != dtype or record.problem.keys() != problem.keys():
+                continue
+            if record.code_hash != code_hash or record.toolchain != self.toolchain:
+                continue
+            if record.config is None or (record.latency is not None and record.latency < 0):
+                continue
+            distance = _problem_distance(problem, record.problem, exact_keys)
+            if distance is None:
+                continue
+            neighbors.append((distance, record))
+        neighbors = sorted(neighbors, key=lambda neighbor: neighbor[0])[:k]
+        if not neighbors:
+            return None
+        votes = {}
+        for distance, record in neighbors:
+            config = json.dumps(record.config, sort_keys=True)
+            weight, nearest = votes.get(config, (0.0, record))
+            votes[config] = (weight + 1 / (1 + distance), nearest)
+        return max(votes.values(), key=lambda vote: vote[0])[1]
+
+    def export_records(self, path):
+        """
+        write the current records to a new database file at path
+        """
+        records = self.records()
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            for record in records:
+                file.write(json.dumps(asdict(record), sort_keys=True) + "\n")
+        os.replace(tmp_path, path)
+
+    def import_records(self, path) -> int:
+        """
+        append the records of the database at path whose key is not tuned here, returns their number
+        """
+        known = {record.key for record in self.records()}
+        new = [record for record in TuneDB(path).records() if record.key not in known]
+        if new:
+            with self._lock:
+                self._write(new)
+        return len(new)
+
+    def import_legacy(self, path, kind, arch="", dtype="", code_hash="") -> int:
+        """
+        append the entries of a json tune file of the tuners before TuneDB,
+        [{**problem_keys, "tuned_config": ..., "latency": ...}, ...]
+        """
+        with open(path, "r", encoding="utf-8") as file:
+            entries = json.load(file)
+        records = []
+        for entry in entries:
+            problem = {k: v for k, v in entry.items() if k != "tuned_config" and k not in _LEGACY_METRICS}
+            metrics = {k: v for k, v in entry.items() if k in _LEGACY_METRICS}
+            latency = metrics.pop("latency", metrics.pop("tuned_latency", None))
+            records.append(TuneRecord(kind, problem, entry.get("tuned_config"), latency,
+                                      arch, dtype, code_hash, metrics, self.toolchain))
+        if records:
+            with self._lock:
+                self._write(records)
+        return len(records)
+
+    def gc(self, code_hashes=None, toolchains=None, dry_run=False):
+        """
+        rewrite the database with the current records lookups reach, see _reachable.
+        lines of superseded records and lines that do not parse are dropped too.
+        appends wait for the rewrite. returns the numbers of (kept, removed) lines
+        """
+        if not os.path.exists(self.path):
+            return 0, 0
+        with self._lock, open(self.path, "rb") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                lines = file.read().splitlines()
+                current = {}
+                for line in lines:
+                    try:
+                        record = TuneRecord(**json.loads(line))
+                    except (ValueError, TypeError):
+                        continue
+                    current[record.key] = record
+                kept = [record for record in current.values() if _reachable(record, code_hashes, toolchains)]
+                if not dry_run:
+                    tmp_path = f"{self.path}.tmp{os.getpid()}"
+                    with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+                        for record in kept:
+                            tmp_file.write(json.dumps(asdict(record), sort_keys=True) + "\n")
+                    os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+        return len(kept), len([line for line in lines if line.strip()]) - len(kept)
+
+    def unreachable(self, code_hashes=None, toolchains=None) -> list:
+        """
+        the current records gc removes
+        """
+        return [record for record in self.records() if not _reachable(record, code_hashes, toolchains)]
+
+
+def _reachable(record, code_hashes=None, toolchains=None):
+    # None keeps the records of every code_hash or toolchain, e.g. of the other hosts sharing the file
+    return (toolchains is None or record.toolchain in toolchains) and \
+        (code_hashes is None or record.code_hash in code_hashes)
+
+
+_dbs = {}
+_dbs_lock = threading.Lock()
+# key -> thread of the problems tuned in the background
+_background = {}
+
+
+def tune_db(path) -> TuneDB:
+    """
+    the TuneDB of path shared in this process
+    """
+    path = os.path.abspath(path)
+    with _dbs_lock:
+        if path not in _dbs:
+            _dbs[path] = TuneDB(path)
+        return _dbs[path]
+
+
+def lookup_or_tune(db, kind, problem, tune_fn, arch="", dtype="", code_hash="",
+                   tune=True, transfer="") -> Optional[TuneRecord]:
+    """
+    the record of problem if it is tuned. else with transfer "nearest" or
+    "background" the record of the nearest tuned problems, "background" also
+    tunes problem in a thread for later runs. else with tune the record of
+    tune_fn() -> (config, latency), else None
+    """
+    record = db.lookup(kind, problem, arch, dtype, code_hash)
+    if record is not None:
+        return record
+    if transfer:
+        record = db.nearest(kind, problem, arch, dtype, code_hash)
+        if record is not None:
+            if transfer == "background":
+                _tune_in_background(db, kind, problem, tune_fn, arch, dtype, code_hash)
+            return record
+    if not tune:
+        return None
+    config, latency = tune_fn()
+    return db.append(kind, problem, config, latency, arch, dtype, code_hash)
+
+
+def joint_tune(db, kind, problem, shared_space, tune_kernels, weights=None, arch="", dtype="", code_hash="",
+               tune=True, transfer="") -> Optional[TuneRecord]:
+    """
+    record of the kernels of a training step tuned for their summed latency, see lookup_or_tune.
+    shared_space: values of the parameters the kernels share, e.g. {"BT": [32, 64, 128]}.
+    tune_kernels(shared) -> {kernel kind: (config, latency)} for one value of them, latency -1 if
+    the kernel failed. weights: runs of a kernel per step, e.g. 2 for a forward kernel recomputed
+    in backward. the config of the record is {"shared": ..., "configs": ..., "latencies": ...}
+    """
+    weights = weights or {}
+
+    def tune_fn():
+        best_config, best_latency = None, -1
+        for values in itertools.product(*shared_space.values()):
+            shared = dict(zip(shared_space, values))
+            kernels = tune_kernels(shared)
+            if any(latency is None or latency < 0 for _, latency in kernels.values()):
+                continue
+            latency = sum(weights.get(k, 1) * kernel_latency for k, (_, kernel_latency) in kernels.items())
+            if best_latency < 0 or latency < best_latency:
+                best_latency = latency
+                best_config = {
+                    "shared": shared,
+                    "configs": {k: config for k, (config, _) in kernels.items()},
+                    "latencies": {k: kernel_latency for k, (_, kernel_latency) in kernels.items()},
+                }
+        return best_config, best_latency
+
+    return lookup_or_tune(db, kind, problem, tune_fn, arch, dtype, code_hash, tune, transfer)
+
+
+def _tune_in_background(db, kind, problem, tune_fn, arch, dtype, code_hash):
+    key = (db.path, *_key(kind, problem, arch, dtype, code_hash, db.toolchain))
+    with _dbs_lock:
+        if key in _background:
+            return
+
+        def run():
+            config, latency = tune_fn()
+            db.append(kind, problem, config, latency, arch, dtype, code_hash)
+
+        _background[key] = threading.Thread(target=run, daemon=True)
+        _background[key].start()
+
+
+def join_background_tuning(timeout=None):
+    """
+    wait for the problems tuned in the background
+    """
+    with _dbs_lock:
+        threads = list(_background.values())
+    for thread in threads:
+        thread.join(timeout)
+
+
+def code_hashes(paths) -> set:
+    """
+    source_hash of the python files in paths, e.g. the generated modules of attn_engine/cache
+    """
+    hashes = set()
+    for path in paths:
+        if os.path.isfile(path):
+            hashes.add(source_hash(path))
+            continue
+        for root, _, files in os.walk(path):
+            hashes.update(source_hash(os.path.join(root, name)) for name in files if name.endswith(".py"))
+    return hashes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="tuning database maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="write the current records of db to path")
+    export_parser.add_argument("db")
+    export_parser.add_argument("path")
+    import_parser = subparsers.add_parser("import", help="append the untuned records of path to db")
+    import_parser.add_argument("db")
+    import_parser.add_argument("path")
+    legacy_parser = subparsers.add_parser("import-legacy", help="append the entries of a json tune file to db")
+    legacy_parser.add_argument("db")
+    legacy_parser.add_argument("path")
+    legacy_parser.add_argument("--kind", required=True, choices=KINDS)
+    legacy_parser.add_argument("--arch", default="")
+    legacy_parser.add_argument("--dtype", default="")
+    gc_parser = subparsers.add_parser("gc", help="list, with --apply remove, the records of db lookups do not reach")
+    gc_parser.add_argument("db")
+    gc_parser.add_argument("--code", nargs="+", default=None,
+                           help="generated modules or their directories, remove the records of other code")
+    gc_parser.add_argument("--toolchain", nargs="+", default=None,
+                           help="toolchains to keep, e.g. tilelang==0.1.0, default all")
+    gc_parser.add_argument("--apply", action="store_true", help="rewrite db, else only list")
+    args = parser.parse_args(argv)
+
+    db = TuneDB(args.db)
+    if args.command == "export":
+        db.export_records(args.path)
+        print(f"exported {len(db.records())} records to {args.path}")
+    elif args.command == "import":
+        print(f"imported {db.import_records(args.path)} records from {args.path}")
+    elif args.command == "gc":
+        hashes = None if args.code is None else code_hashes(args.code)
+        for record in db.unreachable(hashes, args.toolchain):
+            print(f"unreachable: {record.kind} {json.dumps(record.problem, sort_keys=True)} arch={record.arch} "
+                  f"dtype={record.dtype} toolchain={record.toolchain} code_hash={record.code_hash}")
+        kept, removed = db.gc(hashes, args.toolchain, dry_run=not args.apply)
+        if args.apply:
+            print(f"removed {removed} lines, kept {kept} records of {args.db}")
+        else:
+            print(f"would remove {removed} lines and keep {kept} records of {args.db}, rewrite it with --apply")
+    else:
+        print(f"imported {db.import_legacy(args.path, args.kind, args.arch, args.dtype)} records from {args.path}")
+
+
+if __name__ == "__main__":
+    main()
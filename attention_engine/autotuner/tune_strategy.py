@@ -0,0 +1,196 @@
+"""
+Tuning strategies: which configs are benchmarked and for how long.
+
+measure(config, rep) -> latency in ms of config benchmarked for about rep
+ms (the rep of do_bench). configs can be any objects, e.g. config dicts or
+indices of compiled modules; configs that fail raise or return inf.
+
+- Exhaustive: every config for max_rep, as the tuners before strategies
+- SuccessiveHalving: every config for min_rep, the best 1 / eta of them for
+  eta times longer, ..., the finalists for max_rep
+- Hyperband: brackets of successive halving from many configs starting at
+  min_rep to few configs starting at max_rep, for short measurements too
+  noisy to drop configs on
+
+budget_s stops a strategy after that many seconds of wall clock, the best
+config of the longest measurements wins.
+"""
+import inspect
+import math
+import random
+import time
+import traceback
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Trial:
+    config: object
+    rep: float
+    latency: float
+
+
+@dataclass
+class TuneResult:
+    config: object
+    latency: float
+    trials: list = field(default_factory=list)
+
+
+class _BudgetExhausted(Exception):
+    pass
+
+
+class Strategy:
+    def __init__(self, max_rep=100, budget_s=None, clock=time.perf_counter):
+        self.max_rep = max_rep
+        self.budget_s = budget_s
+        self.clock = clock
+
+    def run(self, configs, measure) -> TuneResult:
+        """
+        best config, None if no config could be measured
+        """
+        configs = list(configs)
+        self._measure_fn = measure
+        self._start = self.clock()
+        self._trials = []
+        self._measured = {}
+        try:
+            self._search(configs)
+        except _BudgetExhausted:
+            pass
+        return self._result()
+
+    def _search(self, configs):
+        raise NotImplementedError
+
+    def _measure(self, i, configs, rep):
+        # i: index of the config, a config is measured once per rep
+        if (i, rep) in self._measured:
+            return self._measured[(i, rep)]
+        if self.budget_s is not None and self.clock() - self._start >= self.budget_s:
+            raise _BudgetExhausted
+        try:
+            latency = float(self._measure_fn(configs[i], rep))
+        except Exception:
+            print(traceback.format_exc())
+            latency = math.inf
+        if math.isnan(latency):
+            latency = math.inf
+        self._measured[(i, rep)] = latency
+        self._trials.append(Trial(configs[i], rep, latency))
+        return latency
+
+    def _result(self):
+        trials = [trial for trial in self._trials if trial.latency < math.inf]
+        if not trials:
+            return TuneResult(None, math.inf, self._trials)
+        rep = max(trial.rep for trial in trials)
+        best = min((trial for trial in trials if trial.rep == rep), key=lambda trial: trial.latency)
+        return TuneResult(best.config, best.latency, self._trials)
+
+    def _successive_halving(self, configs, indices, rep, eta):
+        while True:
+            rep = min(rep, self.max_rep)
+            latencies = {i: self._measure(i, configs, rep) for i in indices}
+            if rep >= self.max_rep:
+                return
+            indices = sorted((i for i in indices if latencies[i] < math.inf), key=lambda i: latencies[i])
+            indices = indices[:max(1, len(indices) // eta)]
+            if not indices:
+                return
+            rep *= eta
+
+
+class Exhaustive(Strategy):
+    def _search(self, configs):
+        for i in range(len(configs)):
+            self._measure(i, configs, self.max_rep)
+
+
+class SuccessiveHalving(Strategy):
+    def __init__(self, min_rep=5, max_rep=100, eta=3, budget_s=None, clock=time.perf_counter):
+        super().__init__(max_rep, budget_s, clock)
+        self.min_rep = min_rep
+        self.eta = int(eta)
+
+    def _search(self, configs):
+        self._successive_halving(configs, list(range(len(configs))), self.min_rep, self.eta)
+
+
+class Hyperband(Strategy):
+    def __init__(self, min_rep=1, max_rep=100, eta=3, budget_s=None, clock=time.perf_counter, seed=0):
+        super().__init__(max_rep, budget_s, clock)
+        self.min_rep = min_rep
+        self.eta = int(eta)
+        self.seed = seed
+
+    def _search(self, configs):
+        rng = random.Random(self.seed)
+        s_max = int(math.log(self.max_rep / self.min_rep, self.eta) + 1e-9)
+        for s in range(s_max, -1, -1):
+            # bracket s: n configs from rep max_rep / eta^s, the configs are a
+            # finite list, the most aggressive bracket measures all of them
+            n = math.ceil(len(configs) * (s_max + 1) / ((s + 1) * self.eta ** (s_max - s)))
+            indices = rng.sample(range(len(configs)), min(n, len(configs)))
+            self._successive_halving(configs, indices, self.max_rep / self.eta ** s, self.eta)
+
+
+STRATEGIES = {
+    "exhaustive": Exhaustive,
+    "halving": SuccessiveHalving,
+    "hyperband": Hyperband,
+}
+
+
+def make_strategy(spec):
+    """
+    strategy of spec "name" or "name:key=value,...", e.g. "hyperband:budget_s=300,max_rep=100".
+    None for an empty spec, strategies are returned as is
+    """
+    if not spec or isinstance(spec, Strategy):
+        return spec or None
+    name, _, args = spec.partition(":")
+    if name not in STRATEGIES:
+        raise ValueError(f"unknown tune strategy {name}, expected one of {list(STRATEGIES)}")
+    kwargs = {}
+    for arg in filter(None, args.split(",")):
+        key, _, value = arg.partition("=")
+        kwargs[key.strip()] = float(value)
+    return STRATEGIES[name](**kwargs)
+
+
+def tl_profiler_measure(profilers, warmup=10):
+    """
+    measure of indices into tilelang profilers
+    """
+    def measure(i, rep):
+        profiler = profilers[i]
+        return profiler.do_bench(profiler, warmup=warmup, rep=rep)
+    return measure
+
+
+def tl_autotune(kernel_func, configs, out_idx, strategy, warmup=10):
+    """
+    tune kernel_func(**config) of a tilelang template with strategy in place of
+    tilelang's autotune. configs are compiled when they are first measured.
+    the config of the result has the values in the argument order of kernel_func
+    like tilelang's autotune, None if no config could be measured
+    """
+    import tilelang as tl
+
+    profilers = {}
+
+    def measure(i, rep):
+        if i not in profilers:
+            mod, params = tl.lower(kernel_func(**configs[i]))
+            profilers[i] = tl.Profiler(mod, params, out_idx, tl.TensorSupplyType.Auto)
+        return tl_profiler_measure(profilers, warmup)(i, rep)
+
+    result = make_strategy(strategy).run(range(len(configs)), measure)
+    if result.config is None:
+        return None
+    config = configs[result.config]
+    names = inspect.signature(kernel_func).parameters
+    return TuneResult([config.get(name) for name in names], result.latency, result.trials)
@@ -0,0 +1,111 @@
+"""
+Benchmark throughput of the cpu backend versus the number of worker threads.
+
+Causal softmax attention, the (batch, head, q tile) grid is split across
+num_cores workers, tile sizes come from the L2 size of the machine.
+usage:
+    python -m benchmark.bench_cpu_engine [seq_len]
+"""
+import os
+import sys
+import time
+
+import torch
+
+from attn_engine import AttentionEngine, OnlineFunc
+from autotuner.arch import CPU
+from core.transform.core import SymbolScalar, CustomIO
+from core.transform.graph import Var
+from core.utils import meta_tensor
+
+B, H, D = 1, 8, 64
+softmax_scale = 1 / D ** 0.5
+
+
+def causal_mask(b, h, q_idx, kv_idx):
+    return q_idx >= kv_idx
+
+
+def score_mod(score, custom_fwd_inputs, b, h, q_idx, kv_idx):
+    return score * softmax_scale
+
+
+class OnlineSoftmax(OnlineFunc):
+    def __init__(self):
+        online_rowscales = {
+            "m": SymbolScalar("m", Var("-inf")),
+            "r": SymbolScalar("r", Var("0.0")),
+        }
+        final_rowscales = {
+            "lse": SymbolScalar("lse", Var("0.0")),
+        }
+        super().__init__(online_rowscales, final_rowscales, CustomIO())
+
+    @staticmethod
+    def online_fwd(scores, online_rowscales, b, h, q_idx):
+        m, r = online_rowscales["m"], online_rowscales["r"]
+        m_new = m.max(scores.get_reduce("max"))
+        scale_tmp = (m - m_new).exp()
+        r = r * scale_tmp
+        scores = (scores - m_new).exp()
+        r = r + scores.get_reduce("sum")
+        return scores, {"m": m_new, "r": r}, scale_tmp
+
+    @staticmethod
+    def online_fwd_epilogue(o, online_rowscales, b, h, q_idx):
+        o_new = o / online_rowscales["r"]
+        lse = (online_rowscales["r"]).log() + online_rowscales["m"]
+        return o_new, {"lse": lse}
+
+    @staticmethod
+    def forward(scores, final_rowscales, b, h, q_idx, kv_idx):
+        return (scores - final_rowscales["lse"]).exp()
+
+    @staticmethod
+    def backward(dp, scores, final_rowscales, doosum_rowscales, b, h, q_idx, kv_idx):
+        return (dp - doosum_rowscales) * scores
+
+
+def bench_cores(num_cores, seq_len, rep=3):
+    device = CPU(num_cores=num_cores)
+    qkv_meta = (
+        meta_tensor(B, H, seq_len, D, dtype=torch.float32),
+        meta_tensor(B, H, seq_len, D, dtype=torch.float32),
+        meta_tensor(B, H, seq_len, D, dtype=torch.float32),
+    )
+    mod = AttentionEngine(qkv_meta, CustomIO(), score_mod=score_mod, mask_mod=causal_mask,
+                          online_func=OnlineSoftmax(), device=device, backend="cpu")
+    q = torch.randn(B, seq_len, H, D)
+    k = torch.randn(B, seq_len, H, D)
+    v = torch.randn(B, seq_len, H, D)
+
+    with torch.no_grad():
+        mod(q, k, v)
+        t0 = time.perf_counter()
+        for _ in range(rep):
+            mod(q, k, v)
+        t1 = time.perf_counter()
+    ms = (t1 - t0) / rep * 1e3
+    # causal: half of the qk^T and pv flops
+    flops = 4 * B * H * seq_len * seq_len * D * 0.5
+    return {
+        "cores": num_cores,
+        "seq_len": seq_len,
+        "ms": ms,
+        "tokens/s": B * seq_len / ms * 1e3,
+        "GFLOPS": flops / ms * 1e-6,
+    }
+
+
+if __name__ == "__main__":
+    seq_len = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    max_cores = os.cpu_count() or 1
+    print(f"L2 {CPU().l2_cache_bytes // 1024}KB, {max_cores} cores")
+    base = None
+    num_cores = 1
+    while num_cores <= max_cores:
+        result = bench_cores(num_cores, seq_len)
+        base = base or result["ms"]
+        result["speedup"] = base / result["ms"]
+        print(result)
+        num_cores *= 2
@@ -0,0 +1,66 @@
+"""
+Benchmark compile time (backward + tl codegen) versus score_mod graph size.
+
+Graphs are deep polynomial score_mods with shared subgraphs:
+    x_{i+1} = x_i * x_i + x_i
+usage:
+    python -m benchmark.bench_dag_compile
+"""
+import time
+
+from core.transform.core import SymbolScalar, topo_sort
+from core.transform.graph import Var
+from core.codegen.tl_gen import generate_tl_from_dag
+
+
+def polynomial_score_mod(scores, depth):
+    x = scores
+    for _ in range(depth):
+        x = x * x + x
+    return x
+
+
+def backward_recursive(x, grad=None):
+    """
+    previous recursive backward, revisits shared subgraphs
+    """
+    if grad:
+        x.grad = grad
+    x._backward(x.grad)
+    for node in x.prev:
+        backward_recursive(node)
+
+
+def bench_depth(depth, recursive=False):
+    scores = SymbolScalar("scores", Var("scores"), shape_idx=["block_M", "block_N"])
+    dscores = SymbolScalar("dscores", Var("dscores"), shape_idx=["block_M", "block_N"])
+
+    t0 = time.perf_counter()
+    out = polynomial_score_mod(scores, depth)
+    t1 = time.perf_counter()
+    if recursive:
+        backward_recursive(out, dscores)
+    else:
+        out.backward(dscores)
+    t2 = time.perf_counter()
+    generate_tl_from_dag([out])
+    generate_tl_from_dag([scores.grad])
+    t3 = time.perf_counter()
+    num_nodes = len(topo_sort([out, scores.grad]))
+    return {
+        "depth": depth,
+        "nodes": num_nodes,
+        "trace_ms": (t1 - t0) * 1e3,
+        "backward_ms": (t2 - t1) * 1e3,
+        "codegen_ms": (t3 - t2) * 1e3,
+    }
+
+
+if __name__ == "__main__":
+    print("worklist backward:")
+    for depth in [4, 8, 16, 64, 256, 1024, 4096]:
+        print(bench_depth(depth))
+
+    print("recursive backward (reference):")
+    for depth in [4, 6, 8, 10]:
+        print(bench_depth(depth, recursive=True))
@@ -0,0 +1,62 @@
+"""
+Benchmark config enumeration of decider versus seq_len.
+
+vectorized: constraints of attn_fwd_space evaluated as tensors over the
+capped product space; loop (reference): memory_usage per tuple of the
+same space like the previous decider; uncapped: size of the product space
+with block ranges up to seq_len.
+usage:
+    python -m benchmark.bench_decider
+"""
+import itertools
+import time
+
+import torch
+
+from core.utils import meta_tensor
+from autotuner.arch import A100, H100
+from autotuner.decider import attn_fwd_space, memory_usage
+
+
+def loop_configs(space, qkv_meta, hardware_meta):
+    """
+    previous python loop over the product space
+    """
+    dim_v = qkv_meta[2].shape[3]
+    dtype = qkv_meta[0].dtype
+    configs = []
+    for values in itertools.product(*space.axes.values()):
+        bm, bn, bk, qk_mem, acco_mem, nt, stage = values
+        shared_mem, reg_num = memory_usage(bm, bn, bk, dim_v, qk_mem, acco_mem, nt, stage, dtype)
+        if shared_mem <= hardware_meta.smem_cap and reg_num * nt <= hardware_meta.reg_cap and \
+                reg_num <= hardware_meta.register_per_thread and \
+                bm % ((nt / hardware_meta.threads_per_mma) * hardware_meta.mma_primitive[0]) == 0:
+            configs.append(values)
+    return configs
+
+
+def bench_seqlen(hardware_meta, seqlen, dim=128, loop=True):
+    qkv_meta = [meta_tensor(1, seqlen, 16, dim, dtype=torch.float16)] * 3
+    t0 = time.perf_counter()
+    space = attn_fwd_space(qkv_meta, hardware_meta)
+    configs = space.configs()
+    t1 = time.perf_counter()
+    result = {
+        "arch": type(hardware_meta).__name__,
+        "seqlen": seqlen,
+        "space": space.size,
+        "uncapped_space": attn_fwd_space(qkv_meta, hardware_meta, max_block=seqlen).size,
+        "configs": len(configs),
+        "vectorized_ms": (t1 - t0) * 1e3,
+    }
+    if loop:
+        t2 = time.perf_counter()
+        assert len(loop_configs(space, qkv_meta, hardware_meta)) == len(configs)
+        result["loop_ms"] = (time.perf_counter() - t2) * 1e3
+    return result
+
+
+if __name__ == "__main__":
+    for hardware_meta in [H100(), A100()]:
+        for seqlen in [256, 1024, 8192, 32768]:
+            print(bench_seqlen(hardware_meta, seqlen))
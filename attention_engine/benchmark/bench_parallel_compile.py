@@ -0,0 +1,43 @@
+"""
+Benchmark compile time of tune configs, serial versus worker processes.
+
+Every config compiles a deep polynomial score_mod (backward + tl codegen),
+a CPU bound python workload like lowering a tilelang program, so the
+speedup is measurable without a GPU.
+usage:
+    python -m benchmark.bench_parallel_compile [num_configs] [depth]
+"""
+import os
+import sys
+import time
+
+from autotuner.parallel_compile import compile_configs
+from benchmark.bench_dag_compile import bench_depth
+
+
+def compile_score_mod(config, cache_dir):
+    return bench_depth(config["depth"])["nodes"]
+
+
+def bench_compile(num_configs, depth, num_workers):
+    configs = [{"depth": depth, "id": i} for i in range(num_configs)]
+    t0 = time.perf_counter()
+    results = compile_configs(compile_score_mod, configs, num_workers)
+    t1 = time.perf_counter()
+    assert all(result.error is None for result in results)
+    return {
+        "num_workers": num_workers,
+        "configs": num_configs,
+        "compile_s": t1 - t0,
+        "per_config_s": sum(result.seconds for result in results) / num_configs,
+    }
+
+
+if __name__ == "__main__":
+    num_configs = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    depth = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    serial = bench_compile(num_configs, depth, 0)
+    print(serial)
+    for num_workers in sorted({2, 4, os.cpu_count() or 1}):
+        result = bench_compile(num_configs, depth, num_workers)
+        print({**result, "speedup": serial["compile_s"] / result["compile_s"]})
@@ -121,22 +121,62 @@ import torch
 import torch.fx as fx
 import operator
 
+# torch ops of mask_mod -> tl expression of the args {0}, {1}, ...
+# comparisons, +-*, // and % of tl are the same as torch (floordiv/floormod)
 torch_supported_ops = {
-    # TODO: add more here
-    torch.logical_and: "operator.and_",
+    torch.logical_and: "operator.and_({0}, {1})",
+    torch.logical_or: "operator.or_({0}, {1})",
+    torch.logical_xor: "operator.xor({0}, {1})",
+    torch.logical_not: "T.if_then_else({0}, False, True)",
+    torch.bitwise_and: "operator.and_({0}, {1})",
+    torch.bitwise_or: "operator.or_({0}, {1})",
+    torch.bitwise_xor: "operator.xor({0}, {1})",
+    torch.where: "T.if_then_else({0}, {1}, {2})",
+    torch.abs: "T.abs({0})",
+    torch.maximum: "T.max({0}, {1})",
+    torch.minimum: "T.min({0}, {1})",
+    torch.remainder: "operator.mod({0}, {1})",
+    torch.fmod: "T.truncmod({0}, {1})",
+    torch.floor_divide: "operator.floordiv({0}, {1})",
+    torch.add: "operator.add({0}, {1})",
+    torch.sub: "operator.sub({0}, {1})",
+    torch.mul: "operator.mul({0}, {1})",
+    torch.neg: "operator.neg({0})",
+    torch.eq: "operator.eq({0}, {1})",
+    torch.ne: "operator.ne({0}, {1})",
+    torch.lt: "operator.lt({0}, {1})",
+    torch.le: "operator.le({0}, {1})",
+    torch.gt: "operator.gt({0}, {1})",
+    torch.ge: "operator.ge({0}, {1})",
 }
 
 def is_operator_func(func):
     return func in operator.__dict__.values()
 
-def tl_codegen_from_torchNode(node: fx.Node) -> str:
+def tl_codegen_from_torchNode(node: fx.Node, backend: str = "tl") -> str:
+    """
+    backend "tl": tl expressions, "torch": torch calls on index tensors of the torch template
+    """
+    if node.op in ("call_function", "call_method") and node.kwargs:
+        raise NotImplementedError(f"kwargs of {node.target} are not supported in mask_mod")
+    args = [str(arg) for arg in node.args]
     if node.op == "call_function":
         if is_operator_func(node.target):
-            return f"{node} = operator.{node.target.__name__}({', '.join([str(arg) for arg in node.args])})"
+            return f"{node} = operator.{node.target.__name__}({', '.join(args)})"
         elif node.target in torch_supported_ops:
-            return f"{node} = {torch_supported_ops[node.target]}({', '.join([str(arg) for arg in node.args])})"
+            if backend == "torch":
+                return f"{node} = torch.{node.target.__name__}({', '.join(args)})"
+            return f"{node} = {torch_supported_ops[node.target].format(*args)}"
         else:
             raise NotImplementedError(f"Operator {node.target} is not supported")
+    elif node.op == "call_method":
+        # q_idx.abs(), x.logical_and(y): same as torch.abs(q_idx), torch.logical_and(x, y)
+        method = getattr(torch, node.target, None)
+        if method not in torch_supported_ops:
+            raise NotImplementedError(f"Method {node.target} is not supported")
+        if backend == "torch":
+            return f"{node} = {args[0]}.{node.target}({', '.join(args[1:])})"
+        return f"{node} = {torch_supported_ops[method].format(*args)}"
     elif node.op == "placeholder":
         return ""
     elif node.op == "output":
@@ -144,10 +184,23 @@ def tl_codegen_from_torchNode(node: fx.Node) -> str:
     else:
         raise NotImplementedError(f"Operator {node.op} is not supported")
                 
-def tl_codegen_from_torchfx(mask_graph: fx.GraphModule)->IndentedCode:
+def tl_codegen_from_torchfx(mask_graph: fx.GraphModule, backend: str = "tl")->IndentedCode:
     graph = mask_graph.graph
     mask_code = IndentedCode()
+    placeholders = [node for node in graph.nodes if node.op == "placeholder"]
+    # custom_fwd_inputs["x"] of mask_mod -> global buffer g_x of the kernel
+    custom_inputs = placeholders[4] if len(placeholders) > 4 else None
+    buffers = {}
     for node in graph.nodes:
-        mask_code.add_line(tl_codegen_from_torchNode(node))
+        if node.op == "call_function" and node.target == operator.getitem:
+            src, idx = node.args
+            if src is custom_inputs:
+                buffers[node] = f"g_{idx}"
+                continue
+            if src in buffers:
+                idx = idx if isinstance(idx, tuple) else (idx,)
+                mask_code.add_line(f"{node} = {buffers[src]}[{', '.join([str(i) for i in idx])}]")
+                continue
+        mask_code.add_line(tl_codegen_from_torchNode(node, backend))
     return mask_code
     
\ No newline at end of file
@@ -0,0 +1,112 @@
+from ..transform.core import SymbolScalar
+from ..transform.graph import Const
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+
+@dataclass
+class LivenessInfo:
+    # buffer name of every scheduled node, id(node) -> varname
+    buffers: Dict[int, str] = field(default_factory=dict)
+    # shape_idx -> number of buffers allocated for intermediates
+    num_buffers: Dict[Tuple[str, ...], int] = field(default_factory=dict)
+    # shape_idx -> max number of buffers live at the same time
+    peak_live: Dict[Tuple[str, ...], int] = field(default_factory=dict)
+
+    def peak(self, shape_idx: list) -> int:
+        return self.peak_live.get(tuple(str(i) for i in shape_idx), 0)
+
+
+def is_live_out(node: SymbolScalar, num_uses: int) -> bool:
+    """
+    node value is needed after the schedule: it is not reusable or it has
+    users(count) that are neither lowered(visit_count) nor in the schedule
+    """
+    if not node.allow_reuse:
+        return True
+    return node.count > node.visit_count + num_uses
+
+
+def analyze_liveness(schedule: List[SymbolScalar],
+                     outputs: List[SymbolScalar]) -> LivenessInfo:
+    """
+    linear scan buffer assignment over a topologically sorted schedule.
+    a node writes inplace into an input that dies at this node (same shape),
+    otherwise it takes a free buffer of the same shape&dtype, otherwise a new one.
+    inputs(Var or lowered nodes) are reused inplace only, never pooled.
+    """
+    info = LivenessInfo()
+    output_ids = {id(node) for node in outputs}
+
+    last_use = {}
+    num_uses = {}
+    for i, node in enumerate(schedule):
+        for prev in node.prev:
+            last_use[id(prev)] = i
+            num_uses[id(prev)] = num_uses.get(id(prev), 0) + 1
+    live_out = {}
+
+    def dies_at(node, i):
+        if id(node) not in live_out:
+            live_out[id(node)] = id(node) in output_ids or \
+                is_live_out(node, num_uses[id(node)])
+        return not live_out[id(node)] and last_use.get(id(node)) == i
+
+    live = {}  # buffer name -> shape_idx
+    free = {}  # (shape_idx, dtype) -> [buffer name]
+    pooled = {}  # buffer name -> (shape_idx, dtype), buffers owned by intermediates
+
+    def buffer_of(node):
+        if id(node) not in info.buffers:
+            # input of the schedule
+            info.buffers[id(node)] = node.varname
+            live[node.varname] = tuple(node.shape_idx)
+        return info.buffers[id(node)]
+
+    def update_peak(shape):
+        count = sum(1 for s in live.values() if s == shape)
+        info.peak_live[shape] = max(info.peak_live.get(shape, 0), count)
+
+    for i, node in enumerate(schedule):
+        if isinstance(node.code, Const):
+            continue
+        shape = tuple(node.shape_idx)
+        if not node.prev:
+            buffer_of(node)
+            update_peak(shape)
+            continue
+        dying = []
+        for prev in node.prev:
+            if isinstance(prev.code, Const) or any(prev is d for d in dying):
+                continue
+            buffer_of(prev)
+            if dies_at(prev, i):
+                dying.append(prev)
+
+        # 1. inplace, keep the name of the input
+        buffer = None
+        for prev in dying:
+            if prev.shape_idx == node.shape_idx and prev.allow_reuse:
+                buffer = info.buffers[id(prev)]
+                break
+        # 2. release dead inputs
+        for prev in dying:
+            name = info.buffers[id(prev)]
+            if name == buffer or name not in live:
+                continue
+            del live[name]
+            if name in pooled:
+                free.setdefault(pooled[name], []).append(name)
+        # 3. free buffer, 4. new buffer
+        if buffer is None:
+            key = (shape, node.dtype)
+            if free.get(key):
+                buffer = free[key].pop()
+            else:
+                buffer = node.varname
+                pooled[buffer] = key
+                info.num_buffers[shape] = info.num_buffers.get(shape, 0) + 1
+        info.buffers[id(node)] = buffer
+        live[buffer] = shape
+        update_peak(shape)
+    return info
@@ -0,0 +1,87 @@
+"""
+Check the tl lowering of a mask_mod against create_mask.
+
+The lowered mask code is run in python on scalar indices with a T namespace
+of the tl semantics (floordiv/floormod like python, if_then_else, ...),
+for random problem shapes and random elements of each.
+"""
+from .common import tl_codegen_from_torchfx
+from ..transform.core import create_mask
+from ..utils import IndentedCode
+
+import math
+import operator
+import random
+from types import SimpleNamespace
+
+import torch
+import torch.fx as fx
+
+# tl scalar semantics
+_T = SimpleNamespace(
+    if_then_else=lambda cond, x, y: x if cond else y,
+    abs=abs,
+    max=max,
+    min=min,
+    truncmod=lambda x, y: int(math.fmod(x, y)),
+)
+# ~ of a tl bool is logical not, int is bitwise
+_operator = SimpleNamespace(**{name: getattr(operator, name) for name in dir(operator) if not name.startswith("__")})
+_operator.invert = lambda x: (not x) if isinstance(x, bool) else ~x
+
+
+class _Buffer:
+    # g_x[i, j] of a custom input -> python scalar
+    def __init__(self, tensor):
+        self.tensor = tensor
+
+    def __getitem__(self, idx):
+        return self.tensor[idx].item()
+
+
+def lowered_mask_fn(mask_mod, mask_inputs=None):
+    """
+    python function (b, h, q_idx, kv_idx) -> bool running the tl code of mask_mod
+    """
+    mask_graph = fx.symbolic_trace(mask_mod)
+    nodes = list(mask_graph.graph.nodes)
+    placeholders = [node.name for node in nodes if node.op == "placeholder"][:4]
+    fn_code = IndentedCode()
+    fn_code.add_line(f"def _mask({', '.join(placeholders)}):")
+    fn_code.more_indent()
+    fn_code += tl_codegen_from_torchfx(mask_graph)
+    fn_code.add_line(f"return {nodes[-1].args[0]}")
+    env = {"operator": _operator, "T": _T}
+    for name, tensor in (mask_inputs or {}).items():
+        env[f"g_{name}"] = _Buffer(tensor)
+    exec(str(fn_code), env)
+    return env["_mask"]
+
+
+def verify_mask_codegen(mask_mod, make_inputs=None, num_shapes=4, num_samples=256,
+                        max_batch=3, max_heads=4, max_seqlen=300, seed=0):
+    """
+    raise ValueError at the first element where the tl lowering of mask_mod differs from create_mask.
+    make_inputs(B, H, Q, KV) -> dict of custom_fwd_inputs for mask_mods reading them
+    """
+    rng = random.Random(seed)
+    for _ in range(num_shapes):
+        B, H = rng.randint(1, max_batch), rng.randint(1, max_heads)
+        Q = rng.randint(1, max_seqlen)
+        KV = rng.randint(1, max_seqlen)
+        mask_inputs = make_inputs(B, H, Q, KV) if make_inputs is not None else None
+        mod = mask_mod
+        if mask_inputs is not None:
+            mod = lambda b, h, q_idx, kv_idx: mask_mod(b, h, q_idx, kv_idx, mask_inputs)
+        mask = create_mask(mod, B, H, Q, KV, "cpu")
+        mask = mask.expand(B, H, Q, KV)
+        tl_mask = lowered_mask_fn(mask_mod, mask_inputs)
+        for _ in range(num_samples):
+            b, h = rng.randrange(B), rng.randrange(H)
+            q_idx, kv_idx = rng.randrange(Q), rng.randrange(KV)
+            expected = bool(mask[b, h, q_idx, kv_idx])
+            got = bool(tl_mask(b, h, q_idx, kv_idx))
+            if got != expected:
+                raise ValueError(
+                    f"lowered {getattr(mask_mod, '__name__', 'mask_mod')} is {got}, create_mask is {expected} "
+                    f"at b={b}, h={h}, q_idx={q_idx}, kv_idx={kv_idx} of shape {(B, H, Q, KV)}")
@@ -1,6 +1,7 @@
-from ..transform.core import SymbolScalar, SymbolicArray, CustomIO
+from ..transform.core import SymbolScalar, SymbolicArray, CustomIO, topo_sort
 from ..transform.graph import Var, Const
 from ..utils import IndentedCode
+from .liveness import analyze_liveness
 from typing import Tuple
 
 
@@ -204,12 +205,17 @@ def to_pytorch_op(type: str, *args: SymbolScalar):
         )
     elif type == "ReduceMax":
         code.add_line(
-            f"{args[0].varname} = torch.max({args[1].varname}, dim=-1)"
+            f"{args[0].varname} = torch.amax({args[1].varname}, dim=-1)"
         )
-    elif type == "Sub" or type == "Add" or type == "Mul" or type == "Div" or type == "Neg" or type == "Exp" or type == "Log" or type == "Abs" or type == "Max":
+    elif type == "ReduceAbsSum":
+        code.add_line(
+            f"{args[0].varname} = torch.sum(torch.abs({args[1].varname}), dim=-1)"
+        )
+    elif type == "Sub" or type == "Add" or type == "Mul" or type == "Div" or type == "Neg" or type == "Exp" or type == "Exp2" or type == "Log" or type == "Abs" or type == "Max" or type == "Tanh" or type == "MaxBwd":
         # args idx
         # assume outputn dim max
-        output_idx = args[0].shape_idx
+        # copy, shape_idx of the output node must not change
+        output_idx = list(args[0].shape_idx)
         argnames = [arg.varname for arg in args]
 
         # for bwd grad
@@ -222,7 +228,7 @@ def to_pytorch_op(type: str, *args: SymbolScalar):
 
         for i, arg in enumerate(args):
             assert (len(arg.shape_idx) <= len(output_idx))
-            if len(arg.shape_idx) == 0:
+            if i == 0 or len(arg.shape_idx) == 0:
                 continue
             if len(arg.shape_idx) < len(output_idx):
                 # a -> a[...,None]
@@ -238,8 +244,11 @@ def to_pytorch_op(type: str, *args: SymbolScalar):
                 f"{argnames[0]} = {argnames[1]} + {argnames[2]}"
             )
         elif type == "Max":
+            # torch.maximum does not take python scalars
+            maxargs = [f"torch.as_tensor({name})" if len(arg.shape_idx) == 0 else name
+                       for arg, name in zip(args[1:], argnames[1:])]
             code.add_line(
-                f"{argnames[0]} = torch.maximum({argnames[1]}, {argnames[2]})"
+                f"{argnames[0]} = torch.maximum({maxargs[0]}, {maxargs[1]})"
             )
         elif type == "Exp":
             code.add_line(
@@ -257,6 +266,26 @@ def to_pytorch_op(type: str, *args: SymbolScalar):
             code.add_line(
                 f"{argnames[0]} = torch.log({argnames[1]})"
             )
+        elif type == "Neg":
+            code.add_line(
+                f"{argnames[0]} = -{argnames[1]}"
+            )
+        elif type == "Exp2":
+            code.add_line(
+                f"{argnames[0]} = torch.exp2({argnames[1]})"
+            )
+        elif type == "Tanh":
+            code.add_line(
+                f"{argnames[0]} = torch.tanh({argnames[1]})"
+            )
+        elif type == "Abs":
+            code.add_line(
+                f"{argnames[0]} = torch.abs({argnames[1]})"
+            )
+        elif type == "MaxBwd":
+            code.add_line(
+                f"{argnames[0]} = torch.where({argnames[2]} > {argnames[3]}, {argnames[1]}, 0.0)"
+            )
         else:  # TODO
             raise NotImplementedError(str(type))
 
@@ -267,15 +296,24 @@ def to_pytorch_op(type: str, *args: SymbolScalar):
 
 
 def generate_tl_from_dag(x_list: list[SymbolScalar], to_tl: bool = True, to_cute: bool = False,
-                         output_var_name_list=None, return_inputs=False) -> Tuple[IndentedCode, dict]:
+                         output_var_name_list=None, return_inputs=False,
+                         return_liveness=False) -> Tuple[IndentedCode, dict]:
     # global var
     input_vars = {}
     inputs = {}
 
-    def generate_tl(x: SymbolScalar, varname: str = None):
+    # worklist in topological order instead of recursion,
+    # lowered nodes and their inputs are not revisited
+    schedule = topo_sort(x_list, skip=lambda node: node.lowered)
+    # assign intermediates to a minimal set of buffers
+    liveness = analyze_liveness(schedule, x_list)
+    output_varnames = {}
+    if output_var_name_list is not None:
+        for x, varname in zip(x_list, output_var_name_list):
+            output_varnames[id(x)] = varname
+
+    def generate_node(x: SymbolScalar, varname: str = None):
         tl_code = IndentedCode()
-        if x.lowered:
-            return tl_code
         if isinstance(x.code, Var):
             # tl_code.add_line(f"{x.varname} = {x.code.name}")
             # add input_var
@@ -284,29 +322,12 @@ def generate_tl_from_dag(x_list: list[SymbolScalar], to_tl: bool = True, to_cute
             return tl_code
         if isinstance(x.code, Const):
             return tl_code
-        # for i, input_item in enumerate(x.code.inputs):
-        #     tl_code += generate_tl(SymbolScalar(f"{x.varname}_i{i}", input_item))
-        for i, input_item in enumerate(x.prev):
-            tl_code += generate_tl(input_item)
-            # if input_item.varname == "dsT_0":
-            #     print("dsT_0::",input_item.varname)
-            #     print("x:", x.varname)
-            #     print(input_item.visit_count)
         # all previous node be generated before visit_count+1
         for i, input_item in enumerate(x.prev):
             input_item.visit_count += 1
 
-        # optimize tl performance by inplace operation
-        # print(x.varname)
-        # print([x.varname for x in x.prev])
-        # print("count:",[x.count for x in x.prev])
-        # print("visit:",[x.visit_count for x in x.prev])
-        # print("use_list:",[[usea.varname for usea in x.use_list] for x in x.prev])
-        for i, input_item in enumerate(x.prev):
-            if input_item.shape_idx == x.shape_idx:
-                if (input_item.count == 1 or input_item.visit_count == input_item.count) and input_item.allow_reuse:
-                    x.varname = input_item.varname
-                    break
+        # optimize tl performance by inplace operation and buffer reuse
+        x.varname = liveness.buffers[id(x)]
         if varname is not None:  # overwrite varname
             x.varname = varname
         # add input_var
@@ -323,11 +344,11 @@ def generate_tl_from_dag(x_list: list[SymbolScalar], to_tl: bool = True, to_cute
         return tl_code
 
     tl_code = IndentedCode()
-    for idx, x in enumerate(x_list):
-        tl_code += generate_tl(
-            x,
-            varname=output_var_name_list[idx] if output_var_name_list is not None else None)
-    if not return_inputs:
-        return tl_code, input_vars
-    else:
-        return tl_code, input_vars, inputs
+    for x in schedule:
+        tl_code += generate_node(x, varname=output_varnames.get(id(x)))
+    outputs = (tl_code, input_vars)
+    if return_inputs:
+        outputs += (inputs,)
+    if return_liveness:
+        outputs += (liveness,)
+    return outputs
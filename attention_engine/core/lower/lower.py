@@ -1,10 +1,14 @@
 # from ..attn_engine import OnlineFunc
-from ..transform.core import SymbolScalar, SymbolicArray, CustomIO, is_causal_mask, is_less_causal_mask, create_block_mask
+from ..transform.core import SymbolScalar, SymbolicArray, CustomIO, classify_block_mask, create_block_mask, \
+    mask_mod_uses_batch_head, mask_mod_custom_inputs, block_mask_to_index, block_mask_to_index_bwd
 from ..transform.graph import Var, Const
-from ..utils import IndentedCode
+from ..transform.mask_pattern import analyze_mask_mod
+from ..transform.block_mask_cache import block_mask_cache
+from ..transform.dynamic_mask import DynamicBlockMask
+from ..utils import IndentedCode, meta_tensor
 from ..codegen.tl_gen import generate_tl_from_dag
 from ..template.attn_template import TlAttnTemplate
-from ..template.blockattn_template import TlBlockAttnTemplate
+from ..template.blockattn_template import TlBlockAttnTemplate, TlBlockAttnIdxTemplate
 from dataclasses import dataclass, field, InitVar
 
 from ..codegen.common import *
@@ -18,6 +22,8 @@ import logging
 import torch.fx as fx
 
 accum_type = "float"
+# fraction of nonzero blocks below which the csr block index template is used
+BLOCK_SPARSE_INDEX_DENSITY = 0.25
 
 shape_idx_map_sp = {
     "batch": sp.simplify("bz"),
@@ -147,11 +153,16 @@ class AttnFwdKernelOption(KernelOptionsBase):
 class TunnerOutput:
     TUNE: str = "False"
     TUNE_FILE: str = ""
+    TUNE_TRANSFER: str = ""
+    TUNE_STRATEGY: str = ""
+    TUNE_JOINT: str = "False"
+    TUNE_DEVICE: str = "None"
     block_M: str = "128"
     block_N: str = "128"
     stages: str = "2"
     thread_num: str = "256"
     shared_fuse: str = "False"
+    num_score_fragments: str = "1"
     
 @dataclass
 class AttnBwdKernelOption(KernelOptionsBase):
@@ -192,6 +203,15 @@ class lowerOutput:
     mask_output: str = "True"
     mask_mod_code: str = ""
     is_mask_mod_code: str = "False"
+    # block mask dims, size 1 and index 0 if mask_mod does not use batch/head
+    mask_batch: str = "batch"
+    mask_heads: str = "heads"
+    mask_batch_idx: str = "bz"
+    mask_head_idx: str = "by"
+    mask_head_idx_bwd: str = "bx"
+    # kv loop bounds of q tile bx, closed form from the mask pattern
+    kv_loop_start: str = "0"
+    kv_loop_end: str = "T.ceildiv((bx + 1) * block_M, block_N) if is_casual else T.ceildiv(seq_len, block_N)"
     
     # score_mod name&code
     scores: str = "scores"
@@ -212,7 +232,7 @@ class lowerOnlineFuncOutput:
                  isused_doosum, final_rowscales_length, final_rowscales_load, online_func_fwd, custom_bwd_inputs_load, custom_bwd_body,
                  final_rowscales_shared_init,
                  custom_bwd_inputs, custom_bwd_inputs_init,
-                 o_scale_varname):
+                 o_scale_varname, online_func_num_fragments=1):
         self.online_rowscales_initvalue = str(online_rowscales_initvalue)
         self.online_func_def = str(online_func_def)
         self.call_online_func = call_online_func
@@ -229,6 +249,7 @@ class lowerOnlineFuncOutput:
         self.custom_bwd_inputs = custom_bwd_inputs
         self.custom_bwd_inputs_init = custom_bwd_inputs_init
         self.o_scale_varname = o_scale_varname
+        self.online_func_num_fragments = online_func_num_fragments
 
 
 @dataclass
@@ -244,6 +265,7 @@ class lowerScoreModOutput:
     score_mod_output_var: str
     score_mod_bwd_inputs_declare: str
     score_mod_bwd_inputs_declare_shared: str
+    score_mod_num_fragments: int = 1
     
 @dataclass
 class customInputOutput:
@@ -339,8 +361,10 @@ def lower_online_func(online_func, lower_output: lowerOutput,
     for k, v in new_online_rowscales.items():
         new_online_rowscales[k].set_allow_reuse(False)
     o_scalevar.set_allow_reuse(False)
-    tl_code, input_vars_online = generate_tl_from_dag(
-        list(new_online_rowscales.values()) + [scores_new, o_scalevar])
+    tl_code, input_vars_online, _, liveness = generate_tl_from_dag(
+        list(new_online_rowscales.values()) + [scores_new, o_scalevar],
+        return_inputs=True, return_liveness=True)
+    online_func_num_fragments = liveness.peak(scores.shape_idx)
     online_func_def = func_block(
         online_fwd_func_name, input_vars_online.values(), tl_code
     )
@@ -456,7 +480,8 @@ def lower_online_func(online_func, lower_output: lowerOutput,
         final_rowscales_shared_init=final_rowscales_shared_init,
         custom_bwd_inputs=custom_bwd_inputs,
         custom_bwd_inputs_init=custom_bwd_inputs_init,
-        o_scale_varname=o_scale_varname
+        o_scale_varname=o_scale_varname,
+        online_func_num_fragments=online_func_num_fragments
     )
 
 
@@ -478,7 +503,9 @@ def lower_score_mod(score_mod, custom_fwd_inputs, lower_output: lowerOutput, ker
 
     # 2. score_mod func op def&call
     scores_new = score_mod(scores, custom_fwd_inputs, b, h, q_idx, kv_idx)
-    tl_code, input_vars = generate_tl_from_dag([scores_new])
+    tl_code, input_vars, _, liveness = generate_tl_from_dag(
+        [scores_new], return_inputs=True, return_liveness=True)
+    score_mod_num_fragments = liveness.peak(scores.shape_idx)
     score_mod_func_def = func_block(func_name, input_vars.values(), tl_code)
     call_score_mod = call_op(func_name, input_vars.values())
     
@@ -542,7 +569,8 @@ def lower_score_mod(score_mod, custom_fwd_inputs, lower_output: lowerOutput, ker
         score_mod_fwd_body=str(score_mod_fwd_body),
         score_mod_output_var=str(score_mod_output_var),
         score_mod_bwd_inputs_declare=str(score_mod_bwd_inputs_declare),
-        score_mod_bwd_inputs_declare_shared=str(score_mod_bwd_inputs_declare_shared)
+        score_mod_bwd_inputs_declare_shared=str(score_mod_bwd_inputs_declare_shared),
+        score_mod_num_fragments=score_mod_num_fragments
     )
 
 def lower_custom_inputs(custom_fwd_inputs, lower_output: lowerOutput, kernel_options: KernelOptionsBase):
@@ -602,12 +630,55 @@ def lower_custom_inputs(custom_fwd_inputs, lower_output: lowerOutput, kernel_opt
     )
 
 
+# fwd tiles of the tl template, the space get_configs of attn_tl.py tunes
+TL_FWD_BLOCK_M = (64, 128, 256)
+TL_FWD_BLOCK_N = (32, 64, 128, 256)
+TL_FWD_STAGES = (1, 2)
+TL_FWD_THREADS = (128, 256)
+
+
+def decide_fwd_tile(tune_output, hardware_meta, Batch, head, seqlen, dimqk, dimv, tl_dtype, is_causal=False,
+                    block_mask_info=None):
+    """
+    keep the fwd tile of tune_output if decider finds it fits hardware_meta with
+    tune_output.num_score_fragments live scores, else set the best tile of the
+    cost model among the fitting tiles of the template.
+    block_mask_info: BlockMaskInfo of the block mask of block sparse kernels
+    """
+    from autotuner.decider import decider
+    from autotuner.cost_model import AttnProblem, prune_configs
+    import torch
+    num_score_fragments = int(tune_output.num_score_fragments)
+    qkv_meta = [meta_tensor(Batch, seqlen, head, dimqk, dtype=getattr(torch, tl_dtype)),
+                meta_tensor(Batch, seqlen, head, dimqk, dtype=getattr(torch, tl_dtype)),
+                meta_tensor(Batch, seqlen, head, dimv, dtype=getattr(torch, tl_dtype))]
+    _, configs = decider(qkv_meta, hardware_meta, num_score_fragments)
+    # scores in shared memory iff shared_fuse, acc_o in registers
+    qk_mem_level = [1, int(tune_output.shared_fuse == "True"), 0]
+    tiles = [c for c in configs
+             if c["block_M"] in TL_FWD_BLOCK_M and c["block_N"] in TL_FWD_BLOCK_N
+             and c["stages"] in TL_FWD_STAGES and c["num_threads"] in TL_FWD_THREADS
+             and list(c["qk_mem_level"]) == qk_mem_level and list(c["acco_mem_level"]) == [1, 0, 0]]
+    current = (int(tune_output.block_M), int(tune_output.block_N), int(tune_output.stages),
+               int(tune_output.thread_num))
+    if not tiles or current in [(c["block_M"], c["block_N"], c["stages"], c["num_threads"]) for c in tiles]:
+        return tune_output
+    problem = AttnProblem.from_qkv_meta(qkv_meta, is_causal, num_score_fragments, block_mask_info)
+    best = prune_configs(tiles, problem, hardware_meta, 1)[0]
+    tune_output.block_M = str(best["block_M"])
+    tune_output.block_N = str(best["block_N"])
+    tune_output.stages = str(best["stages"])
+    tune_output.thread_num = str(best["num_threads"])
+    return tune_output
+
+
 def lower_tl(score_mod, block_mask, online_func,
              custom_fwd_inputs,
              Batch, head, seqlen,
              dimqk, dimv, tl_dtype, mask_value, tuned_config=None, infer_mask=False,
              tune=False, tune_file="",
-             tune_bwd=False, tune_file_bwd=""):
+             tune_bwd=False, tune_file_bwd="", tune_transfer="",
+             tune_strategy="", tune_joint=False, hardware_meta=None):
 
     # convert 0 to symbolic
     Batch = f"T.symbolic('{Batch}')" if isinstance(Batch, str) else Batch
@@ -626,7 +697,8 @@ def lower_tl(score_mod, block_mask, online_func,
     # 1. kernel performance configs
     # tune
     if tuned_config is None:
-        tune_output = TunnerOutput(TUNE=str(tune), TUNE_FILE=str(tune_file))
+        tune_output = TunnerOutput(TUNE=str(tune), TUNE_FILE=str(tune_file), TUNE_TRANSFER=tune_transfer,
+                                   TUNE_STRATEGY=tune_strategy, TUNE_JOINT=str(tune_joint))
     else:
         tune_output = TunnerOutput(**tuned_config)
     # Fwd config
@@ -647,7 +719,7 @@ def lower_tl(score_mod, block_mask, online_func,
     
         
     # ------------ATTN BWD----------------
-    # Bwd config(TODO: autotuner bwd)
+    # Bwd config, tuned with TUNE_BWD or TUNE_JOINT
     tune_output_bwd = TunnerOutputBwd(TUNE_BWD=str(tune_bwd), TUNE_FILE_BWD=str(tune_file_bwd))
     if max(dimqk, dimv) <= 64:
         tune_output_bwd.block_M_bwd = "128"
@@ -672,6 +744,28 @@ def lower_tl(score_mod, block_mask, online_func,
     
     lower_online_func_output = lower_online_func(
         online_func, lower_output, kernel_options, bwd_kernel_options)
+    # register pressure of [block_M, block_N] fragments for autotuner
+    tune_output.num_score_fragments = str(max(1,
+        lower_score_mod_output.score_mod_num_fragments,
+        lower_online_func_output.online_func_num_fragments))
+    # fwd tile that fits the registers of the device, unless tuned or fixed for large dimv
+    if hardware_meta is not None and tuned_config is None and not tune and dimv <= 256 and \
+            all(isinstance(x, int) for x in (Batch, head, seqlen)):
+        is_causal = block_mask is not None and analyze_mask_mod(block_mask).is_causal
+        block_mask_info = None
+        if infer_mask and block_mask is not None and not mask_mod_custom_inputs(block_mask):
+            # the cost model of block sparse kernels counts the nonzero blocks at the default tile
+            import torch
+            block_M, block_N = int(tune_output.block_M), int(tune_output.block_N)
+            default_block_mask = block_mask_cache.get_or_create(
+                block_mask, Batch, head, seqlen, seqlen, "cuda" if torch.cuda.is_available() else "cpu",
+                block_M, block_N, separate_full_blocks=True)
+            block_mask_info = classify_block_mask(default_block_mask, block_M, block_N)
+        decide_fwd_tile(tune_output, hardware_meta, Batch, head, seqlen, dimqk, dimv, tl_dtype, is_causal,
+                        block_mask_info)
+    if hardware_meta is not None:
+        # get_configs prunes the tuned tiles for the same device
+        tune_output.TUNE_DEVICE = repr(hardware_meta.to_dict())
     output_idx_list = [i for i in range(3 +
                                         len(custom_fwd_inputs.input_tensors), 3 +
                                         len(custom_fwd_inputs.input_tensors) +
@@ -703,23 +797,59 @@ def lower_tl(score_mod, block_mask, online_func,
         lower_output.mask_output = node_list[-1].args[0].name
         lower_output.mask_mod_code = str(tl_codegen_from_torchfx(mask_graph))
         lower_output.is_mask_mod_code = "True"
+        uses_batch, uses_head = mask_mod_uses_batch_head(block_mask)
+        if not uses_batch:
+            lower_output.mask_batch, lower_output.mask_batch_idx = "1", "0"
+        if not uses_head:
+            lower_output.mask_heads, lower_output.mask_head_idx = "1", "0"
+            lower_output.mask_head_idx_bwd = "0"
     
     # TODO: infer mask logic
     if infer_mask:
         block_M = int(tune_output.block_M)
         block_N = int(tune_output.block_N)
+        # bwd tiles: block_M_bwd kv rows, block_N_bwd q rows
+        block_M_bwd = int(tune_output_bwd.block_M_bwd)
+        block_N_bwd = int(tune_output_bwd.block_N_bwd)
         import torch
-        if block_mask is not None:
-            block_mask = create_block_mask(block_mask, Batch, head, seqlen, seqlen, "cuda" if torch.cuda.is_available() else "cpu", block_M, block_N)
-        if block_mask is not None:
-            lower_output.is_casual = "True" if is_less_causal_mask(block_mask,block_M, block_N) else "False"
-        else:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        mask_mod = block_mask
+        if block_mask is not None and mask_mod_custom_inputs(block_mask):
+            # runtime mask: the kernel takes a dense block mask rebuilt from custom_fwd_inputs every call
             lower_output.is_casual = "False"
-        if block_mask is not None and not is_causal_mask(block_mask, block_M, block_N):
             tlattn_template = TlBlockAttnTemplate
+            block_mask = DynamicBlockMask(block_mask, custom_fwd_inputs.input_tensors.keys(), block_M, block_N,
+                                          block_M_bwd, block_N_bwd)
             output_idx_list = [i+1 for i in output_idx_list]
+            bwd_output_idx_list = [i+3 for i in bwd_output_idx_list]
         else:
-            tlattn_template = TlAttnTemplate
+            if block_mask is not None:
+                # shared by all layers with the same mask&shape
+                block_mask = block_mask_cache.get_or_create(block_mask, Batch, head, seqlen, seqlen, device, block_M, block_N,
+                                                            separate_full_blocks=True)
+            if block_mask is not None:
+                block_mask_info = classify_block_mask(block_mask, block_M, block_N)
+                lower_output.is_casual = "True" if block_mask_info.is_less_causal else "False"
+            else:
+                lower_output.is_casual = "False"
+            if block_mask is not None and not block_mask_info.is_causal:
+                if block_mask_info.density <= BLOCK_SPARSE_INDEX_DENSITY:
+                    # sparse: iterate only the nonzero kv blocks of each row
+                    tlattn_template = TlBlockAttnIdxTemplate
+                    block_mask = block_mask_to_index(block_mask)
+                    output_idx_list = [i+3 for i in output_idx_list]
+                else:
+                    tlattn_template = TlBlockAttnTemplate
+                    output_idx_list = [i+1 for i in output_idx_list]
+                # bwd visits the nonzero q blocks of every kv block
+                block_mask_bwd = block_mask_cache.get_or_create(mask_mod, Batch, head, seqlen, seqlen, device, block_N_bwd, block_M_bwd,
+                                                                separate_full_blocks=True)
+                block_mask = (block_mask, block_mask_to_index_bwd(block_mask_bwd))
+                bwd_output_idx_list = [i+3 for i in bwd_output_idx_list]
+            else:
+                # dense kernel, causal is handled by is_casual
+                tlattn_template = TlAttnTemplate
+                block_mask = None
         
         return tlattn_template(
             custom_fwd_inputs=kernel_code_template.input_args,
@@ -741,7 +871,17 @@ def lower_tl(score_mod, block_mask, online_func,
         
     else:
         tlattn_template = TlAttnTemplate
-        lower_output.is_casual = "True" if block_mask is not None else "False"
+        if block_mask is not None:
+            # is_casual also bounds the q loop of bwd, only for masks with kv_idx <= q_idx
+            mask_pattern = analyze_mask_mod(block_mask)
+            lower_output.is_casual = str(mask_pattern.is_causal)
+            loop_start, loop_end = mask_pattern.tl_kv_loop_bounds()
+            if loop_start is not None:
+                lower_output.kv_loop_start = loop_start
+            if loop_end is not None:
+                lower_output.kv_loop_end = loop_end
+        else:
+            lower_output.is_casual = "False"
 
         return tlattn_template(
             custom_fwd_inputs=kernel_code_template.input_args,
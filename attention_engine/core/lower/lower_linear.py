@@ -106,6 +106,9 @@ class TunnerOutput:
     TUNE_FILE:str=""
     TUNE_BWD:str = "False"
     TUNE_FILE_BWD:str = ""
+    TUNE_TRANSFER:str = ""
+    TUNE_STRATEGY:str = ""
+    TUNE_JOINT:str = "False"
     
     BT: str = "64"
     BK_h: str = "64"
@@ -364,10 +367,13 @@ def lowerQmodFused(q_mod, custom_io, lower_output: lowerOutput):
 
 
 def lower_tl(qkv_meta, q_mod, k_mod, v_mod, decay_mod, custom_io, tuned_config=None,
-             tune=False, tune_filename="", tune_bwd=False):
+             tune=False, tune_filename="", tune_bwd=False, tune_transfer="", tune_strategy="",
+             tune_joint=False):
 
     if tuned_config is None:
-        tune_output = TunnerOutput(TUNE=tune, TUNE_FILE=tune_filename, TUNE_BWD=tune_bwd, TUNE_FILE_BWD=tune_filename)
+        tune_output = TunnerOutput(TUNE=tune, TUNE_FILE=tune_filename, TUNE_BWD=tune_bwd, TUNE_FILE_BWD=tune_filename,
+                                   TUNE_TRANSFER=tune_transfer, TUNE_STRATEGY=tune_strategy,
+                                   TUNE_JOINT=str(tune_joint))
     else:
         tune_output = TunnerOutput(**tuned_config)
 
@@ -0,0 +1,390 @@
+from ..transform.core import SymbolScalar, SymbolicArray, CustomIO, mask_mod_custom_inputs
+from ..transform.graph import Var, Const
+from ..utils import IndentedCode
+from ..codegen.tl_gen import generate_tl_from_dag
+from ..codegen.common import tl_codegen_from_torchfx
+from ..template.torch_attn_template import TorchAttnTemplate, TorchLinearAttnTemplate
+from dataclasses import dataclass
+from copy import deepcopy
+
+import torch.fx as fx
+
+# dims of a custom input -> dim of the [batch, heads, block_M, block_N] tile
+custom_input_dim_map = {
+    "batch": 0,
+    "heads": 1,
+    "seq_len": 2,
+    "seq_len_kv": 3,
+    # "1": None
+}
+
+# runtime tensors keep leading [batch, heads] dims,
+# shape_idx only describes the broadcast of the trailing tile dims
+SCORES_SHAPE = ["block_M", "block_N"]
+ROWSCALES_SHAPE = ["block_M"]
+
+
+@dataclass
+class TorchTunnerOutput:
+    block_M: str = "64"
+    block_N: str = "64"
+    block_M_bwd: str = "64"
+    block_N_bwd: str = "64"
+    # threads over the (batch, head, q tile) grid, 0 runs all heads in one block
+    num_workers: str = "0"
+
+
+def cpu_tile_config(D, DV, device):
+    """
+    block sizes whose float32 working set of one kv iteration fits in half of L2,
+    one worker thread per core
+    """
+    budget = device.l2_cache_bytes // 2
+
+    def fit(num_tiles, row_elems):
+        block = 256
+        while block > 16 and 4 * (num_tiles * block * block + block * row_elems) > budget:
+            block //= 2
+        return str(block)
+
+    # fwd: q, k, v, acc_o rows; scores, p, mask tiles
+    block_fwd = fit(3, 2 * D + 2 * DV)
+    # bwd: q, do, dq, k, v, dk, dv rows; p, dp, ds, mask + score_mod intermediates
+    block_bwd = fit(5, 4 * D + 3 * DV)
+    return TorchTunnerOutput(
+        block_M=block_fwd, block_N=block_fwd,
+        block_M_bwd=block_bwd, block_N_bwd=block_bwd,
+        num_workers=str(device.compute_max_core),
+    )
+
+
+@dataclass
+class lowerTorchOutput:
+    is_inf_mask: str = "True"
+    # mask_mod name&code
+    q_idx: str = "q_idx"
+    kv_idx: str = "kv_idx"
+    batch_idx: str = "batch_idx"
+    head_idx: str = "head_idx"
+    mask_output: str = "True"
+    mask_mod_code: str = ""
+    is_mask_mod_code: str = "False"
+
+
+@dataclass
+class lowerTorchCustomInputOutput:
+    custom_input_dims: str = "[]"
+    custom_fwd_inputs_tile: str = ""
+
+
+@dataclass
+class lowerTorchScoreModOutput:
+    score_mod_fwd_body: str
+    score_mod_output_var: str
+    score_mod_bwd_fwd_body: str
+    score_mod_bwd_output_var: str
+    score_mod_backward: str
+    score_mod_grad_var: str
+
+
+@dataclass
+class lowerTorchOnlineFuncOutput:
+    o_scale_init: str
+    online_rowscales_initvalue: str
+    # acc_o and online_rowscales, kept for rows masked in a whole kv tile
+    online_state: str
+    online_func_body: str
+    o_scale_update: str
+    online_rowscales_update: str
+    online_func_output_var: str
+    online_func_epilogue: str
+    acc_o_output_var: str
+    final_rowscales_save: str
+    final_rowscales_length: str
+    final_rowscales_load: str
+    online_func_fwd: str
+    online_func_fwd_output_var: str
+    online_func_bwd: str
+    online_func_bwd_output_var: str
+    isused_doosum: str
+
+
+def index_vars(shape_idx, prefix=""):
+    """
+    b, h, q_idx, kv_idx, bound to broadcastable index tensors in the template
+    """
+    return [SymbolScalar(f"{prefix}{name}", Var(f"{prefix}{name}"), shape_idx=list(shape_idx))
+            for name in ["b", "h", "q_idx", "kv_idx"]]
+
+
+def clear_custom_inputs(custom_fwd_inputs: CustomIO):
+    for v in custom_fwd_inputs.input_tensors.values():
+        v.clear_codegen()
+
+
+def lower_custom_inputs(custom_fwd_inputs: CustomIO):
+    custom_input_dims = []
+    custom_fwd_inputs_tile = IndentedCode()
+    for i, (k, v) in enumerate(custom_fwd_inputs.input_tensors.items()):
+        dims = []
+        for shape in v.shape_idx:
+            if shape in custom_input_dim_map.keys():
+                dims.append(custom_input_dim_map[shape])
+            elif shape == "1":
+                dims.append(None)
+            else:
+                raise NotImplementedError(
+                    f"dim {shape} of custom input {k} is not supported by torch backend")
+        custom_input_dims.append(dims)
+        custom_fwd_inputs_tile.add_line(
+            f"{k} = _tile(_custom[{i}], _q0, _q1, _k0, _k1)")
+        v.shape_idx = [
+            "block_M" if custom_input_dim_map["seq_len"] in dims else "1",
+            "block_N" if custom_input_dim_map["seq_len_kv"] in dims else "1"]
+    return lowerTorchCustomInputOutput(
+        custom_input_dims=str(custom_input_dims),
+        custom_fwd_inputs_tile=str(custom_fwd_inputs_tile)
+    )
+
+
+def lower_score_mod(score_mod, custom_fwd_inputs: CustomIO):
+    # 1. fwd
+    scores = SymbolScalar("scores", Var("scores"), shape_idx=list(SCORES_SHAPE))
+    clear_custom_inputs(custom_fwd_inputs)
+    scores_new = score_mod(scores, custom_fwd_inputs, *index_vars(SCORES_SHAPE))
+    torch_code, _ = generate_tl_from_dag([scores_new], to_tl=False)
+    score_mod_fwd_body = str(torch_code)
+    score_mod_output_var = scores_new.varname
+
+    # 2. bwd, recompute fwd and keep the inputs of grad
+    scores = SymbolScalar("scores", Var("scores"), shape_idx=list(SCORES_SHAPE))
+    dscores = SymbolScalar("dscores", Var("dscores"), shape_idx=list(SCORES_SHAPE))
+    clear_custom_inputs(custom_fwd_inputs)
+    scores_new = score_mod(scores, custom_fwd_inputs, *index_vars(SCORES_SHAPE))
+    scores_new.backward(dscores)
+    torch_code, _ = generate_tl_from_dag([scores_new], to_tl=False)
+    score_mod_bwd_fwd_body = str(torch_code)
+    score_mod_bwd_output_var = scores_new.varname
+    if scores.grad is None:
+        score_mod_backward = ""
+        score_mod_grad_var = "torch.zeros_like(dscores)"
+    else:
+        torch_code, _ = generate_tl_from_dag([scores.grad], to_tl=False)
+        score_mod_backward = str(torch_code)
+        score_mod_grad_var = scores.grad.varname
+
+    return lowerTorchScoreModOutput(
+        score_mod_fwd_body=score_mod_fwd_body,
+        score_mod_output_var=score_mod_output_var,
+        score_mod_bwd_fwd_body=score_mod_bwd_fwd_body,
+        score_mod_bwd_output_var=score_mod_bwd_output_var,
+        score_mod_backward=score_mod_backward,
+        score_mod_grad_var=score_mod_grad_var
+    )
+
+
+def lower_online_func(online_func):
+    # b, h, q_idx of online_func are [batch, heads, block_M] rows, named apart from score_mod
+    # ones, bwd keeps score_mod intermediates alive across online_func code
+    online_rowscales = online_func.online_rowscales
+
+    # 1. init online_rowscales, o_scale
+    scores = SymbolicArray("scores", Var("scores"), shape_idx=list(SCORES_SHAPE))
+    b, h, q_idx, _ = index_vars(ROWSCALES_SHAPE, prefix="online_")
+    online_rowscales_initvalue = IndentedCode()
+    for k, v in online_rowscales.items():  # v.code is Var
+        online_rowscales_initvalue.add_line(
+            f"{v.varname} = torch.full(_rows, float(\"{v.code.name}\"), dtype=torch.float, device=device)")
+
+    # 2. online_fwd
+    scores_new, new_online_rowscales, o_scalevar = online_func.online_fwd(
+        scores, online_rowscales, b, h, q_idx)
+    for k, v in new_online_rowscales.items():
+        new_online_rowscales[k].set_allow_reuse(False)
+    o_scalevar.set_allow_reuse(False)
+    torch_code, _ = generate_tl_from_dag(
+        list(new_online_rowscales.values()) + [scores_new, o_scalevar], to_tl=False)
+    online_func_body = str(torch_code)
+    online_func_output_var = scores_new.varname
+
+    o_scale_init = ""
+    if isinstance(o_scalevar.code, Const):
+        o_scale_update = f"acc_o = acc_o * {o_scalevar.varname}"
+    else:
+        o_scale_update = f"acc_o = acc_o * {o_scalevar.varname}[..., None]"
+        if isinstance(o_scalevar.code, Var) and \
+                o_scalevar.varname not in [v.varname for v in online_rowscales.values()]:
+            o_scale_init = f"{o_scalevar.varname} = torch.ones(_rows, dtype=torch.float, device=device)"
+
+    # 3. online_rowscales update, all at once
+    update_dst = []
+    update_src = []
+    for k, v in new_online_rowscales.items():
+        if v.varname == online_rowscales[k].varname:
+            continue
+        update_dst.append(online_rowscales[k].varname)
+        update_src.append(v.varname)
+    online_rowscales_update = f"{', '.join(update_dst)} = {', '.join(update_src)}" \
+        if update_dst else ""
+
+    # 4. online_fwd_epilogue
+    for k, v in online_rowscales.items():
+        online_rowscales[k].clear_codegen()
+    acco = SymbolicArray("acc_o", Var("acc_o"), shape_idx=["block_M", "dimv"])
+    b, h, q_idx, _ = index_vars(ROWSCALES_SHAPE, prefix="online_")
+    acco_new, new_final_rowscales = online_func.online_fwd_epilogue(
+        acco, online_rowscales, b, h, q_idx)
+    torch_code, _ = generate_tl_from_dag(
+        [acco_new] + list(new_final_rowscales.values()), to_tl=False)
+    online_func_epilogue = str(torch_code)
+    final_rowscales_save = IndentedCode()
+    for i, v in enumerate(new_final_rowscales.values()):
+        final_rowscales_save.add_line(f"_final_rowscales[{i}][:, :, _q0:_q1] = {v.varname}")
+
+    # 5. bwd: online_func forward with final_rowscales
+    final_rowscales_names = list(new_final_rowscales.keys())
+    final_rowscales_load = IndentedCode()
+    for i, k in enumerate(final_rowscales_names):
+        final_rowscales_load.add_line(f"{k} = _final_rowscales[{i}][:, :, _q0:_q1]")
+
+    def final_rowscales_bwd():
+        return {k: SymbolScalar(k, Var(k), shape_idx=list(ROWSCALES_SHAPE))
+                for k in final_rowscales_names}
+
+    p = SymbolScalar("p", Var("p"), shape_idx=list(SCORES_SHAPE))
+    b, h, q_idx, _ = index_vars(ROWSCALES_SHAPE, prefix="online_")
+    _, _, _, kv_idx = index_vars(SCORES_SHAPE, prefix="online_")
+    p_new = online_func.forward(p, final_rowscales_bwd(), b, h, q_idx, kv_idx)
+    torch_code, _ = generate_tl_from_dag([p_new], to_tl=False)
+    online_func_fwd = str(torch_code)
+    online_func_fwd_output_var = p_new.varname
+
+    # 6. bwd: online_func backward
+    dp = SymbolScalar("dp", Var("dp"), shape_idx=list(SCORES_SHAPE))
+    p = SymbolScalar("p", Var("p"), shape_idx=list(SCORES_SHAPE))
+    doosum = SymbolScalar("doosum", Var("doosum"), shape_idx=list(ROWSCALES_SHAPE))
+    b, h, q_idx, _ = index_vars(ROWSCALES_SHAPE, prefix="online_")
+    _, _, _, kv_idx = index_vars(SCORES_SHAPE, prefix="online_")
+    dscores = online_func.backward(dp, p, final_rowscales_bwd(), doosum, b, h, q_idx, kv_idx)
+    torch_code, input_vars_bwd = generate_tl_from_dag([dscores], to_tl=False)
+    online_func_bwd = str(torch_code)
+    online_func_bwd_output_var = dscores.varname
+    isused_doosum = doosum.varname in input_vars_bwd
+
+    return lowerTorchOnlineFuncOutput(
+        o_scale_init=o_scale_init,
+        online_rowscales_initvalue=str(online_rowscales_initvalue),
+        online_state=", ".join(["acc_o"] + [v.varname for v in online_rowscales.values()]),
+        online_func_body=online_func_body,
+        o_scale_update=o_scale_update,
+        online_rowscales_update=online_rowscales_update,
+        online_func_output_var=online_func_output_var,
+        online_func_epilogue=online_func_epilogue,
+        acc_o_output_var=acco_new.varname,
+        final_rowscales_save=str(final_rowscales_save),
+        final_rowscales_length=str(len(final_rowscales_names)),
+        final_rowscales_load=str(final_rowscales_load),
+        online_func_fwd=online_func_fwd,
+        online_func_fwd_output_var=online_func_fwd_output_var,
+        online_func_bwd=online_func_bwd,
+        online_func_bwd_output_var=online_func_bwd_output_var,
+        isused_doosum=str(isused_doosum)
+    )
+
+
+def lower_torch(score_mod, block_mask, online_func,
+                custom_fwd_inputs, mask_value="-inf", tuned_config=None):
+    """
+    blocked online attention in pytorch for the same score_mod, mask_mod and online_func,
+    runs on cpu, used as fallback and as reference of the tl kernels.
+    """
+    # lowering changes codegen state and shape of the symbolic inputs, keep user objects intact
+    online_func = deepcopy(online_func)
+    custom_fwd_inputs = deepcopy(custom_fwd_inputs)
+
+    lower_output = lowerTorchOutput()
+    lower_output.is_inf_mask = "True" if block_mask is not None and mask_value == "-inf" else "False"
+    if tuned_config is None:
+        tune_output = TorchTunnerOutput()
+    else:
+        tune_output = TorchTunnerOutput(**tuned_config)
+
+    lower_custom_inputs_output = lower_custom_inputs(custom_fwd_inputs)
+    lower_score_mod_output = lower_score_mod(score_mod, custom_fwd_inputs)
+    lower_online_func_output = lower_online_func(online_func)
+
+    # mask mod
+    if block_mask is not None:
+        if mask_mod_custom_inputs(block_mask):
+            raise NotImplementedError("mask_mod reading custom_fwd_inputs is only supported by tl backend")
+        mask_graph = fx.symbolic_trace(block_mask)
+        node_list = [node for node in mask_graph.graph.nodes]
+        lower_output.batch_idx = node_list[0].name
+        lower_output.head_idx = node_list[1].name
+        lower_output.q_idx = node_list[2].name
+        lower_output.kv_idx = node_list[3].name
+        lower_output.mask_output = node_list[-1].args[0].name
+        lower_output.mask_mod_code = str(tl_codegen_from_torchfx(mask_graph, backend="torch"))
+        lower_output.is_mask_mod_code = "True"
+
+    return TorchAttnTemplate(
+        **lower_custom_inputs_output.__dict__,
+        **lower_score_mod_output.__dict__,
+        **lower_online_func_output.__dict__,
+        **lower_output.__dict__,
+        **tune_output.__dict__,
+    )()
+
+
+@dataclass
+class TorchLinearTunnerOutput:
+    BT: str = "64"
+
+
+def lower_linear_mod(mod, name, shape_idx, custom_io: CustomIO):
+    """
+    pytorch expr of q_mod/k_mod/v_mod/decay_mod on the whole tensor
+    """
+    x = SymbolicArray(name, Var(name), shape_idx=shape_idx)
+    custom_io = deepcopy(custom_io)
+    # inputs are used after the mod, no inplace
+    x.count += 1
+    for v in custom_io.input_tensors.values():
+        v.count += 1
+    x_new = mod(x, custom_io)
+    torch_code, _ = generate_tl_from_dag([x_new], to_tl=False)
+    return str(torch_code), x_new.varname
+
+
+def lower_torch_linear(qkv_meta, q_mod, k_mod, v_mod, decay_mod, custom_io,
+                       tuned_config=None):
+    if custom_io is None:
+        custom_io = CustomIO()
+    if tuned_config is None:
+        tune_output = TorchLinearTunnerOutput()
+    else:
+        tune_output = TorchLinearTunnerOutput(**tuned_config)
+
+    mod_outputs = {}
+    for name, mod, shape_idx in [
+        ("q", q_mod, ["B", "H", "T", "D"]),
+        ("k", k_mod, ["B", "H", "T", "D"]),
+        ("v", v_mod, ["B", "H", "T", "DV"]),
+        ("decay", decay_mod, ["B", "H", "T"]),
+    ]:
+        if mod is None:
+            mod_outputs[f"{name}_mod_expr"] = ""
+            mod_outputs[f"{name}_name"] = name
+        else:
+            mod_outputs[f"{name}_mod_expr"], mod_outputs[f"{name}_name"] = \
+                lower_linear_mod(mod, name, shape_idx, custom_io)
+
+    custom_inputs_list = ", ".join(custom_io.input_tensors.keys())
+    custom_inputs_cast = "\n".join(
+        f"{name} = {name}.float()" for name in custom_io.input_tensors.keys())
+    return TorchLinearAttnTemplate(
+        custom_inputs_list=custom_inputs_list,
+        custom_inputs_cast=custom_inputs_cast,
+        **mod_outputs,
+        **tune_output.__dict__,
+    )()
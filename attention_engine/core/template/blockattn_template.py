@@ -15,7 +15,7 @@ class TlBlockAttnTemplate:
         with open(template_dir, 'r') as f:
             TL_KERNEL = f.read()
 
-        template = jinja2.Template(TL_KERNEL)
+        template = jinja2.Template(TL_KERNEL, trim_blocks=True, lstrip_blocks=True)
 
         # remove None
         kargs = {k: (v if v is not None else "") for k, v in kargs.items()}
@@ -25,3 +25,7 @@ class TlBlockAttnTemplate:
         return self.tlcode
 
 
+class TlBlockAttnIdxTemplate(TlBlockAttnTemplate):
+    # csr BlockSparseIndex instead of the dense block mask in fwd
+    def __init__(self, template_dir=TEMPLATE_DIR, **kargs):
+        super().__init__(template_dir, use_block_index=True, **kargs)
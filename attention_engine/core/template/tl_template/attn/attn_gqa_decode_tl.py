@@ -5,6 +5,7 @@ from tilelang.autotuner import *
 import tilelang.language as T
 import itertools
 from tilelang.profiler import cached
+from autotuner.tune_strategy import tl_autotune
 
 # TL_GLOBAL_FUNC = """
 def fast_tanh(A, B):
@@ -34,7 +35,7 @@ def get_configs():
     return configs
 
 
-def kernel(batch, heads, groups, seqlen_kv, dim, dimv, tune=False):
+def kernel(batch, heads, groups, seqlen_kv, dim, dimv, tune=False, strategy=""):
     scale = (1.0 / dim)**0.5 * 1.44269504  # log2(e)
     shape_q = [batch, 1, heads, dim]
     shape_k = [batch, seqlen_kv, groups, dim]
@@ -296,6 +297,8 @@ def kernel(batch, heads, groups, seqlen_kv, dim, dimv, tune=False):
             return main_no_split
 
     if tune:
+        if strategy:
+            return tl_autotune(kernel_func, get_configs(), [6], strategy)
 
         @autotune(
             configs=get_configs(),
@@ -12,6 +12,15 @@ from functools import partial
 
 import operator
 
+from autotuner.arch import device_arch, VirtualArch
+from autotuner.decider import memory_usage, fits_memory
+from autotuner.cost_model import AttnProblem, prune_configs
+from autotuner.tune_db import tune_db, lookup_or_tune, joint_tune, current_arch, source_hash
+from autotuner.tune_strategy import tl_autotune
+
+# configs of the cost model that are compiled&measured
+TUNE_TOP_K = 16
+
 # TL_GLOBAL_FUNC = """
 def fast_tanh(A, B):
     return T.call_extern("handle", "fasttanh", T.address_of(A), T.address_of(B))
@@ -22,13 +31,31 @@ def make_dq_layout(dQ):
         dQ.shape, lambda b, l, h, d: [b, l // 8, h, d // 8, (d % 2), 4 * (l % 8) + (d % 8) // 2]
     )
 
-def get_configs():
+def get_tune_device():
+    # the device the engine lowered for, decider chose the default tile for it
+    if TUNE_DEVICE is not None:
+        return VirtualArch(TUNE_DEVICE)
+    return device_arch(torch.cuda.current_device())
+
+def get_configs(batch, heads, seq_len, dim, dimv, dtype, is_casual,
+                num_score_fragments={{num_score_fragments}}, arch=None, top_k=TUNE_TOP_K):
+    """
+    num_score_fragments: peak live [block_M, block_N] fragments from liveness analysis
+    arch: the tuned device, the current cuda device by default
+    """
+    arch = arch or get_tune_device()
     block_M = [64, 128, 256]
     block_N = [32, 64, 128, 256]
     num_stages = [1, 2]
     thread_num = [128, 256]
     shared_fuse = [{{shared_fuse}},]# [True, False]
     _configs = list(itertools.product(block_M, block_N, num_stages, thread_num, shared_fuse))
+    # prune configs that spill registers or exceed shared memory, the model of decider
+    _configs_fit = [c for c in _configs
+                    if fits_memory(*memory_usage(c[0], c[1], dim, dimv, [1, int(c[4])], [1, 0], c[3], c[2],
+                                                 getattr(torch, dtype), num_score_fragments), c[3], arch)]
+    if len(_configs_fit) > 0:
+        _configs = _configs_fit
     
     configs = [{
         'block_M': c[0],
@@ -37,7 +64,9 @@ def get_configs():
         'thread_num': c[3],
         'shared_fuse': c[4]
     } for c in _configs]
-    return configs
+    problem = AttnProblem(batch, heads, seq_len, seq_len, dim, dimv, getattr(torch, dtype), is_casual,
+                          num_score_fragments)
+    return prune_configs(configs, problem, arch, top_k)
         
 # TL_KERNEL = """
 def kernel(batch, heads, seq_len, dim, dimv, tune=False):
@@ -102,11 +131,12 @@ def kernel(batch, heads, seq_len, dim, dimv, tune=False):
                 {{online_rowscales_initvalue | indent(16)}}
 
                 # TODO: mask
+                loop_st = {{kv_loop_start}}
                 loop_range = (
-                    T.ceildiv((bx + 1) * block_M, block_N) if is_casual else T.ceildiv(seq_len, block_N)
+                    {{kv_loop_end}}
                 )
 
-                for k in T.Pipelined(loop_range, num_stages=num_stages):
+                for k in T.Pipelined(loop_st, loop_range, num_stages=num_stages):
                     T.copy(K[bz, k * block_N : (k + 1) * block_N, by, :], K_shared)
 
                     # TODO: copy custom_fwd_input_tensor in score_mod&online_func
@@ -166,8 +196,11 @@ def kernel(batch, heads, seq_len, dim, dimv, tune=False):
         return main
     
     if tune:
+        if TUNE_STRATEGY:
+            return tl_autotune(kernel_func, get_configs(batch, heads, seq_len, dim, dimv, dtype, is_casual),
+                               {{output_idx_list}}, TUNE_STRATEGY)
         @autotune(
-            configs=get_configs(),
+            configs=get_configs(batch, heads, seq_len, dim, dimv, dtype, is_casual),
             warmup=10,
             rep=10,
         )
@@ -407,6 +440,8 @@ def flashattn_bwd(batch, heads, seq_len, dim, dimv, tune=False):
         return flash_bwd     
     
     if tune:
+        if TUNE_STRATEGY:
+            return tl_autotune(kernel_func, get_bwd_configs(), {{bwd_output_idx_list}}, TUNE_STRATEGY)
         @autotune(
             configs=get_bwd_configs(),
             warmup=10,
@@ -453,6 +488,12 @@ TUNE = {{TUNE}}
 TUNE_FILE = "{{TUNE_FILE}}"
 TUNE_BWD = {{TUNE_BWD}}
 TUNE_FILE_BWD = "{{TUNE_FILE_BWD}}"
+TUNE_TRANSFER = "{{TUNE_TRANSFER}}"
+TUNE_STRATEGY = "{{TUNE_STRATEGY}}"
+TUNE_JOINT = {{TUNE_JOINT}}
+TUNE_ARCH = current_arch()
+TUNE_DEVICE = {{TUNE_DEVICE}}
+CODE_HASH = source_hash(__file__)
 
 def get_problem_keys():
     return {
@@ -463,39 +504,54 @@ def get_problem_keys():
         "dimv": {{DIMV}},
     }
     
-def tune(tune_file, kernel_profiler, problem_keys)->Tuple:
-    tuned_config = None
-    pk = problem_keys
-    if not os.path.exists(tune_file):
-        with open(tune_file, "w") as f:
-            json.dump([], f, indent=4)
-        configs = []
-    else:
-        with open(tune_file, "r") as f:
-            configs = json.load(f)
-        # find the config with the same problem size
-        for config in configs:
-            if all(config[k] == v for k, v in pk.items()):
-                tuned_config = config['tuned_config']
-                break
-    if tuned_config is None:
-        result = kernel_profiler(
-            **problem_keys
-        )
-        tuned_config = result.config
-        with open(tune_file, "w") as f:
-            configs.append({
-                **pk,
-                'tuned_config': tuned_config
-            })
-            json.dump(configs, f, indent=4)
-    return tuned_config
+def tune_record(tune_file, kind, kernel_profiler, problem_keys, tune=True):
+    """
+    tuned record of problem_keys, with TUNE_TRANSFER the record of the nearest tuned problems,
+    None if it is neither tuned nor tune
+    """
+    def tune_fn():
+        result = kernel_profiler(**problem_keys)
+        if result is None:
+            return None, -1
+        return result.config, result.latency
+    return lookup_or_tune(tune_db(tune_file), kind, problem_keys, tune_fn,
+                          TUNE_ARCH, "{{tl_dtype}}", CODE_HASH, tune, TUNE_TRANSFER)
+
+def tune(tune_file, kind, kernel_profiler, problem_keys, tune=True):
+    record = tune_record(tune_file, kind, kernel_profiler, problem_keys, tune)
+    return None if record is None else record.config
+
+def autotune_attn_step(file_path, do_tune=True):
+    """
+    forward and backward configs tuned for the fwd+bwd step latency, (None, None) if it failed
+    or is neither tuned nor do_tune. forward saves per row rowscales, no tile size is shared
+    """
+    pk = get_problem_keys()
+
+    def tune_kernels(shared):
+        kernels = {}
+        for kind, kernel_profiler in [("attn_fwd", partial(kernel, tune=True)),
+                                      ("attn_bwd", partial(flashattn_bwd, tune=True))]:
+            record = tune_record(file_path, kind, kernel_profiler, pk, do_tune)
+            kernels[kind] = (None, -1) if record is None else (record.config, record.latency)
+        return kernels
+
+    record = joint_tune(tune_db(file_path), "attn_step", pk, {}, tune_kernels, None,
+                        TUNE_ARCH, "{{tl_dtype}}", CODE_HASH, do_tune, TUNE_TRANSFER)
+    if record is None or record.config is None:
+        return None, None
+    return record.config["configs"]["attn_fwd"], record.config["configs"]["attn_bwd"]
     
 # forward
 tuned_config = None
-if TUNE:
+_tuned_config = None
+_tuned_bwd_config = None
+if TUNE_JOINT and (TUNE or TUNE_BWD or TUNE_TRANSFER):
+    _tuned_config, _tuned_bwd_config = autotune_attn_step(TUNE_FILE or TUNE_FILE_BWD, TUNE or TUNE_BWD)
+if _tuned_config is None and (TUNE or (TUNE_TRANSFER and TUNE_FILE)):
     pk = get_problem_keys()
-    _tuned_config = tune(TUNE_FILE, partial(kernel, tune=True), pk)
+    _tuned_config = tune(TUNE_FILE, "attn_fwd", partial(kernel, tune=True), pk, TUNE)
+if _tuned_config is not None:
     tuned_config = {
         'block_M': _tuned_config[0],
         'block_N': _tuned_config[1],
@@ -531,9 +587,10 @@ mod_post = tl.compile(
 )
 
 tuned_bwd_config = None
-if TUNE_BWD:
+if _tuned_bwd_config is None and (TUNE_BWD or (TUNE_TRANSFER and TUNE_FILE_BWD)):
     pk = get_problem_keys()
-    _tuned_bwd_config = tune(TUNE_FILE_BWD, partial(flashattn_bwd, tune=True), pk)
+    _tuned_bwd_config = tune(TUNE_FILE_BWD, "attn_bwd", partial(flashattn_bwd, tune=True), pk, TUNE_BWD)
+if _tuned_bwd_config is not None:
     tuned_bwd_config = {
         'block_M': _tuned_bwd_config[0],
         'block_N': _tuned_bwd_config[1],
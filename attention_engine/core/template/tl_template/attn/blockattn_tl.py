@@ -25,7 +25,16 @@ def kernel(batch, heads, seq_len, dim, dimv,
     shape_v = [batch, seq_len, heads, dimv]
     # TODO: seqlenkv
     seq_len_kv = seq_len
-    block_mask_shape = [batch, heads, downsample_len, downsample_len]
+{% if use_block_index %}
+    # csr block index of downsample_len kv blocks per row,
+    # [1, 1, ...] if mask_mod does not depend on batch/head
+    num_q_blocks = T.ceildiv(seq_len, block_M)
+    kv_num_blocks_shape = [{{mask_batch}}, {{mask_heads}}, num_q_blocks]
+    kv_indices_shape = [{{mask_batch}}, {{mask_heads}}, num_q_blocks, downsample_len]
+{% else %}
+    # [1, 1, ...] if mask_mod does not depend on batch/head
+    block_mask_shape = [{{mask_batch}}, {{mask_heads}}, downsample_len, downsample_len]
+{% endif %}
     dtype = "{{tl_dtype}}" # "float16"
     accum_dtype = "float"
     block_mask_dtype = "int8"
@@ -33,7 +42,9 @@ def kernel(batch, heads, seq_len, dim, dimv,
     # TODO: mask
     is_casual = {{is_casual}} # True
     # shared_fuse = True
+{% if not use_block_index %}
     assert(downsample_len == seq_len_kv // block_N)
+{% endif %}
 
 # TL_MAIN = """
     @T.macro
@@ -50,7 +61,13 @@ def kernel(batch, heads, seq_len, dim, dimv,
         V: T.Buffer(shape_v, dtype), # type: ignore
         {{custom_fwd_inputs | indent(8)}}
 
+{% if use_block_index %}
+        KVNumBlocks: T.Buffer(kv_num_blocks_shape, "int32"), # type: ignore
+        KVIndices: T.Buffer(kv_indices_shape, "int32"), # type: ignore
+        KVKinds: T.Buffer(kv_indices_shape, block_mask_dtype), # type: ignore
+{% else %}
         BlockSparseMask: T.Buffer(block_mask_shape, block_mask_dtype), # type: ignore
+{% endif %}
         Output: T.Buffer(shape_v, dtype), # type: ignore
         {{final_rowscales_output | indent(8)}}
     ):
@@ -68,7 +85,11 @@ def kernel(batch, heads, seq_len, dim, dimv,
 
             {{custom_fwd_inputs_init | indent(12)}}
             
+{% if use_block_index %}
+            num_kv_blocks = T.alloc_local([1], "int32")
+{% else %}
             block_mask = T.alloc_local([downsample_len], block_mask_dtype)
+{% endif %}
 
             T.annotate_layout({
                 Q_shared: tl.layout.make_swizzled_layout(Q_shared),
@@ -82,8 +103,16 @@ def kernel(batch, heads, seq_len, dim, dimv,
 
             {{online_rowscales_initvalue | indent(12)}}
 
+{% if use_block_index %}
+            num_kv_blocks[0] = KVNumBlocks[{{mask_batch_idx}}, {{mask_head_idx}}, bx]
+
+            # only the listed kv blocks, entries after num_kv_blocks are padding
+            for kk in T.Pipelined(downsample_len, num_stages=num_stages):
+                if kk < num_kv_blocks[0]:
+                    k = KVIndices[{{mask_batch_idx}}, {{mask_head_idx}}, bx, kk]
+{% else %}
             for vj in T.serial(downsample_len):
-                block_mask[vj] = BlockSparseMask[bz, by, bx, vj]
+                block_mask[vj] = BlockSparseMask[{{mask_batch_idx}}, {{mask_head_idx}}, bx, vj]
 
             # TODO: mask
             loop_range = (
@@ -92,6 +121,7 @@ def kernel(batch, heads, seq_len, dim, dimv,
 
             for k in T.Pipelined(loop_range, num_stages=num_stages):
                 if block_mask[k] != 0:
+{% endif %}
                     T.copy(K[bz, k * block_N : (k + 1) * block_N, by, :], K_shared)
 
                     # TODO: copy custom_fwd_input_tensor in score_mod&online_func
@@ -99,15 +129,23 @@ def kernel(batch, heads, seq_len, dim, dimv,
 
                     # TODO: naive solution: if reduce_max, -T.inf; if reduce_sum, 0
                     if (is_casual or {{is_mask_mod_code}}) and {{is_inf_mask}}:
-                        for i, j in T.Parallel(block_M, block_N):
-                            {{q_idx}} = bx * block_M + i
-                            {{kv_idx}} = k * block_N + j
-                            {{batch_idx}} = bz
-                            {{head_idx}} = by
-                            {{mask_mod_code | indent(28)}}
-                            scores[i, j] = T.if_then_else(
-                                {{mask_output}}, 0, -T.infinity(scores.dtype)
-                            )
+                        # block_mask: 1 partial, 2 full, full blocks need no elementwise mask
+{% if use_block_index %}
+                        if KVKinds[{{mask_batch_idx}}, {{mask_head_idx}}, bx, kk] == 1:
+{% else %}
+                        if block_mask[k] == 1:
+{% endif %}
+                            for i, j in T.Parallel(block_M, block_N):
+                                {{q_idx}} = bx * block_M + i
+                                {{kv_idx}} = k * block_N + j
+                                {{batch_idx}} = bz
+                                {{head_idx}} = by
+                                {{mask_mod_code | indent(32)}}
+                                scores[i, j] = T.if_then_else(
+                                    {{mask_output}}, 0, -T.infinity(scores.dtype)
+                                )
+                        else:
+                            T.clear(scores)
                     else:
                         T.clear(scores)
                     
@@ -181,13 +219,17 @@ def flashattn_bwd_preprocess(batch, heads, seq_len, dim, dimv):
 
 # TL_KERNEL_BWD = """
 def flashattn_bwd(batch, heads, seq_len, dim, dimv, is_casual, 
-                block_M, block_N, thread_num = 128*2):
+                block_M, block_N, max_q_blocks, thread_num = 128*2):
     sm_scale = (1.0 / dim) ** 0.5
     scale = (1.0 / dim) ** 0.5 * 1.44269504  # log2(e)
     shape = [batch, seq_len, heads, dim]
     shape_v = [batch, seq_len, heads, dimv]
     # TODO: seqlenkv
     seq_len_kv = seq_len
+    # transposed csr block index, the nonzero q blocks of every kv block
+    num_kv_blocks = T.ceildiv(seq_len_kv, block_M)
+    q_num_blocks_shape = [{{mask_batch}}, {{mask_heads}}, num_kv_blocks]
+    q_indices_shape = [{{mask_batch}}, {{mask_heads}}, num_kv_blocks, max_q_blocks]
     dtype = "{{tl_dtype}}" # "float16"
     accum_dtype = "float"
 
@@ -224,6 +266,9 @@ def flashattn_bwd(batch, heads, seq_len, dim, dimv, is_casual,
         # custom_bwd_inputs
         {{custom_bwd_inputs | indent(8)}}
 
+        QNumBlocks: T.Buffer(q_num_blocks_shape, "int32"), # type: ignore
+        QIndices: T.Buffer(q_indices_shape, "int32"), # type: ignore
+        QKinds: T.Buffer(q_indices_shape, "int8"), # type: ignore
         dQ: T.Buffer(shape, accum_dtype), # type: ignore
         dK: T.Buffer(shape, dtype), # type: ignore
         dV: T.Buffer(shape_v, dtype), # type: ignore
@@ -260,6 +305,7 @@ def flashattn_bwd(batch, heads, seq_len, dim, dimv, is_casual,
             dq = T.alloc_fragment([block_N, dim], accum_dtype)
             dv_shared = T.alloc_shared([block_N, dimv], dtype)
             dk_shared = T.alloc_shared([block_N, dim], dtype)
+            num_q_blocks = T.alloc_local([1], "int32")
             T.annotate_layout(
                 {
                     dQ: make_dq_layout(dQ),
@@ -277,78 +323,79 @@ def flashattn_bwd(batch, heads, seq_len, dim, dimv, is_casual,
             T.clear(dv)
             T.clear(dk)
 
-            # TODO: is causal
-            loop_st = T.floordiv(by * block_M, block_N) if is_casual else 0
-            loop_ed = T.ceildiv(seq_len, block_N)
-
-            for k in T.Pipelined(loop_st, loop_ed, num_stages=2):
-                T.copy(Q[bz, k * block_N : (k + 1) * block_N, bx, :], q)
-                {{custom_fwd_inputs_load_shared_bwd | indent(16)}}
-                T.clear(qkT)
-                T.gemm(K_shared, q, qkT, transpose_B=True, policy=T.GemmWarpPolicy.FullRow)
+            # only the listed q blocks, dq/dk/dv work scales with the mask density
+            num_q_blocks[0] = QNumBlocks[{{mask_batch_idx}}, {{mask_head_idx_bwd}}, by]
+            for kk in T.Pipelined(max_q_blocks, num_stages=2):
+                if kk < num_q_blocks[0]:
+                    k = QIndices[{{mask_batch_idx}}, {{mask_head_idx_bwd}}, by, kk]
+                    T.copy(Q[bz, k * block_N : (k + 1) * block_N, bx, :], q)
+                    {{custom_fwd_inputs_load_shared_bwd | indent(20)}}
+                    T.clear(qkT)
+                    T.gemm(K_shared, q, qkT, transpose_B=True, policy=T.GemmWarpPolicy.FullRow)
                 
-                # score_mod
-                score_mod({{score_mod_inputs_bwd_list}}) # qkT,
+                    # score_mod
+                    score_mod({{score_mod_inputs_bwd_list}}) # qkT,
 
-                # final_rowscales_load
-                {{final_rowscales_load | indent(16)}}
+                    # final_rowscales_load
+                    {{final_rowscales_load | indent(20)}}
 
-                # online_func_fwd
-                {{ online_func_fwd | indent(16) }}
+                    # online_func_fwd
+                    {{ online_func_fwd | indent(20) }}
                 
-                # TODO: is causal
-                if is_casual or {{is_mask_mod_code}}:
-                    for i, j in T.Parallel(block_M, block_N):
-                        {{q_idx}} = k * block_N + j
-                        {{kv_idx}} =  by * block_M + i
-                        {{batch_idx}} = bz
-                        {{head_idx}} = bx
-                        {{mask_mod_code | indent(24)}}
-                        {{score_mod_output_var}}[i, j] = T.if_then_else(
-                            {{mask_output}}, {{score_mod_output_var}}[i, j], 0
-                        )
+                    # 1 partial, 2 full, full blocks need no elementwise mask
+                    if (is_casual or {{is_mask_mod_code}}) and QKinds[{{mask_batch_idx}}, {{mask_head_idx_bwd}}, by, kk] == 1:
+                        for i, j in T.Parallel(block_M, block_N):
+                            {{q_idx}} = k * block_N + j
+                            {{kv_idx}} =  by * block_M + i
+                            {{batch_idx}} = bz
+                            {{head_idx}} = bx
+                            {{mask_mod_code | indent(28)}}
+                            {{score_mod_output_var}}[i, j] = T.if_then_else(
+                                {{mask_output}}, {{score_mod_output_var}}[i, j], 0
+                            )
                 
-                T.copy(dO[bz, k * block_N : (k + 1) * block_N, bx, :], do)
-                T.clear(dsT)
-                T.gemm(V_shared, do, dsT, transpose_B=True, policy=T.GemmWarpPolicy.FullRow)
+                    T.copy(dO[bz, k * block_N : (k + 1) * block_N, bx, :], do)
+                    T.clear(dsT)
+                    T.gemm(V_shared, do, dsT, transpose_B=True, policy=T.GemmWarpPolicy.FullRow)
                 
-                T.copy({{score_mod_output_var}}, qkT_cast)
-                T.gemm(qkT_cast, do, dv, policy=T.GemmWarpPolicy.FullRow)
-
-                # custom_bwd_inputs_load
-                {{custom_bwd_inputs_load | indent(16)}}
-
-                # T.clear(dsT)
-                # T.gemm(V_local, do, dsT, transpose_B=True, policy=T.GemmWarpPolicy.FullRow)
-
-                if is_casual or {{is_mask_mod_code}}:
-                    for i, j in T.Parallel(block_M, block_N):
-                        {{q_idx}} = k * block_N + j
-                        {{kv_idx}} =  by * block_M + i
-                        {{batch_idx}} = bz
-                        {{head_idx}} = bx
-                        {{mask_mod_code | indent(24)}}
-                        dsT[i, j] = T.if_then_else(
-                            {{mask_output}}, dsT[i, j], 0
-                        )
-
-                # custom_bwd
-                {{custom_bwd_body | indent(16)}}
+                    T.copy({{score_mod_output_var}}, qkT_cast)
+                    T.gemm(qkT_cast, do, dv, policy=T.GemmWarpPolicy.FullRow)
+
+                    # custom_bwd_inputs_load
+                    {{custom_bwd_inputs_load | indent(20)}}
+
+                    # T.clear(dsT)
+                    # T.gemm(V_local, do, dsT, transpose_B=True, policy=T.GemmWarpPolicy.FullRow)
+
+                    # 1 partial, 2 full, full blocks need no elementwise mask
+                    if (is_casual or {{is_mask_mod_code}}) and QKinds[{{mask_batch_idx}}, {{mask_head_idx_bwd}}, by, kk] == 1:
+                        for i, j in T.Parallel(block_M, block_N):
+                            {{q_idx}} = k * block_N + j
+                            {{kv_idx}} =  by * block_M + i
+                            {{batch_idx}} = bz
+                            {{head_idx}} = bx
+                            {{mask_mod_code | indent(28)}}
+                            dsT[i, j] = T.if_then_else(
+                                {{mask_output}}, dsT[i, j], 0
+                            )
+
+                    # custom_bwd
+                    {{custom_bwd_body | indent(20)}}
                 
-                # score_mod_backward
-                score_mod_backward({{score_mod_bwd_inputs_list}}) #  qkT, 
+                    # score_mod_backward
+                    score_mod_backward({{score_mod_bwd_inputs_list}}) #  qkT, 
                   
                                 
-                T.copy(dsT, dsT_cast)
-                T.gemm(dsT_cast, q, dk, policy=T.GemmWarpPolicy.FullRow)
-
-                T.copy(dsT_cast, dsT_shared)
-                T.clear(dq)
-                # T.gemm(dsT_shared, K_local_T, dq, transpose_A=True)
-                T.gemm(dsT_shared, K_shared, dq, transpose_A=True, policy=T.GemmWarpPolicy.FullCol)
-                for i, j in T.Parallel(block_N, dim):
-                    if k * block_N + i < seq_len:
-                        T.atomic_add(dQ[bz, k * block_N + i, bx, j], dq[i, j])
+                    T.copy(dsT, dsT_cast)
+                    T.gemm(dsT_cast, q, dk, policy=T.GemmWarpPolicy.FullRow)
+
+                    T.copy(dsT_cast, dsT_shared)
+                    T.clear(dq)
+                    # T.gemm(dsT_shared, K_local_T, dq, transpose_A=True)
+                    T.gemm(dsT_shared, K_shared, dq, transpose_A=True, policy=T.GemmWarpPolicy.FullCol)
+                    for i, j in T.Parallel(block_N, dim):
+                        if k * block_N + i < seq_len:
+                            T.atomic_add(dQ[bz, k * block_N + i, bx, j], dq[i, j])
             T.copy(dv, dV[bz, by * block_M : (by + 1) * block_M, bx, :])
             T.copy(dk, dK[bz, by * block_M : (by + 1) * block_M, bx, :])
 
@@ -380,25 +427,42 @@ def flashattn_bwd_postprocess(batch, heads, seq_len, dim, dimv):
 class _attention(torch.autograd.Function):
     @staticmethod
     def forward(ctx, q, k, v, *custom_fwd_inputs):
-        custom_fwd_inputs, block_sparse_mask = custom_fwd_inputs[:-1], custom_fwd_inputs[-1]
+{% if use_block_index %}
+        # last inputs are the BlockSparseIndex of fwd and the transposed one of bwd
+        custom_fwd_inputs, block_idx, block_idx_bwd = custom_fwd_inputs[:-2], custom_fwd_inputs[-2], custom_fwd_inputs[-1]
+        block_sparse_mask = (block_idx.kv_num_blocks, block_idx.kv_indices, block_idx.kv_kinds)
+{% else %}
+        # last inputs are the block mask of fwd and the transposed BlockSparseIndex of bwd
+        custom_fwd_inputs, block_sparse_mask, block_idx_bwd = custom_fwd_inputs[:-2], custom_fwd_inputs[-2], custom_fwd_inputs[-1]
+        block_sparse_mask = (block_sparse_mask,)
+{% endif %}
         BATCH, N_CTX, H, D_HEAD = q.shape
         D_HEADV = v.shape[-1]
         block_M = {{block_M}} # 128
         block_N = {{block_N}} # 128 if D_HEAD <= 128 else 64
+{% if use_block_index %}
+        # static width of the index, KVNumBlocks bounds the loop
+        downsample_len = (N_CTX + block_N - 1) // block_N
+{% else %}
         downsample_len = N_CTX // block_N
+{% endif %}
         # stages = 0 for tilelang blocksparse
         stages = 0 # {{stages}} # 2
         thread_num = {{thread_num}} # 256
         shared_fuse = {{shared_fuse}} # False
         output_idx_list = {{output_idx_list}}
-        program = kernel(BATCH, H, N_CTX, D_HEAD, D_HEADV, downsample_len, block_M, block_N, stages, thread_num, shared_fuse)
-        mod = tl.compile(program, out_idx=output_idx_list)
+        # compiled once per shape, the block mask is a runtime input
+        mod = tl.profiler.cached(
+            kernel, output_idx_list, BATCH, H, N_CTX, D_HEAD, D_HEADV, downsample_len, block_M, block_N, stages, thread_num, shared_fuse
+        )
         if len(output_idx_list) == 1:
-            o = mod(q, k, v, *custom_fwd_inputs, block_sparse_mask)
+            o = mod(q, k, v, *custom_fwd_inputs, *block_sparse_mask)
             final_scale = []
         else:
-            o, *final_scale = mod(q, k, v, *custom_fwd_inputs, block_sparse_mask)
+            o, *final_scale = mod(q, k, v, *custom_fwd_inputs, *block_sparse_mask)
         ctx.save_for_backward(q, k, v, o, *custom_fwd_inputs, *final_scale)
+        ctx.block_idx_bwd = block_idx_bwd
+        ctx.num_custom_fwd_inputs = len(custom_fwd_inputs)
         return o
     
     @staticmethod
@@ -420,15 +484,20 @@ class _attention(torch.autograd.Function):
         # TODO: causal
         is_casual = {{is_casual}}
         output_idx_list = {{bwd_output_idx_list}}
+        block_idx_bwd = ctx.block_idx_bwd
+        # static width of the index, QNumBlocks bounds the loop
+        max_q_blocks = (N_CTX + block_N - 1) // block_N
+        block_idx_bwd_tensors = (block_idx_bwd.kv_num_blocks, block_idx_bwd.kv_indices, block_idx_bwd.kv_kinds)
         mod = tl.profiler.cached(
-            flashattn_bwd, output_idx_list, BATCH, H, N_CTX, D_HEAD, D_HEAD_V, is_casual, block_M, block_N, thread_num
+            flashattn_bwd, output_idx_list, BATCH, H, N_CTX, D_HEAD, D_HEAD_V, is_casual, block_M, block_N, max_q_blocks, thread_num
         )
         if {{isused_doosum}}:
-            dq, dk, dv = mod(q, k, v, do, *tmp, delta)
+            dq, dk, dv = mod(q, k, v, do, *tmp, delta, *block_idx_bwd_tensors)
         else:
-            dq, dk, dv = mod(q, k, v, do, *tmp)
+            dq, dk, dv = mod(q, k, v, do, *tmp, *block_idx_bwd_tensors)
         dq = mod_post(dq)
-        none_list = [None] * len(tmp)
+        # custom_fwd_inputs, the block mask of fwd and block_idx_bwd
+        none_list = [None] * (ctx.num_custom_fwd_inputs + 2)
         return dq, dk, dv, *none_list
 
 attention = _attention.apply
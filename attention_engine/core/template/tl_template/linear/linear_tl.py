@@ -13,13 +13,12 @@ import json
 from typing import Tuple
 from functools import partial
 
-from autotuner.arch import AttnDevice, H100
+from autotuner.arch import H100, device_arch
+from autotuner.tune_db import tune_db, lookup_or_tune, joint_tune, current_arch, source_hash
+from autotuner.tune_strategy import tl_autotune
 current_device = torch.cuda.current_device()
-device_cap = torch.cuda.get_device_capability(current_device)
-try:
-    attn_device = AttnDevice[device_cap]()
-except KeyError:
-    attn_device = H100()
+# unknown devices: queried from the device, with a warning
+attn_device = device_arch(current_device)
 
 # ---------------------TRITON_KERNEL_CUMSUM
 @triton.jit
@@ -216,6 +215,8 @@ def chunk_fwd_h(
         configs = generate_config_h(batch,headq,headk,head,seqlen,dim,dimv,BT, device=attn_device)
         if len(configs) == 0:
             return None
+        if TUNE_STRATEGY:
+            return tl_autotune(kernel_func, configs, {{output_idx_list_h}}, TUNE_STRATEGY)
         @autotune(
             configs=configs,
             warmup=10,
@@ -391,6 +392,8 @@ def chunk_o(
         configs = generate_config_o(batch,headq,headk,head,seqlen,dim,dimv,BT, device=attn_device)
         if len(configs) == 0:
             return None
+        if TUNE_STRATEGY:
+            return tl_autotune(kernel_func, configs, {{output_idx_list_o}}, TUNE_STRATEGY)
         @autotune(
             configs=configs,
             warmup=10,
@@ -526,6 +529,8 @@ def chunk_bwd_kernel_dh(
         configs = generate_config_dh(batch,headq,headk,head,seqlen,dim,dimv,BT, device=attn_device)
         if len(configs) == 0:
             return None
+        if TUNE_STRATEGY:
+            return tl_autotune(kernel_func, configs, [5,], TUNE_STRATEGY)
         @autotune(
             configs=configs,
             warmup=10,
@@ -769,6 +774,8 @@ def chunk_bwd_dqkg(
         configs = generate_config_dqkg(batch,headq,headk,head,seqlen,dim,dimv,BT, device=attn_device)
         if len(configs) == 0:
             return None
+        if TUNE_STRATEGY:
+            return tl_autotune(kernel_func, configs, [7,8,9,], TUNE_STRATEGY)
         @autotune(
             configs=configs,
             warmup=10,
@@ -911,6 +918,8 @@ def chunk_bwd_kernel_dv(
         configs = generate_config_dv(batch,headq,headk,head,seqlen,dim,dimv,BT, device=attn_device)
         if len(configs) == 0:
             return None
+        if TUNE_STRATEGY:
+            return tl_autotune(kernel_func, configs, [5,], TUNE_STRATEGY)
         @autotune(
             configs=configs,
             warmup=10,
@@ -933,40 +942,28 @@ TUNE = {{TUNE}}
 TUNE_FILE = "{{TUNE_FILE}}"
 TUNE_BWD = {{TUNE_BWD}}
 TUNE_FILE_BWD = "{{TUNE_FILE_BWD}}"
+TUNE_TRANSFER = "{{TUNE_TRANSFER}}"
+TUNE_STRATEGY = "{{TUNE_STRATEGY}}"
+TUNE_JOINT = {{TUNE_JOINT}}
+TUNE_ARCH = current_arch()
+CODE_HASH = source_hash(__file__)
 
     
-def tune(tune_file, kernel_profiler, problem_keys)->Tuple:
-    tuned_config = None
-    tuned_latency = -1
-    pk = problem_keys
-    if not os.path.exists(tune_file):
-        with open(tune_file, "w") as f:
-            json.dump([], f, indent=4)
-        configs = []
-    else:
-        with open(tune_file, "r") as f:
-            configs = json.load(f)
-        # find the config with the same problem size
-        for config in configs:
-            if all(config[k] == v for k, v in pk.items()):
-                tuned_config = config['tuned_config']
-                tuned_latency = config['tuned_latency']
-                return tuned_config, tuned_latency
-    if tuned_config is None:
-        result = kernel_profiler(
-            **problem_keys
-        )
-        if result is not None:
-            tuned_config = result.config
-            tuned_latency = result.latency
-        with open(tune_file, "w") as f:
-            configs.append({
-                **pk,
-                'tuned_config': tuned_config,
-                'tuned_latency': tuned_latency
-            })
-            json.dump(configs, f, indent=4)
-    return tuned_config, tuned_latency
+def tune(tune_file, kind, kernel_profiler, problem_keys, tune=True)->Tuple:
+    """
+    (config, latency) of problem_keys, with TUNE_TRANSFER of the nearest tuned problems,
+    (None, -1) if it failed or is neither tuned nor tune
+    """
+    def tune_fn():
+        result = kernel_profiler(**problem_keys)
+        if result is None:
+            return None, -1
+        return result.config, result.latency
+    record = lookup_or_tune(tune_db(tune_file), kind, problem_keys, tune_fn,
+                            TUNE_ARCH, "bfloat16", CODE_HASH, tune, TUNE_TRANSFER)
+    if record is None:
+        return None, -1
+    return record.config, record.latency
     
 def get_problem_keys_ho(BT):
     return {
@@ -980,7 +977,7 @@ def get_problem_keys_ho(BT):
         "BT": BT,
     }
     
-def autotune_linearattn(file_path="mamba2"):
+def autotune_linearattn(file_path="mamba2", do_tune=True):
             
     BTs = [32,64,128,192,256]
  
@@ -988,8 +985,8 @@ def autotune_linearattn(file_path="mamba2"):
     best_latency = 1e6
     best_BT = None
     for BT in BTs:
-        config_h, latency_h = tune(f"{file_path}_h.json", partial(chunk_fwd_h, tune=True), get_problem_keys_ho(BT))
-        config_o, latency_o = tune(f"{file_path}_o.json", partial(chunk_o, tune=True), get_problem_keys_ho(BT))
+        config_h, latency_h = tune(file_path, "linear_h", partial(chunk_fwd_h, tune=True), get_problem_keys_ho(BT), do_tune)
+        config_o, latency_o = tune(file_path, "linear_o", partial(chunk_o, tune=True), get_problem_keys_ho(BT), do_tune)
         
         if latency_h == -1 or latency_o == -1:
             continue
@@ -1012,7 +1009,7 @@ def autotune_linearattn(file_path="mamba2"):
     return best_BT, best_config_h, best_config_o, best_latency
 
 
-def autotune_linearattn_bwd(file_path="mamba2"):
+def autotune_linearattn_bwd(file_path="mamba2", do_tune=True):
     
     BTs = [32,64,128,192]# ,256]
  
@@ -1020,10 +1017,10 @@ def autotune_linearattn_bwd(file_path="mamba2"):
     best_latency = 1e6
     best_BT = None
     for BT in BTs:
-        config_h, latency_h = tune(f"{file_path}_h.json", partial(chunk_fwd_h, tune=True), get_problem_keys_ho(BT))
-        config_dh, latency_dh = tune(f"{file_path}_dh.json", partial(chunk_bwd_kernel_dh, tune=True), get_problem_keys_ho(BT))
-        config_dqkg, latency_dqkg = tune(f"{file_path}_dqkg.json", partial(chunk_bwd_dqkg, tune=True), get_problem_keys_ho(BT))
-        config_dv, latency_dv = tune(f"{file_path}_dv.json", partial(chunk_bwd_kernel_dv, tune=True), get_problem_keys_ho(BT))
+        config_h, latency_h = tune(file_path, "linear_h", partial(chunk_fwd_h, tune=True), get_problem_keys_ho(BT), do_tune)
+        config_dh, latency_dh = tune(file_path, "linear_dh", partial(chunk_bwd_kernel_dh, tune=True), get_problem_keys_ho(BT), do_tune)
+        config_dqkg, latency_dqkg = tune(file_path, "linear_dqkg", partial(chunk_bwd_dqkg, tune=True), get_problem_keys_ho(BT), do_tune)
+        config_dv, latency_dv = tune(file_path, "linear_dv", partial(chunk_bwd_kernel_dv, tune=True), get_problem_keys_ho(BT), do_tune)
         
         if latency_h == -1 or latency_dh == -1 or latency_dqkg == -1 or latency_dv == -1:
             continue
@@ -1057,13 +1054,62 @@ def autotune_linearattn_bwd(file_path="mamba2"):
     
     return best_BT, best_config_h, best_config_dh, best_config_dqkg, best_config_dv, best_latency
 
+
+def to_config(config):
+    return {
+        "BK": config[0],
+        "BV": config[1],
+        "num_stages": config[2],
+        "num_threads": config[3],
+    }
+
+
+def autotune_linearattn_step(file_path="mamba2", do_tune=True):
+    """
+    BT shared by the forward and backward kernels, tuned for the fwd+bwd step
+    latency, h runs twice: in forward and recomputed in backward.
+    (BT, {kind: config}), (None, None) if it failed or is neither tuned nor do_tune
+    """
+    step_kernels = {
+        "linear_h": chunk_fwd_h,
+        "linear_o": chunk_o,
+        "linear_dh": chunk_bwd_kernel_dh,
+        "linear_dqkg": chunk_bwd_dqkg,
+        "linear_dv": chunk_bwd_kernel_dv,
+    }
+
+    def tune_kernels(shared):
+        problem_keys = get_problem_keys_ho(shared["BT"])
+        return {kind: tune(file_path, kind, partial(kernel, tune=True), problem_keys, do_tune)
+                for kind, kernel in step_kernels.items()}
+
+    problem_keys = get_problem_keys_ho(None)
+    del problem_keys["BT"]
+    # BTs both forward and backward support
+    record = joint_tune(tune_db(file_path), "linear_step", problem_keys, {"BT": [32,64,128,192]},
+                        tune_kernels, {"linear_h": 2}, TUNE_ARCH, "bfloat16", CODE_HASH, do_tune, TUNE_TRANSFER)
+    if record is None or record.config is None:
+        return None, None
+    return record.config["shared"]["BT"], {kind: to_config(config) for kind, config in record.config["configs"].items()}
+
    
 tuned_config_h = None
 tuned_config_o = None
 BT=None
-if TUNE:
-    BT, tuned_config_h, tuned_config_o, _ = autotune_linearattn(TUNE_FILE)
-else:
+BT_BWD=None
+if TUNE_JOINT and (TUNE or TUNE_BWD or TUNE_TRANSFER):
+    # one BT for forward and backward
+    BT, step_configs = autotune_linearattn_step(TUNE_FILE or TUNE_FILE_BWD, TUNE or TUNE_BWD)
+    if BT is not None:
+        BT_BWD = BT
+        tuned_config_h = tuned_config_h_2 = step_configs["linear_h"]
+        tuned_config_o = step_configs["linear_o"]
+        tuned_config_dh = step_configs["linear_dh"]
+        tuned_config_dqkg = step_configs["linear_dqkg"]
+        tuned_config_dv = step_configs["linear_dv"]
+if BT is None and (TUNE or (TUNE_TRANSFER and TUNE_FILE)):
+    BT, tuned_config_h, tuned_config_o, _ = autotune_linearattn(TUNE_FILE, TUNE)
+if BT is None:
     BT = {{BT}}
     tuned_config_h = {
         'BK': {{BK_h}},
@@ -1086,10 +1132,9 @@ output_idx_list = {{output_idx_list_o}}# [5,]
 chunk_fwd_o_mod = tl.compile(chunk_o(BATCH, HQ,HK, H, N_CTX, D_HEAD, D_HEADV, BT)(**tuned_config_o), output_idx_list, )
 
 # bwd
-BT_BWD=None
-if TUNE_BWD:
-    BT_BWD, tuned_config_h_2, tuned_config_dh, tuned_config_dqkg, tuned_config_dv,_ = autotune_linearattn_bwd(TUNE_FILE_BWD)
-else:
+if BT_BWD is None and (TUNE_BWD or (TUNE_TRANSFER and TUNE_FILE_BWD)):
+    BT_BWD, tuned_config_h_2, tuned_config_dh, tuned_config_dqkg, tuned_config_dv,_ = autotune_linearattn_bwd(TUNE_FILE_BWD, TUNE_BWD)
+if BT_BWD is None:
     BT_BWD = {{BT_BWD}}
     tuned_config_h_2 = {
         'BK': {{BK_h}},
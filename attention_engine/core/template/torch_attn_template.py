@@ -0,0 +1,35 @@
+import jinja2
+import os
+import os.path as osp
+
+TEMPLATE_DIR = osp.join(
+    osp.dirname(
+        osp.abspath(__file__)),
+    'torch_template/attn_torch.py')
+
+LINEAR_TEMPLATE_DIR = osp.join(
+    osp.dirname(
+        osp.abspath(__file__)),
+    'torch_template/linear_torch.py')
+
+
+class TorchAttnTemplate:
+    def __init__(self, template_dir=TEMPLATE_DIR,
+                 **kargs
+                 ):
+        with open(template_dir, 'r') as f:
+            TORCH_KERNEL = f.read()
+
+        template = jinja2.Template(TORCH_KERNEL)
+
+        # remove None
+        kargs = {k: (v if v is not None else "") for k, v in kargs.items()}
+        self.torchcode = template.render(**kargs)
+
+    def __call__(self):
+        return self.torchcode
+
+
+class TorchLinearAttnTemplate(TorchAttnTemplate):
+    def __init__(self, template_dir=LINEAR_TEMPLATE_DIR, **kargs):
+        super().__init__(template_dir, **kargs)
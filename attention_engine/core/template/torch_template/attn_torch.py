@@ -0,0 +1,277 @@
+# TORCH_IMPORT = """
+import torch
+import operator
+
+# blocked online attention in pytorch, tiled over kv like the tl kernel.
+# q,k,v: [batch, seq_len, heads, dim], computed in float32,
+# a tile is [batch, heads, block_M, block_N], no [seq_len, seq_len_kv] tensor is materialized.
+# with NUM_WORKERS > 0 the (batch, head, q tile) grid is split across a thread pool (cpu).
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_M = {{block_M}}
+BLOCK_N = {{block_N}}
+BLOCK_M_BWD = {{block_M_bwd}}
+BLOCK_N_BWD = {{block_N_bwd}}
+IS_MASK = {{is_mask_mod_code}}
+IS_INF_MASK = {{is_inf_mask}}
+# dim of [batch, heads, seq_len, seq_len_kv] for every dim of custom_fwd_inputs, None for size 1
+CUSTOM_INPUT_DIMS = {{custom_input_dims}}
+FINAL_ROWSCALES_LENGTH = {{final_rowscales_length}}
+# 0: one block covers all [batch, heads], the grid is only over q tiles and runs inline
+NUM_WORKERS = {{num_workers}}
+
+
+def _mask_mod({{batch_idx}}, {{head_idx}}, {{q_idx}}, {{kv_idx}}):
+    {{mask_mod_code | indent(4)}}
+    return {{mask_output}}
+
+
+def _view(x, dims):
+    # custom input -> [batch, heads, seq_len, seq_len_kv] with size 1 for missing dims
+    kept = [i for i, dim in enumerate(dims) if dim is not None]
+    shape = [1, 1, 1, 1]
+    for i in kept:
+        shape[dims[i]] = x.shape[i]
+    x = x.float().reshape([x.shape[i] for i in kept])
+    x = x.permute(sorted(range(len(kept)), key=lambda i: dims[kept[i]]))
+    return x.reshape(shape)
+
+
+def _tile(x, q0, q1, k0, k1):
+    q_slice = slice(q0, q1) if x.shape[2] > 1 else slice(None)
+    kv_slice = slice(k0, k1) if x.shape[3] > 1 else slice(None)
+    return x[:, :, q_slice, kv_slice]
+
+
+def _select(x, b0, b1, h0, h1):
+    # [batch, heads] block of a broadcastable custom input
+    x = x[b0:b1] if x.shape[0] > 1 else x
+    return x[:, h0:h1] if x.shape[1] > 1 else x
+
+
+def _grid(BATCH, H, N_CTX, block_size):
+    q_tiles = [(q0, min(q0 + block_size, N_CTX)) for q0 in range(0, N_CTX, block_size)]
+    if NUM_WORKERS == 0:
+        return [(0, BATCH, 0, H, q0, q1) for q0, q1 in q_tiles]
+    return [(b, b + 1, h, h + 1, q0, q1)
+            for b in range(BATCH) for h in range(H) for q0, q1 in q_tiles]
+
+
+def _run_grid(fn, grid):
+    if NUM_WORKERS <= 1:
+        for item in grid:
+            fn(*item)
+        return
+    # workers share the intra-op threads, no oversubscription of cores.
+    # the count is per thread for openmp, so set it in every worker as well
+    num_threads = torch.get_num_threads()
+    worker_threads = max(1, num_threads // NUM_WORKERS)
+    torch.set_num_threads(worker_threads)
+    try:
+        with ThreadPoolExecutor(NUM_WORKERS, initializer=torch.set_num_threads,
+                                initargs=(worker_threads,)) as pool:
+            # raise the first error of the workers
+            for _ in pool.map(lambda item: fn(*item), grid):
+                pass
+    finally:
+        torch.set_num_threads(num_threads)
+
+
+def _tile_mask(b, h, q_idx, kv_idx):
+    if not IS_MASK:
+        return None
+    return torch.as_tensor(_mask_mod(b, h, q_idx, kv_idx), device=q_idx.device)
+
+
+def _masked_rows(mask, rows):
+    # rows of a tile whose scores are all -inf, None if there are none
+    if mask is None or not IS_INF_MASK:
+        return None
+    masked = (~mask).all(dim=-1).expand(rows)
+    return masked if masked.any() else None
+
+
+def _keep_rows(masked, state, new_state):
+    # online state of masked rows is not updated, their exp(-inf - -inf) is nan
+    return tuple(torch.where(masked.view(masked.shape + (1,) * (x.dim() - masked.dim())), x_prev, x)
+                 for x_prev, x in zip(state, new_state))
+
+
+def attention_fwd(q, k, v, *custom_fwd_inputs):
+    BATCH, N_CTX, H, D_HEAD = q.shape
+    N_CTX_KV, H_KV, D_HEADV = k.shape[1], k.shape[2], v.shape[-1]
+    device = q.device
+    # queries are aligned to the end of kv
+    q_offset = N_CTX_KV - N_CTX
+    _q_all = q.transpose(1, 2).float().contiguous()
+    _k_all = k.transpose(1, 2).float().repeat_interleave(H // H_KV, dim=1)
+    _v_all = v.transpose(1, 2).float().repeat_interleave(H // H_KV, dim=1)
+    _custom_all = [_view(x, dims) for x, dims in zip(custom_fwd_inputs, CUSTOM_INPUT_DIMS)]
+    _o_all = torch.empty(BATCH, H, N_CTX, D_HEADV, dtype=torch.float, device=device)
+    _final_rowscales_all = [torch.empty(BATCH, H, N_CTX, dtype=torch.float, device=device)
+                            for _ in range(FINAL_ROWSCALES_LENGTH)]
+
+    def _fwd_block(_b0, _b1, _h0, _h1, _q0, _q1):
+        # q tile [_q0, _q1) of heads [_b0, _b1) x [_h0, _h1), outputs are written in place
+        _k = _k_all[_b0:_b1, _h0:_h1]
+        _v = _v_all[_b0:_b1, _h0:_h1]
+        _custom = [_select(x, _b0, _b1, _h0, _h1) for x in _custom_all]
+        _o = _o_all[_b0:_b1, _h0:_h1]
+        _final_rowscales = [x[_b0:_b1, _h0:_h1] for x in _final_rowscales_all]
+        _b = torch.arange(_b0, _b1, device=device).view(-1, 1, 1, 1)
+        _h = torch.arange(_h0, _h1, device=device).view(1, -1, 1, 1)
+        _q_idx = torch.arange(_q0, _q1, device=device).view(1, 1, -1, 1) + q_offset
+        _q_tile = _q_all[_b0:_b1, _h0:_h1, _q0:_q1]
+        _rows = (_b1 - _b0, _h1 - _h0, _q1 - _q0)
+        acc_o = torch.zeros(*_rows, D_HEADV, dtype=torch.float, device=device)
+        {{o_scale_init | indent(8)}}
+        {{online_rowscales_initvalue | indent(8)}}
+
+        for _k0 in range(0, N_CTX_KV, BLOCK_N):
+            _k1 = min(_k0 + BLOCK_N, N_CTX_KV)
+            _kv_idx = torch.arange(_k0, _k1, device=device).view(1, 1, 1, -1)
+            _mask = _tile_mask(_b, _h, _q_idx, _kv_idx)
+            # skip fully masked tiles
+            if _mask is not None and not _mask.any():
+                continue
+            scores = _q_tile @ _k[:, :, _k0:_k1].transpose(-1, -2)
+            if _mask is not None and IS_INF_MASK:
+                scores = scores.masked_fill(~_mask, float("-inf"))
+
+            # score_mod
+            {{custom_fwd_inputs_tile | indent(12)}}
+            b, h, q_idx, kv_idx = _b, _h, _q_idx, _kv_idx
+            {{score_mod_fwd_body | indent(12)}}
+            scores = {{score_mod_output_var}}
+            if _mask is not None and not IS_INF_MASK:
+                scores = scores.masked_fill(~_mask, 0)
+
+            # online_func
+            _masked = _masked_rows(_mask, _rows)
+            if _masked is not None:
+                _state = ({{online_state}},)
+            online_b, online_h, online_q_idx = _b[..., 0], _h[..., 0], _q_idx[..., 0]
+            {{online_func_body | indent(12)}}
+            {{o_scale_update | indent(12)}}
+            {{online_rowscales_update | indent(12)}}
+            acc_o = acc_o + {{online_func_output_var}} @ _v[:, :, _k0:_k1]
+            if _masked is not None:
+                {{online_state}}, = _keep_rows(_masked, _state, ({{online_state}},))
+
+        # online_fwd_epilogue
+        online_b, online_h, online_q_idx = _b[..., 0], _h[..., 0], _q_idx[..., 0]
+        {{online_func_epilogue | indent(8)}}
+        _o[:, :, _q0:_q1] = {{acc_o_output_var}}
+        {{final_rowscales_save | indent(8)}}
+
+    _run_grid(_fwd_block, _grid(BATCH, H, N_CTX, BLOCK_M))
+    return _o_all.transpose(1, 2).to(q.dtype), _final_rowscales_all
+
+
+def attention_bwd(do, q, k, v, o, custom_fwd_inputs, final_rowscales):
+    BATCH, N_CTX, H, D_HEAD = q.shape
+    N_CTX_KV, H_KV, D_HEADV = k.shape[1], k.shape[2], v.shape[-1]
+    device = q.device
+    q_offset = N_CTX_KV - N_CTX
+    _q_all = q.transpose(1, 2).float().contiguous()
+    _k_all = k.transpose(1, 2).float().repeat_interleave(H // H_KV, dim=1)
+    _v_all = v.transpose(1, 2).float().repeat_interleave(H // H_KV, dim=1)
+    _do_all = do.transpose(1, 2).float().contiguous()
+    _custom_all = [_view(x, dims) for x, dims in zip(custom_fwd_inputs, CUSTOM_INPUT_DIMS)]
+    if {{isused_doosum}}:
+        _doosum_all = (_do_all * o.transpose(1, 2).float()).sum(dim=-1)
+    _dq_all = torch.zeros_like(_q_all)
+    _dk_all = torch.zeros_like(_k_all)
+    _dv_all = torch.zeros_like(_v_all)
+
+    def _bwd_block(_b0, _b1, _h0, _h1, _qs, _qe):
+        # all q tiles of heads [_b0, _b1) x [_h0, _h1), dk&dv of different blocks are disjoint
+        _q = _q_all[_b0:_b1, _h0:_h1]
+        _k = _k_all[_b0:_b1, _h0:_h1]
+        _v = _v_all[_b0:_b1, _h0:_h1]
+        _do = _do_all[_b0:_b1, _h0:_h1]
+        _custom = [_select(x, _b0, _b1, _h0, _h1) for x in _custom_all]
+        _final_rowscales = [x[_b0:_b1, _h0:_h1] for x in final_rowscales]
+        if {{isused_doosum}}:
+            _doosum = _doosum_all[_b0:_b1, _h0:_h1]
+        _dq = _dq_all[_b0:_b1, _h0:_h1]
+        _dk = _dk_all[_b0:_b1, _h0:_h1]
+        _dv = _dv_all[_b0:_b1, _h0:_h1]
+        _b = torch.arange(_b0, _b1, device=device).view(-1, 1, 1, 1)
+        _h = torch.arange(_h0, _h1, device=device).view(1, -1, 1, 1)
+        for _q0 in range(_qs, _qe, BLOCK_M_BWD):
+            _q1 = min(_q0 + BLOCK_M_BWD, _qe)
+            _q_idx = torch.arange(_q0, _q1, device=device).view(1, 1, -1, 1) + q_offset
+            _q_tile = _q[:, :, _q0:_q1]
+            _do_tile = _do[:, :, _q0:_q1]
+            _dq_tile = _dq[:, :, _q0:_q1]
+
+            for _k0 in range(0, N_CTX_KV, BLOCK_N_BWD):
+                _k1 = min(_k0 + BLOCK_N_BWD, N_CTX_KV)
+                _kv_idx = torch.arange(_k0, _k1, device=device).view(1, 1, 1, -1)
+                _mask = _tile_mask(_b, _h, _q_idx, _kv_idx)
+                if _mask is not None and not _mask.any():
+                    continue
+                _k_tile = _k[:, :, _k0:_k1]
+                _v_tile = _v[:, :, _k0:_k1]
+                scores = _q_tile @ _k_tile.transpose(-1, -2)
+
+                # score_mod
+                {{custom_fwd_inputs_tile | indent(16)}}
+                b, h, q_idx, kv_idx = _b, _h, _q_idx, _kv_idx
+                {{score_mod_bwd_fwd_body | indent(16)}}
+                p = {{score_mod_bwd_output_var}}
+
+                # online_func forward with final_rowscales
+                online_b, online_h, online_q_idx = _b[..., 0], _h[..., 0], _q_idx[..., 0]
+                online_kv_idx = _kv_idx
+                {{final_rowscales_load | indent(16)}}
+                if {{isused_doosum}}:
+                    doosum = _doosum[:, :, _q0:_q1]
+                {{online_func_fwd | indent(16)}}
+                p = {{online_func_fwd_output_var}}
+                if _mask is not None:
+                    p = p.masked_fill(~_mask, 0)
+
+                _dv[:, :, _k0:_k1] += p.transpose(-1, -2) @ _do_tile
+                dp = _do_tile @ _v_tile.transpose(-1, -2)
+                if _mask is not None:
+                    dp = dp.masked_fill(~_mask, 0)
+
+                # online_func backward
+                {{online_func_bwd | indent(16)}}
+                dscores = {{online_func_bwd_output_var}}
+
+                # score_mod backward
+                {{score_mod_backward | indent(16)}}
+                _ds = {{score_mod_grad_var}}
+                _dq_tile += _ds @ _k_tile
+                _dk[:, :, _k0:_k1] += _ds.transpose(-1, -2) @ _q_tile
+
+    _run_grid(_bwd_block, _grid(BATCH, H, N_CTX, N_CTX))
+    _dk = _dk_all.view(BATCH, H_KV, H // H_KV, N_CTX_KV, D_HEAD).sum(2)
+    _dv = _dv_all.view(BATCH, H_KV, H // H_KV, N_CTX_KV, D_HEADV).sum(2)
+    return (_dq_all.transpose(1, 2).to(q.dtype), _dk.transpose(1, 2).to(k.dtype),
+            _dv.transpose(1, 2).to(v.dtype))
+
+
+# pytorch compatible func
+class _attention(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, q, k, v, *custom_fwd_inputs):
+        o, final_rowscales = attention_fwd(q, k, v, *custom_fwd_inputs)
+        ctx.num_custom_fwd_inputs = len(custom_fwd_inputs)
+        ctx.save_for_backward(q, k, v, o, *custom_fwd_inputs, *final_rowscales)
+        return o
+
+    @staticmethod
+    def backward(ctx, do):
+        q, k, v, o, *tmp = ctx.saved_tensors
+        custom_fwd_inputs = tmp[:ctx.num_custom_fwd_inputs]
+        final_rowscales = tmp[ctx.num_custom_fwd_inputs:]
+        dq, dk, dv = attention_bwd(do, q, k, v, o, custom_fwd_inputs, final_rowscales)
+        none_list = [None] * len(custom_fwd_inputs)
+        return dq, dk, dv, *none_list
+
+
+attention = _attention.apply
@@ -0,0 +1,58 @@
+# TORCH_IMPORT = """
+import torch
+
+# chunked linear attention in pytorch, the recurrence of chunk_fwd_h&chunk_o of the tl kernel.
+# q: [batch, headq, seq_len, dim], k: [batch, headk, seq_len, dim],
+# v: [batch, head, seq_len, dimv], decay: [batch, head, seq_len] (log decay after decay_mod)
+# computed in float32, intra chunk scores are [BT, BT], backward is torch autograd
+
+BT = {{BT}}
+
+
+def linear_attention(q, k, v, decay, {{custom_inputs_list}}):
+    BATCH, HQ, N_CTX, D_HEAD = q.shape
+    HK, H, D_HEADV = k.shape[1], v.shape[1], v.shape[-1]
+    out_dtype = v.dtype
+    q, k, v, decay = q.float(), k.float(), v.float(), decay.float()
+    {{custom_inputs_cast | indent(4)}}
+
+    # decay_mod here
+    {{decay_mod_expr | indent(4)}}
+
+    # q_mod here
+    {{q_mod_expr | indent(4)}}
+
+    # k_mod here
+    {{k_mod_expr | indent(4)}}
+
+    # v_mod here
+    {{v_mod_expr | indent(4)}}
+
+    _q = {{q_name}}.repeat_interleave(H // HQ, dim=1)
+    _k = {{k_name}}.repeat_interleave(H // HK, dim=1)
+    _v = {{v_name}}
+    _g = {{decay_name}}
+
+    # state at the start of a chunk
+    _h = torch.zeros(BATCH, H, D_HEAD, D_HEADV, dtype=torch.float, device=q.device)
+    _o = []
+    for _t0 in range(0, N_CTX, BT):
+        _t1 = min(_t0 + BT, N_CTX)
+        _q_chunk = _q[:, :, _t0:_t1]
+        _k_chunk = _k[:, :, _t0:_t1]
+        _v_chunk = _v[:, :, _t0:_t1]
+        # chunk local cumsum of log decay
+        _g_chunk = _g[:, :, _t0:_t1].cumsum(dim=-1)
+        _g_last = _g_chunk[..., -1:]
+
+        _o_chunk = (_q_chunk * _g_chunk.exp()[..., None]) @ _h
+        _decay = _g_chunk[..., :, None] - _g_chunk[..., None, :]
+        _causal = torch.ones(_t1 - _t0, _t1 - _t0, dtype=torch.bool, device=q.device).tril()
+        _decay = _decay.masked_fill(~_causal, float("-inf")).exp()
+        _s = (_q_chunk @ _k_chunk.transpose(-1, -2)) * _decay
+        _o.append(_o_chunk + _s @ _v_chunk)
+
+        _k_decay = _k_chunk * (_g_last - _g_chunk).exp()[..., None]
+        _h = _h * _g_last.exp()[..., None] + _k_decay.transpose(-1, -2) @ _v_chunk
+
+    return torch.cat(_o, dim=2).to(out_dtype)
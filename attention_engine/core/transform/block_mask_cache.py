@@ -0,0 +1,95 @@
+"""
+LRU cache of block masks shared by all engines.
+
+Layers with the same mask_mod and problem shape lower to the same block mask,
+entries are keyed by the structural hash of the mask_mod fx graph, so two
+equal mask_mods defined in different places share one entry.
+"""
+from .core import create_block_mask, mask_mod_uses_batch_head, BLOCK_SIZE
+from .serialize import serialize_fx_graph, structural_hash
+
+import threading
+from collections import OrderedDict
+
+import torch
+import torch.fx as fx
+
+
+def _mask_mod_hash(mask_mod):
+    """
+    None for mask_mods that can not be keyed by structure, e.g. ones capturing tensors
+    """
+    try:
+        return structural_hash(serialize_fx_graph(fx.symbolic_trace(mask_mod)))
+    except (NotImplementedError, TypeError):
+        return None
+
+
+class BlockMaskCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_create(self, mask_mod, B, H, QLen, KVLen, device, Q_BLOCK_SIZE=None, KV_BLOCK_SIZE=None,
+                      separate_full_blocks=False):
+        """
+        same arguments as create_block_mask, the returned tensor is shared and must not be modified
+        """
+        mask_hash = _mask_mod_hash(mask_mod)
+        if mask_hash is not None:
+            # the mask is [1, 1, ...] in the dims mask_mod does not use, shared by all B, H
+            uses_batch, uses_head = mask_mod_uses_batch_head(mask_mod)
+            B = B if uses_batch else 1
+            H = H if uses_head else 1
+        key = (mask_hash, B, H, QLen, KVLen,
+               Q_BLOCK_SIZE or BLOCK_SIZE, KV_BLOCK_SIZE or BLOCK_SIZE,
+               str(torch.device(device)), separate_full_blocks)
+        with self._lock:
+            if mask_hash is not None and key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        block_mask = create_block_mask(mask_mod, B, H, QLen, KVLen, device, Q_BLOCK_SIZE, KV_BLOCK_SIZE,
+                                       separate_full_blocks=separate_full_blocks)
+        nbytes = block_mask.numel() * block_mask.element_size()
+        if mask_hash is None or nbytes > self.max_bytes:
+            return block_mask
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = block_mask
+                self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.numel() * evicted.element_size()
+                self.evictions += 1
+            return self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+# default cache of lower_tl
+block_mask_cache = BlockMaskCache()
@@ -1,10 +1,13 @@
 import torch
+import torch.fx as fx
 from typing import Literal, Type
 import functools
+import operator
 from .graph import *
 from ..utils import IndentedCode
 import functools
 from copy import copy, deepcopy
+from dataclasses import dataclass
 
 from torch import Tensor
 from typing import Optional, Union, Any
@@ -32,6 +35,35 @@ def plus_count(func):
     return wrapper
 
 
+def topo_sort(outputs: list, skip=None) -> list:
+    """
+    iterative post-order DFS over prev, each node visited once.
+    inputs come before their users in the returned list.
+    skip(node) -> True: node and its prev are not visited
+    """
+    order = []
+    visited = set()
+    for output in outputs:
+        if id(output) in visited or (skip is not None and skip(output)):
+            continue
+        visited.add(id(output))
+        # (node, index of next prev to visit)
+        stack = [(output, 0)]
+        while stack:
+            node, idx = stack[-1]
+            if idx < len(node.prev):
+                stack[-1] = (node, idx + 1)
+                prev = node.prev[idx]
+                if id(prev) in visited or (skip is not None and skip(prev)):
+                    continue
+                visited.add(id(prev))
+                stack.append((prev, 0))
+            else:
+                stack.pop()
+                order.append(node)
+    return order
+
+
 class SymbolScalar:
     def __init__(self, varname: str, value: Node, prev=[], shape_idx: list = ["block_M"],
                  require_grad: bool = True, dtype="float"):
@@ -112,9 +144,12 @@ class SymbolScalar:
     def backward(self, grad=None):  # SymbolicScalar
         if grad:
             self.grad = grad
-        self._backward(self.grad)
-        for node in self.prev:
-            node.backward()
+        # reverse topological order: grad of a node is complete before
+        # it is propagated, shared subgraphs are visited once
+        for node in reversed(topo_sort([self])):
+            if node.grad is None:
+                continue
+            node._backward(node.grad)
 
     def _backward(self, grad):  # symblocscalar
         if self.code.type == "Var" or self.code.type == "Const":
@@ -319,6 +354,7 @@ def create_mask(
     Q_LEN: int,
     KV_LEN: int,
     device: str = "cuda",
+    q_start: int = 0,
 ) -> torch.Tensor:
     r"""This function creates a mask tensor from a mod_fn function.
 
@@ -329,6 +365,7 @@ def create_mask(
         Q_LEN (int): Sequence length of query.
         KV_LEN (int): Sequence length of key/value.
         device (str): Device to run the mask creation on.
+        q_start (int): Index of the first query row, rows are [q_start, q_start + Q_LEN).
 
     Returns:
         mask (Tensor): A mask tensor with shape (B, H, M, N).
@@ -339,7 +376,7 @@ def create_mask(
         H = 1
     b = torch.arange(0, B, device=device)
     h = torch.arange(0, H, device=device)
-    m = torch.arange(0, Q_LEN, device=device)
+    m = torch.arange(q_start, q_start + Q_LEN, device=device)
     n = torch.arange(0, KV_LEN, device=device)
 
     # with TransformGetItemToIndex():
@@ -415,6 +452,59 @@ def _convert_mask_to_block_mask(
         partial_blocks = partial_blocks.to(dtype=torch.int8)
         return partial_blocks, None
 
+@dataclass
+class BlockMaskInfo:
+    """
+    structure of a [B, H, M, N] block mask, rows are (batch, head, q block):
+    is_causal: nonzero blocks are exactly the blocks touching kv_idx <= q_idx
+    is_less_causal: no nonzero block is above the diagonal
+    max_kv_blocks: max nonzero kv blocks of a row
+    empty_rows: rows without nonzero blocks
+    density: fraction of nonzero blocks, full_density: fraction of full (2) blocks.
+    is_causal and density are the mask of AttnProblem of the cost model
+    """
+    is_causal: bool
+    is_less_causal: bool
+    max_kv_blocks: int
+    empty_rows: int
+    density: float
+    full_density: float
+
+
+def _causal_blocks(M, N, block_M, block_N, device):
+    # blocks with some kv_idx <= q_idx
+    q_idx = torch.arange(M, device=device).unsqueeze(-1)
+    kv_idx = torch.arange(N, device=device).view(1, -1)
+    return (q_idx + 1) * block_M > kv_idx * block_N
+
+
+def classify_block_mask(mask_tensor, block_M, block_N) -> BlockMaskInfo:
+    """
+    one pass on the device of mask_tensor, the stats are copied to host once
+    """
+    B, H, M, N = mask_tensor.shape
+    device = mask_tensor.device
+    nonzero = mask_tensor != 0
+    causal = _causal_blocks(M, N, block_M, block_N, device)
+    counts = nonzero.sum(dim=-1)
+    stats = torch.stack([
+        (nonzero == causal).all(),
+        ~(nonzero & ~causal).any(),
+        counts.amax(),
+        (counts == 0).sum(),
+        nonzero.sum() / nonzero.numel(),
+        (mask_tensor == 2).sum() / nonzero.numel(),
+    ]).double().tolist()
+    return BlockMaskInfo(
+        is_causal=bool(stats[0]),
+        is_less_causal=bool(stats[1]),
+        max_kv_blocks=int(stats[2]),
+        empty_rows=int(stats[3]),
+        density=stats[4],
+        full_density=stats[5],
+    )
+
+
 def is_causal_mask(mask_tensor, block_M, block_N):
     """
     mask_tensor: (B,H,seqlen//BLOCKM,seqlen//BLOCKN)
@@ -423,14 +513,9 @@ def is_causal_mask(mask_tensor, block_M, block_N):
     True: mask_tensor is a causal mask
     False: mask_tensor is not a causal mask
     """
-    # 获取张量的形状
     B, H, M, N = mask_tensor.shape
-    q_idx = torch.arange(M).unsqueeze(-1)  # 创建一个列向量
-    kv_idx = torch.arange(N).view(1,-1)  # 创建一个行向量
-    # 创建一个下三角掩码
-    mask = (q_idx+1)*block_M > kv_idx*block_N
-    # 判断是否相等
-    return torch.all(mask_tensor.bool() == mask.to(mask_tensor.device))
+    causal = _causal_blocks(M, N, block_M, block_N, mask_tensor.device)
+    return bool(torch.all((mask_tensor != 0) == causal))
 
 def is_less_causal_mask(mask_tensor, block_M, block_N):
     """
@@ -440,36 +525,128 @@ def is_less_causal_mask(mask_tensor, block_M, block_N):
     True: mask_tensor is a less causal mask
     False: mask_tensor is not a less causal mask
     """
-    # 获取张量的形状
     B, H, M, N = mask_tensor.shape
-    q_idx = torch.arange(M).unsqueeze(-1)  # 创建一个列向量
-    kv_idx = torch.arange(N).view(1,-1)  # 创建一个行向量
-    # 创建一个上三角掩码
-    mask = (q_idx+1)*block_M-1 < (kv_idx)*block_N
-    filter_tensor = mask_tensor[...,mask]
-    is_all_zero = torch.all(filter_tensor == 0)
-    return is_all_zero
+    causal = _causal_blocks(M, N, block_M, block_N, mask_tensor.device)
+    return not bool(torch.any((mask_tensor != 0) & ~causal))
+
+
+def mask_mod_uses_batch_head(mask_mod) -> tuple[bool, bool]:
+    """
+    whether mask_mod reads its batch and head index, from the users of
+    the placeholders of its fx trace.
+    block masks of mask_mods that ignore them are stored once, e.g. causal, sliding window
+    """
+    mask_graph = fx.symbolic_trace(mask_mod)
+    placeholders = [node for node in mask_graph.graph.nodes if node.op == "placeholder"]
+    return len(placeholders[0].users) > 0, len(placeholders[1].users) > 0
+
+
+def mask_mod_custom_inputs(mask_mod) -> list[str]:
+    """
+    names of the custom_fwd_inputs read by mask_mod, [] for index only masks.
+    a mask_mod reading runtime tensors takes them as a 5th argument, e.g.
+        def document_mask(b, h, q_idx, kv_idx, custom_fwd_inputs):
+            doc_ids = custom_fwd_inputs["doc_ids"]
+            return doc_ids[b, q_idx] == doc_ids[b, kv_idx]
+    its block mask is rebuilt from the tensors of every call
+    """
+    mask_graph = fx.symbolic_trace(mask_mod)
+    placeholders = [node for node in mask_graph.graph.nodes if node.op == "placeholder"]
+    if len(placeholders) < 5:
+        return []
+    names = []
+    for node in placeholders[4].users:
+        if node.target != operator.getitem or not isinstance(node.args[1], str):
+            raise NotImplementedError(f"mask_mod custom_fwd_inputs must be indexed by name, got {node}")
+        if node.args[1] not in names:
+            names.append(node.args[1])
+    return names
 
 
 BLOCK_SIZE = 128
-def create_block_mask(mask_mod, B, H, QLen, KVLen, device, Q_BLOCK_SIZE=None, KV_BLOCK_SIZE=None):
+def create_block_mask(mask_mod, B, H, QLen, KVLen, device, Q_BLOCK_SIZE=None, KV_BLOCK_SIZE=None,
+                      separate_full_blocks=False, mask_inputs=None):
+    """
+    int8 [B, H, QLen//Q_BLOCK_SIZE, KVLen//KV_BLOCK_SIZE] block mask, 0 for empty blocks.
+    with separate_full_blocks, partial blocks are 1 and full blocks are 2,
+    kernels skip the elementwise mask_mod on full blocks.
+    mask_inputs: dict of tensors passed to a mask_mod reading custom_fwd_inputs
+    """
     if Q_BLOCK_SIZE is None:
         Q_BLOCK_SIZE = BLOCK_SIZE
     if KV_BLOCK_SIZE is None:
         KV_BLOCK_SIZE = BLOCK_SIZE
-    mask_tensor = create_mask(mask_mod, B, H, QLen, KVLen, device)
-    partial_block_mask, full_block_mask = _convert_mask_to_block_mask(
-        mask_tensor,
-        Q_BLOCK_SIZE=Q_BLOCK_SIZE,
-        KV_BLOCK_SIZE=KV_BLOCK_SIZE,
-        separate_full_blocks=False,
-    )
+    # [1, 1, ...] for dims mask_mod does not use, kernels index them with 0
+    uses_batch, uses_head = mask_mod_uses_batch_head(mask_mod)
+    if not uses_batch:
+        B = 1
+    if not uses_head:
+        H = 1
+    if mask_inputs is not None:
+        # bind the tensors, vmap maps only the 4 index args
+        dynamic_mask_mod = mask_mod
+        mask_mod = lambda b, h, q_idx, kv_idx: dynamic_mask_mod(b, h, q_idx, kv_idx, mask_inputs)
+    # one strip of Q_BLOCK_SIZE query rows at a time, the dense mask is at most
+    # [B, H, Q_BLOCK_SIZE, KVLen] instead of [B, H, QLen, KVLen]
+    partial_block_masks = []
+    for q_start in range(0, QLen, Q_BLOCK_SIZE):
+        mask_strip = create_mask(mask_mod, B, H, min(Q_BLOCK_SIZE, QLen - q_start), KVLen,
+                                 device, q_start=q_start)
+        partial_block_mask, full_block_mask = _convert_mask_to_block_mask(
+            mask_strip,
+            Q_BLOCK_SIZE=Q_BLOCK_SIZE,
+            KV_BLOCK_SIZE=KV_BLOCK_SIZE,
+            separate_full_blocks=separate_full_blocks,
+        )
+        if full_block_mask is not None:
+            # padded blocks at the end are never full
+            partial_block_mask = partial_block_mask + 2 * full_block_mask
+        partial_block_masks.append(partial_block_mask)
     # TODO: sparse block
-    
-    return partial_block_mask
+
+    return torch.cat(partial_block_masks, dim=2)
+
+@dataclass
+class BlockSparseIndex:
+    """
+    csr style block mask, one row per (batch, head, q block):
+    kv_num_blocks: int32 [B, H, Q//bm], number of nonzero kv blocks of the row
+    kv_indices: int32 [B, H, Q//bm, KV//bn], their kv block index in ascending order,
+        entries after kv_num_blocks are padding. the width is static, kernels
+        compile once per shape and loop up to kv_num_blocks
+    kv_kinds: int8, same shape as kv_indices, 1 partial, 2 full
+    """
+    kv_num_blocks: Tensor
+    kv_indices: Tensor
+    kv_kinds: Tensor
+
+
+def block_mask_to_index(block_mask: Tensor) -> BlockSparseIndex:
+    nonzero = block_mask != 0
+    kv_num_blocks = nonzero.sum(dim=-1, dtype=torch.int32)
+    # stable sort keeps nonzero blocks first and in ascending order
+    order = torch.sort((~nonzero).to(torch.int8), dim=-1, stable=True).indices
+    kv_kinds = block_mask.gather(-1, order).to(torch.int8)
+    return BlockSparseIndex(kv_num_blocks, order.to(torch.int32).contiguous(), kv_kinds.contiguous())
+
 
 def create_block_idx(mask_mod, B, H, QLen, KVLen, device, Q_BLOCK_SIZE=None, KV_BLOCK_SIZE=None):
-    block_mask = create_block_mask(mask_mod, B, H, QLen, KVLen, device, Q_BLOCK_SIZE, KV_BLOCK_SIZE)
-    block_idx = torch.nonzero(block_mask, as_tuple=False)
-    # TODO
-    return block_idx
+    block_mask = create_block_mask(mask_mod, B, H, QLen, KVLen, device, Q_BLOCK_SIZE, KV_BLOCK_SIZE,
+                                   separate_full_blocks=True)
+    return block_mask_to_index(block_mask)
+
+
+def block_mask_to_index_bwd(block_mask: Tensor) -> BlockSparseIndex:
+    """
+    transposed index of the bwd kernel, one row per (batch, head, kv block):
+    kv_num_blocks, kv_indices and kv_kinds hold the nonzero q blocks of the row.
+    block_mask is at the bwd tiles, [B, H, Q//block_N_bwd, KV//block_M_bwd]
+    """
+    return block_mask_to_index(block_mask.transpose(-1, -2))
+
+
+def create_block_idx_bwd(mask_mod, B, H, QLen, KVLen, device, Q_BLOCK_SIZE=None, KV_BLOCK_SIZE=None,
+                         mask_inputs=None):
+    block_mask = create_block_mask(mask_mod, B, H, QLen, KVLen, device, Q_BLOCK_SIZE, KV_BLOCK_SIZE,
+                                   separate_full_blocks=True, mask_inputs=mask_inputs)
+    return block_mask_to_index_bwd(block_mask)
@@ -0,0 +1,189 @@
+"""
+Block masks of mask_mods reading custom_fwd_inputs, e.g. packed documents
+
+    def document_causal_mask(b, h, q_idx, kv_idx, custom_fwd_inputs):
+        doc_ids = custom_fwd_inputs["doc_ids"]
+        return (doc_ids[b, q_idx] == doc_ids[b, kv_idx]) & (q_idx >= kv_idx)
+
+    custom_fwd_inputs = CustomIO({"doc_ids": ("batch", "seq_len")})
+
+The kernel is compiled once with the block mask as an input, the block mask
+is rebuilt from the tensors of every call. doc_ids[q_idx] == doc_ids[kv_idx]
+is computed from per block min/max of doc_ids, other conjuncts that only use
+indices are built once and cached.
+"""
+from .core import create_block_mask, mask_mod_custom_inputs, mask_mod_uses_batch_head, \
+    block_mask_to_index_bwd, _broadcast_to_dim, _round_up_to_multiple
+from .block_mask_cache import block_mask_cache
+
+import operator
+
+import torch
+import torch.fx as fx
+
+_and_ops = (operator.and_, torch.logical_and)
+
+
+def document_block_mask(doc_ids, Q_BLOCK_SIZE, KV_BLOCK_SIZE):
+    """
+    int8 [B, 1, S//Q_BLOCK_SIZE, S//KV_BLOCK_SIZE] block mask (0 empty, 1 partial, 2 full) of
+    doc_ids[b, q_idx] == doc_ids[b, kv_idx], doc_ids [S] or [B, S].
+    O(B * S) + O(B * blocks) from the id range of every block, no [S, S] mask.
+    exact for packed (non decreasing) doc_ids, otherwise some empty blocks are
+    partial, which the kernel masks elementwise
+    """
+    doc_ids = _broadcast_to_dim(doc_ids, 2)
+    B, S = doc_ids.shape
+
+    def block_range(block_size):
+        # pad with the last id, min/max of the last block are unchanged
+        pad = _round_up_to_multiple(S, block_size) - S
+        ids = torch.cat([doc_ids, doc_ids[:, -1:].expand(B, pad)], dim=1).view(B, -1, block_size)
+        padded = torch.zeros(ids.shape[1], dtype=torch.bool, device=doc_ids.device)
+        padded[-1] = pad > 0
+        return ids.amin(dim=-1), ids.amax(dim=-1), padded
+
+    q_min, q_max, q_padded = block_range(Q_BLOCK_SIZE)
+    kv_min, kv_max, kv_padded = block_range(KV_BLOCK_SIZE)
+    q_min, q_max, q_padded = q_min[:, :, None], q_max[:, :, None], q_padded[:, None]
+    kv_min, kv_max, kv_padded = kv_min[:, None, :], kv_max[:, None, :], kv_padded[None, :]
+    nonzero = (q_min <= kv_max) & (kv_min <= q_max)
+    # padded elements are masked, so padded blocks are never full
+    full = (q_min == q_max) & (kv_min == kv_max) & (q_min == kv_min) & ~q_padded & ~kv_padded
+    return (nonzero.to(torch.int8) + full.to(torch.int8))[:, None]
+
+
+def combine_block_masks(x, y):
+    """
+    block mask of mask_x & mask_y: empty if either is empty, full if both are full
+    """
+    empty = (x == 0) | (y == 0)
+    full = (x == 2) & (y == 2)
+    return torch.where(empty, 0, torch.where(full, 2, 1)).to(torch.int8)
+
+
+def _conjuncts(node):
+    if node.op == "call_function" and node.target in _and_ops:
+        return [c for arg in node.args for c in _conjuncts(arg)]
+    return [node]
+
+
+def _document_ids(node, placeholders):
+    """
+    (name, batched) if node is x[q_idx] == x[kv_idx] or x[b, q_idx] == x[b, kv_idx]
+    for x = custom_fwd_inputs[name], else None
+    """
+    b, _, q_idx, kv_idx, custom_inputs = placeholders
+    if node.op != "call_function" or node.target != operator.eq:
+        return None
+    lhs, rhs = node.args
+    loads = []
+    for load, idx in ((lhs, q_idx), (rhs, kv_idx)):
+        if not (isinstance(load, fx.Node) and load.target == operator.getitem):
+            return None
+        src, load_idx = load.args
+        if not (isinstance(src, fx.Node) and src.target == operator.getitem and src.args[0] is custom_inputs):
+            return None
+        if load_idx is idx:
+            loads.append((src.args[1], False))
+        elif load_idx == (b, idx):
+            loads.append((src.args[1], True))
+        else:
+            return None
+    return loads[0] if loads[0] == loads[1] else None
+
+
+def _depends_on(node, target):
+    stack, seen = [node], set()
+    while stack:
+        n = stack.pop()
+        if n is target:
+            return True
+        if n not in seen:
+            seen.add(n)
+            stack.extend(n.all_input_nodes)
+    return False
+
+
+def _static_mask_mod(mask_graph, placeholders, nodes):
+    """
+    4 argument mask_mod of the and of nodes, which only use indices
+    """
+    graph = fx.Graph()
+    env = {}
+    for node in placeholders[:4]:
+        env[node] = graph.placeholder(node.name)
+    for node in mask_graph.graph.nodes:
+        if node.op not in ("placeholder", "output") and any(_depends_on(n, node) for n in nodes):
+            env[node] = graph.node_copy(node, lambda n: env[n])
+    output = env[nodes[0]]
+    for node in nodes[1:]:
+        output = graph.call_function(operator.and_, (output, env[node]))
+    graph.output(output)
+    return fx.GraphModule(mask_graph, graph)
+
+
+class DynamicBlockMask:
+    """
+    block mask of a mask_mod reading custom_fwd_inputs, rebuilt for every call.
+    __call__ takes the inputs of the kernel, q k v [batch, seq_len, heads, dim]
+    and custom_fwd_inputs in the order of input_names.
+    with the bwd tiles it returns the fwd block mask and the transposed
+    BlockSparseIndex of bwd
+    """
+
+    def __init__(self, mask_mod, input_names, Q_BLOCK_SIZE, KV_BLOCK_SIZE,
+                 KV_BLOCK_SIZE_BWD=None, Q_BLOCK_SIZE_BWD=None):
+        self.mask_mod = mask_mod
+        self.input_names = list(input_names)
+        self.mask_input_names = mask_mod_custom_inputs(mask_mod)
+        for name in self.mask_input_names:
+            if name not in self.input_names:
+                raise ValueError(f"mask_mod reads {name}, which is not in custom_fwd_inputs")
+        self.Q_BLOCK_SIZE = Q_BLOCK_SIZE
+        self.KV_BLOCK_SIZE = KV_BLOCK_SIZE
+        self.KV_BLOCK_SIZE_BWD = KV_BLOCK_SIZE_BWD
+        self.Q_BLOCK_SIZE_BWD = Q_BLOCK_SIZE_BWD
+        self.uses_batch, self.uses_head = mask_mod_uses_batch_head(mask_mod)
+        # fast path: doc_ids[q_idx] == doc_ids[kv_idx] & <index only mask>
+        self.document_ids = None
+        self.static_mask_mod = None
+        mask_graph = fx.symbolic_trace(mask_mod)
+        placeholders = [node for node in mask_graph.graph.nodes if node.op == "placeholder"]
+        output = [node for node in mask_graph.graph.nodes if node.op == "output"][0].args[0]
+        conjuncts = _conjuncts(output)
+        documents = [_document_ids(node, placeholders) for node in conjuncts]
+        rest = [node for node, document in zip(conjuncts, documents) if document is None]
+        if sum(document is not None for document in documents) == 1 and \
+                not any(_depends_on(node, placeholders[4]) for node in rest):
+            self.document_ids = [document for document in documents if document is not None][0]
+            if rest:
+                self.static_mask_mod = _static_mask_mod(mask_graph, placeholders, rest)
+
+    def __call__(self, q, k, v, *custom_fwd_inputs):
+        block_mask = self.block_mask(q, k, custom_fwd_inputs, self.Q_BLOCK_SIZE, self.KV_BLOCK_SIZE)
+        if self.KV_BLOCK_SIZE_BWD is None:
+            return block_mask
+        block_mask_bwd = self.block_mask(q, k, custom_fwd_inputs, self.Q_BLOCK_SIZE_BWD, self.KV_BLOCK_SIZE_BWD)
+        return block_mask, block_mask_to_index_bwd(block_mask_bwd)
+
+    def block_mask(self, q, k, custom_fwd_inputs, Q_BLOCK_SIZE, KV_BLOCK_SIZE):
+        B, QLen, H = q.shape[:3]
+        KVLen = k.shape[1]
+        inputs = dict(zip(self.input_names, custom_fwd_inputs))
+        if self.document_ids is None or QLen != KVLen:
+            mask_inputs = {name: inputs[name] for name in self.mask_input_names}
+            return create_block_mask(self.mask_mod, B, H, QLen, KVLen, q.device,
+                                     Q_BLOCK_SIZE, KV_BLOCK_SIZE,
+                                     separate_full_blocks=True, mask_inputs=mask_inputs)
+        name, batched = self.document_ids
+        doc_ids = inputs[name] if batched else inputs[name].view(1, -1)
+        block_mask = document_block_mask(doc_ids, Q_BLOCK_SIZE, KV_BLOCK_SIZE)
+        if self.static_mask_mod is not None:
+            static_block_mask = block_mask_cache.get_or_create(
+                self.static_mask_mod, B, H, QLen, KVLen, q.device,
+                Q_BLOCK_SIZE, KV_BLOCK_SIZE, separate_full_blocks=True)
+            block_mask = combine_block_masks(block_mask, static_block_mask)
+        # [batch or 1, heads or 1, ...] like create_block_mask
+        return block_mask.expand(B if self.uses_batch else 1, H if self.uses_head else 1,
+                                 *block_mask.shape[2:]).contiguous()
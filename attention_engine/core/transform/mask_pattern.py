@@ -0,0 +1,305 @@
+"""
+Symbolic analysis of mask_mod.
+
+The fx trace of mask_mod is converted to a sympy boolean expression over
+b, h, q_idx and kv_idx. For a query row the allowed kv indices are bounded by
+    kv_start(q_idx) <= kv_idx <= kv_last(q_idx)
+(the hull of the allowed set), which gives closed form kv loop bounds of a
+q tile for causal (with offset), sliding window, prefix-LM and chunked-local
+masks. Document (segment id) masks index tensors with q_idx/kv_idx, they are
+recognized but have no closed form bounds.
+
+Tile bounds are only emitted when they are proven for every q_idx: bounds
+are built from linear terms, floor, ceiling, min and max, whose monotonicity
+in q_idx follows from their structure. Masks with other functions, e.g.
+q_idx % 4096, are "unknown" and run the dense loop.
+"""
+import operator
+from dataclasses import dataclass
+from typing import Optional
+
+import sympy as sp
+import torch
+import torch.fx as fx
+from sympy.printing.str import StrPrinter
+
+b, h, q, kv = sp.symbols("b h q_idx kv_idx", integer=True)
+
+_ops = {
+    operator.add: lambda x, y: x + y,
+    operator.sub: lambda x, y: x - y,
+    operator.mul: lambda x, y: x * y,
+    operator.floordiv: lambda x, y: sp.floor(x / y),
+    operator.mod: lambda x, y: sp.Mod(x, y),
+    operator.neg: lambda x: -x,
+    operator.ge: sp.Ge,
+    operator.gt: sp.Gt,
+    operator.le: sp.Le,
+    operator.lt: sp.Lt,
+    operator.eq: sp.Eq,
+    operator.ne: sp.Ne,
+    operator.and_: sp.And,
+    operator.or_: sp.Or,
+    operator.invert: sp.Not,
+    torch.logical_and: sp.And,
+    torch.logical_or: sp.Or,
+    torch.logical_not: sp.Not,
+}
+
+# nodes of the mask expressions with closed form tile bounds
+_SUPPORTED = (sp.Symbol, sp.Number, sp.Add, sp.Mul, sp.floor, sp.ceiling, sp.Max, sp.Min,
+              sp.core.relational.Relational, sp.And, sp.Or, sp.Not,
+              sp.logic.boolalg.BooleanTrue, sp.logic.boolalg.BooleanFalse)
+
+
+@dataclass
+class MaskPattern:
+    """
+    kind: "causal", "sliding_window", "prefix_lm", "chunked", "document", "full" or "unknown"
+    kv_start, kv_last: first&last allowed kv_idx of row q_idx, None for unbounded
+    is_causal: kv_idx <= q_idx for every allowed element
+    """
+    kind: str
+    kv_start: Optional[sp.Expr] = None
+    kv_last: Optional[sp.Expr] = None
+    is_causal: bool = False
+
+    def tl_kv_loop_bounds(self, block_M="block_M", block_N="block_N", bx="bx",
+                          batch_idx="bz", head_idx="by"):
+        """
+        (loop start, loop end) in kv blocks of q tile bx, None if the default
+        0 / causal-or-full end is already exact
+        """
+        subs_common = {b: sp.Symbol(batch_idx), h: sp.Symbol(head_idx)}
+        q_first = sp.Symbol(bx) * sp.Symbol(block_M)
+        q_last = (sp.Symbol(bx) + 1) * sp.Symbol(block_M) - 1
+        loop_start = None
+        loop_end = None
+        # bounds are non decreasing in q_idx, tile bounds are at the first and last row
+        if self.kv_start is not None:
+            kv_start = self.kv_start.subs({q: q_first, **subs_common})
+            loop_start = f"T.max({_tl_print(kv_start)}, 0) // {block_N}"
+        if self.kv_last is not None and not (self.is_causal and sp.simplify(self.kv_last - q) == 0):
+            kv_end = self.kv_last.subs({q: q_last, **subs_common}) + 1
+            loop_end = f"T.ceildiv(T.min({_tl_print(kv_end)}, seq_len), {block_N})"
+        return loop_start, loop_end
+
+
+class _TlPrinter(StrPrinter):
+    def _print_Max(self, expr):
+        code = self._print(expr.args[0])
+        for arg in expr.args[1:]:
+            code = f"T.max({code}, {self._print(arg)})"
+        return code
+
+    def _print_Min(self, expr):
+        code = self._print(expr.args[0])
+        for arg in expr.args[1:]:
+            code = f"T.min({code}, {self._print(arg)})"
+        return code
+
+    def _print_floor(self, expr):
+        num, den = sp.fraction(sp.together(expr.args[0]))
+        return f"(({self._print(num)}) // {self._print(den)})"
+
+    def _print_ceiling(self, expr):
+        num, den = sp.fraction(sp.together(expr.args[0]))
+        return f"(({self._print(num)}) + {self._print(den - 1)}) // {self._print(den)}"
+
+
+def _tl_print(expr):
+    return _TlPrinter().doprint(expr)
+
+
+def mask_mod_to_sympy(mask_mod) -> sp.Basic:
+    """
+    sympy boolean expression of mask_mod over b, h, q_idx, kv_idx.
+    indexing a tensor becomes an undefined function of the index, e.g. doc_ids(q_idx)
+    """
+    mask_graph = fx.symbolic_trace(mask_mod)
+    env = {}
+    # custom_fwd_inputs of a runtime mask: custom_fwd_inputs["doc_ids"] -> doc_ids
+    placeholders = iter([b, h, q, kv, sp.Function])
+    for node in mask_graph.graph.nodes:
+        if node.op == "placeholder":
+            env[node.name] = next(placeholders)
+        elif node.op == "get_attr":
+            env[node.name] = sp.Function(node.target)
+        elif node.op == "call_function":
+            args = [env[arg.name] if isinstance(arg, fx.Node) else arg for arg in node.args]
+            if node.target == operator.getitem:
+                idx = args[1]
+                if isinstance(idx, tuple):
+                    idx = [env[i.name] if isinstance(i, fx.Node) else i for i in idx]
+                    env[node.name] = args[0](*idx)
+                else:
+                    env[node.name] = args[0](idx)
+            elif node.target in _ops:
+                env[node.name] = _ops[node.target](*args)
+            else:
+                raise NotImplementedError(f"mask_mod op {node.target} is not supported")
+        elif node.op == "call_method" and node.target == "__getitem__":
+            env[node.name] = env[node.args[0].name](env[node.args[1].name])
+        elif node.op == "output":
+            arg = node.args[0]
+            return sp.sympify(env[arg.name] if isinstance(arg, fx.Node) else arg)
+        else:
+            raise NotImplementedError(f"mask_mod node {node.op} is not supported")
+
+
+def _linear_in_kv(d):
+    """
+    d = a * kv_idx + r, None if d is not linear in kv_idx
+    """
+    a = sp.diff(d, kv)
+    if not a.is_Number or a == 0:
+        return None
+    r = sp.expand(d - a * kv)
+    if r.has(kv):
+        return None
+    return a, r
+
+
+def _kv_range_relational(expr):
+    if isinstance(expr, (sp.LessThan, sp.StrictLessThan)):
+        # d <= 0 -> -d >= 0
+        d = expr.rhs - expr.lhs
+        strict = isinstance(expr, sp.StrictLessThan)
+    else:
+        d = expr.lhs - expr.rhs
+        strict = isinstance(expr, sp.StrictGreaterThan)
+    linear = _linear_in_kv(d)
+    if linear is None:
+        return None, None
+    a, r = linear
+    # a * kv_idx (>|>=) -r
+    bound = -r / a
+    if a > 0:
+        return (sp.floor(bound) + 1 if strict else sp.ceiling(bound)), None
+    return None, (sp.ceiling(bound) - 1 if strict else sp.floor(bound))
+
+
+def _kv_range_eq(expr):
+    d = expr.lhs - expr.rhs
+    linear = _linear_in_kv(d)
+    if linear is not None:
+        a, r = linear
+        return sp.ceiling(-r / a), sp.floor(-r / a)
+    # chunks: floor(kv_idx / c) == f(q_idx) -> [c * f, c * f + c - 1]
+    floors = [f for f in d.atoms(sp.floor) if f.has(kv)]
+    if len(floors) != 1:
+        return None, None
+    chunk = 1 / sp.diff(floors[0].args[0], kv)
+    if not (chunk.is_Integer and chunk > 0) or sp.expand(floors[0].args[0] - kv / chunk) != 0:
+        return None, None
+    y = sp.Dummy("y", integer=True)
+    d = d.subs(floors[0], y)
+    if d.has(kv):
+        return None, None
+    linear = _linear_in_kv(d.subs(y, kv))
+    if linear is None:
+        return None, None
+    a, r = linear
+    start = sp.ceiling(-r / a) * chunk
+    return start, start + chunk - 1
+
+
+def kv_range(expr):
+    """
+    (kv_start, kv_last) of the allowed kv_idx of row q_idx, None for unbounded
+    """
+    if isinstance(expr, sp.And):
+        ranges = [kv_range(arg) for arg in expr.args]
+        starts = [start for start, _ in ranges if start is not None]
+        lasts = [last for _, last in ranges if last is not None]
+        return (sp.Max(*starts) if starts else None), (sp.Min(*lasts) if lasts else None)
+    if isinstance(expr, sp.Or):
+        # hull of the union
+        ranges = [kv_range(arg) for arg in expr.args]
+        starts = [start for start, _ in ranges]
+        lasts = [last for _, last in ranges]
+        return (None if None in starts else sp.Min(*starts)), (None if None in lasts else sp.Max(*lasts))
+    if isinstance(expr, (sp.GreaterThan, sp.StrictGreaterThan, sp.LessThan, sp.StrictLessThan)):
+        return _kv_range_relational(expr)
+    if isinstance(expr, sp.Eq):
+        return _kv_range_eq(expr)
+    # Not, Ne, True and others do not bound kv_idx
+    return None, None
+
+
+def _is_supported(expr):
+    return all(isinstance(node, _SUPPORTED) for node in sp.preorder_traversal(expr))
+
+
+def _direction(expr):
+    """
+    1 if expr is non decreasing in q_idx, -1 if non increasing, 0 if it does
+    not depend on q_idx, None if it is not known
+    """
+    if not expr.has(q):
+        return 0
+    if expr == q:
+        return 1
+    if isinstance(expr, (sp.floor, sp.ceiling)):
+        return _direction(expr.args[0])
+    if isinstance(expr, (sp.Add, sp.Max, sp.Min)):
+        directions = {_direction(arg) for arg in expr.args} - {0}
+        return directions.pop() if len(directions) == 1 and None not in directions else None
+    if isinstance(expr, sp.Mul):
+        # a constant times one factor of q_idx
+        factors = [arg for arg in expr.args if arg.has(q)]
+        coeff = sp.Mul(*[arg for arg in expr.args if not arg.has(q)])
+        if len(factors) != 1 or not coeff.is_Number:
+            return None
+        direction = _direction(factors[0])
+        return None if direction is None else direction * int(sp.sign(coeff))
+    return None
+
+
+def _is_non_decreasing(expr):
+    return _direction(expr) in (0, 1)
+
+
+def _is_le_q(expr):
+    """
+    expr <= q_idx for all b, h, q_idx >= 0
+    """
+    if isinstance(expr, sp.Min):
+        return any(_is_le_q(arg) for arg in expr.args)
+    if isinstance(expr, sp.Max):
+        return all(_is_le_q(arg) for arg in expr.args)
+    nonnegative = {x: sp.Dummy(x.name, integer=True, nonnegative=True) for x in (b, h, q)}
+    return sp.simplify((expr - q).subs(nonnegative)).is_nonpositive is True
+
+
+def analyze_mask_mod(mask_mod) -> MaskPattern:
+    try:
+        expr = mask_mod_to_sympy(mask_mod)
+    except NotImplementedError:
+        return MaskPattern("unknown")
+    if expr is sp.true:
+        return MaskPattern("full")
+    if expr.atoms(sp.core.function.AppliedUndef):
+        return MaskPattern("document")
+    if not _is_supported(expr):
+        return MaskPattern("unknown")
+
+    kv_start, kv_last = kv_range(expr)
+    # tile bounds use the first and last row of the tile
+    if kv_start is not None and not _is_non_decreasing(kv_start):
+        kv_start = None
+    if kv_last is not None and not _is_non_decreasing(kv_last):
+        kv_last = None
+    if kv_start is None and kv_last is None:
+        return MaskPattern("unknown")
+
+    is_causal = kv_last is not None and _is_le_q(kv_last)
+    if expr.has(sp.floor):
+        kind = "chunked"
+    elif kv_last is not None and kv_last.has(sp.Max):
+        kind = "prefix_lm"
+    elif kv_start is not None:
+        kind = "sliding_window"
+    else:
+        kind = "causal"
+    return MaskPattern(kind, kv_start, kv_last, is_causal)
@@ -0,0 +1,396 @@
+"""
+Canonical serialization & structural hash of user attention definitions.
+
+A traced SymbolScalar DAG is stored as its topological node list:
+    {"op": "Mul", "inputs": [0, 2], "shape": ["block_M", "block_N"]}
+leaves are arguments ({"op": "Var", "arg": "scores"}), free Vars or Consts.
+Generated varnames (the _{count} suffixes) are never stored, so the same
+definition always serializes to the same JSON and hash.
+"""
+from .core import SymbolScalar, SymbolicArray, SymbolicTensor, SymbolicConst, CustomIO, topo_sort
+from . import graph
+from .graph import Var, Const
+
+import hashlib
+import importlib
+import json
+from copy import deepcopy
+
+import torch
+import torch.fx as fx
+from torch.fx.node import _get_qualified_name
+
+SERIALIZE_VERSION = 1
+
+_reduce_suffix = {
+    "ReduceSum": "sum",
+    "ReduceMax": "max",
+    "ReduceAbsSum": "abssum",
+}
+
+_leaf_cls = {
+    "SymbolScalar": SymbolScalar,
+    "SymbolicArray": SymbolicArray,
+    "SymbolicTensor": SymbolicTensor,
+}
+
+
+# ---------------- SymbolScalar DAG ----------------
+
+def serialize_dag(outputs, args: dict = None) -> dict:
+    """
+    outputs: SymbolScalar or nested tuple/list/dict of SymbolScalar
+    args: name -> SymbolScalar, leaves that are arguments of the traced function
+    """
+    args = args or {}
+    arg_names = {id(v): k for k, v in args.items()}
+    roots = []
+    _collect(outputs, roots)
+    order = topo_sort(roots)
+    index = {id(node): i for i, node in enumerate(order)}
+
+    nodes = []
+    for node in order:
+        if id(node) in arg_names:
+            nodes.append({"op": "Var", "arg": arg_names[id(node)]})
+        elif isinstance(node.code, Const):
+            nodes.append({"op": "Const", "value": node.code.value})
+        elif isinstance(node.code, Var):
+            nodes.append(_serialize_leaf(node))
+        else:
+            nodes.append({
+                "op": node.code.type,
+                "inputs": [index[id(prev)] for prev in node.prev],
+                "shape": list(node.shape_idx),
+            })
+    return {
+        "nodes": nodes,
+        "outputs": _encode(outputs, index),
+    }
+
+
+def replay_dag(data: dict, args: dict = None):
+    """
+    rebuild the traced DAG on new argument leaves, returns the outputs
+    with the same structure as the serialized function
+    """
+    args = args or {}
+    built = []
+    for spec in data["nodes"]:
+        op = spec["op"]
+        if op == "Var":
+            if "arg" in spec:
+                built.append(args[spec["arg"]])
+            else:
+                built.append(_deserialize_leaf(spec))
+        elif op == "Const":
+            built.append(SymbolicConst(spec["value"]))
+        else:
+            prev = [built[i] for i in spec["inputs"]]
+            built.append(prev[0].op(getattr(graph, op), list(prev[1:]),
+                                    shape_idx=list(spec["shape"]),
+                                    varname_suffix=_reduce_suffix.get(op)))
+    return _decode(data["outputs"], built)
+
+
+def _serialize_leaf(node: SymbolScalar) -> dict:
+    cls_name = type(node).__name__
+    if cls_name not in _leaf_cls:
+        cls_name = "SymbolScalar"
+    return {
+        "op": "Var",
+        "name": node.varname,
+        "value": node.code.name,
+        "cls": cls_name,
+        "shape": list(node.shape_idx),
+        "require_grad": node.require_grad,
+        "dtype": node.dtype,
+    }
+
+
+def _deserialize_leaf(spec: dict) -> SymbolScalar:
+    cls = _leaf_cls[spec["cls"]]
+    node = cls.__new__(cls)
+    SymbolScalar.__init__(node, spec["name"], Var(spec["value"]), prev=[],
+                          shape_idx=list(spec["shape"]),
+                          require_grad=spec["require_grad"], dtype=spec["dtype"])
+    return node
+
+
+def _collect(outputs, roots):
+    if isinstance(outputs, SymbolScalar):
+        roots.append(outputs)
+    elif isinstance(outputs, dict):
+        for v in outputs.values():
+            _collect(v, roots)
+    elif isinstance(outputs, (tuple, list)):
+        for v in outputs:
+            _collect(v, roots)
+
+
+def _encode(outputs, index):
+    # dict keeps insertion order (final_rowscales order is the kernel output order)
+    if isinstance(outputs, SymbolScalar):
+        return {"node": index[id(outputs)]}
+    if isinstance(outputs, dict):
+        return {"dict": [[k, _encode(v, index)] for k, v in outputs.items()]}
+    if isinstance(outputs, (tuple, list)):
+        return {"tuple": [_encode(v, index) for v in outputs]}
+    if outputs is None:
+        return None
+    raise TypeError(f"can not serialize output {outputs}")
+
+
+def _decode(data, built):
+    if data is None:
+        return None
+    if "node" in data:
+        return built[data["node"]]
+    if "dict" in data:
+        return {k: _decode(v, built) for k, v in data["dict"]}
+    return tuple(_decode(v, built) for v in data["tuple"])
+
+
+def _leaf_dict(leaves: dict) -> list:
+    return [[k, _serialize_leaf(v)] for k, v in leaves.items()]
+
+
+def _leaf_dict_load(data: list) -> dict:
+    return {k: _deserialize_leaf(v) for k, v in data}
+
+
+# ---------------- fx mask graph ----------------
+
+def serialize_fx_graph(gm: fx.GraphModule) -> dict:
+    """
+    placeholders are stored by position, call targets by qualified name
+    """
+    index = {}
+    nodes = []
+    num_placeholder = 0
+
+    def encode_arg(arg):
+        if isinstance(arg, fx.Node):
+            return {"node": index[arg]}
+        if isinstance(arg, (tuple, list)):
+            return {"tuple": [encode_arg(a) for a in arg]}
+        if isinstance(arg, (bool, int, float, str)) or arg is None:
+            return {"value": arg}
+        raise TypeError(f"can not serialize mask arg {arg}")
+
+    for node in gm.graph.nodes:
+        index[node] = len(nodes)
+        if node.op == "placeholder":
+            nodes.append({"op": "placeholder", "index": num_placeholder})
+            num_placeholder += 1
+            continue
+        if node.op == "call_function":
+            target = _get_qualified_name(node.target)
+        elif node.op in ("call_method", "output"):
+            target = str(node.target)
+        else:
+            raise NotImplementedError(
+                f"mask_mod op {node.op} is not supported by serialization")
+        nodes.append({
+            "op": node.op,
+            "target": target,
+            "args": [encode_arg(a) for a in node.args],
+            "kwargs": [[k, encode_arg(v)] for k, v in sorted(node.kwargs.items())],
+        })
+    return {"nodes": nodes}
+
+
+def deserialize_fx_graph(data: dict,
+                         arg_names=("b", "h", "q_idx", "kv_idx")) -> fx.GraphModule:
+    fx_graph = fx.Graph()
+    built = []
+
+    def decode_arg(arg):
+        if "node" in arg:
+            return built[arg["node"]]
+        if "tuple" in arg:
+            return tuple(decode_arg(a) for a in arg["tuple"])
+        return arg["value"]
+
+    for spec in data["nodes"]:
+        op = spec["op"]
+        if op == "placeholder":
+            i = spec["index"]
+            name = arg_names[i] if i < len(arg_names) else f"arg{i}"
+            built.append(fx_graph.placeholder(name))
+            continue
+        args = tuple(decode_arg(a) for a in spec["args"])
+        kwargs = {k: decode_arg(v) for k, v in spec["kwargs"]}
+        if op == "call_function":
+            node = fx_graph.call_function(_resolve(spec["target"]), args, kwargs)
+        elif op == "call_method":
+            node = fx_graph.call_method(spec["target"], args, kwargs)
+        else:
+            node = fx_graph.output(args[0])
+        built.append(node)
+    return fx.GraphModule(torch.nn.Module(), fx_graph)
+
+
+def _resolve(qualified_name: str):
+    module_name, _, attr = qualified_name.rpartition(".")
+    if module_name == "operator":
+        module_name = "_operator"
+    obj = importlib.import_module(module_name)
+    for name in attr.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+
+# ---------------- attention definition ----------------
+
+def _trace_score_mod(score_mod, custom_fwd_inputs: CustomIO):
+    custom_fwd_inputs = deepcopy(custom_fwd_inputs)
+    args = _index_args()
+    args["scores"] = SymbolScalar("scores", Var("scores"), shape_idx=["block_M", "block_N"])
+    for k, v in custom_fwd_inputs.input_tensors.items():
+        args[f"custom_fwd_inputs.{k}"] = v
+    scores_new = score_mod(args["scores"], custom_fwd_inputs,
+                           args["b"], args["h"], args["q_idx"], args["kv_idx"])
+    return serialize_dag(scores_new, args)
+
+
+def _index_args():
+    return {
+        "b": SymbolScalar("b", Var("b")),
+        "h": SymbolScalar("h", Var("h")),
+        "q_idx": SymbolScalar("q_idx", Var("q_idx")),
+        "kv_idx": SymbolScalar("kv_idx", Var("kv_idx")),
+    }
+
+
+def _rowscale_args(prefix, rowscales):
+    return {f"{prefix}.{k}": v for k, v in rowscales.items()}
+
+
+def _trace_online_func(online_func):
+    online_func = deepcopy(online_func)
+    data = {
+        "online_rowscales": _leaf_dict(online_func.online_rowscales),
+        "final_rowscales": _leaf_dict(online_func.final_rowscales),
+    }
+
+    # online_fwd
+    online_rowscales = deepcopy(online_func.online_rowscales)
+    args = _index_args()
+    args["scores"] = SymbolicArray("scores", Var("scores"), shape_idx=["block_M", "block_N"])
+    args.update(_rowscale_args("online_rowscales", online_rowscales))
+    outputs = online_func.online_fwd(args["scores"], online_rowscales,
+                                     args["b"], args["h"], args["q_idx"])
+    data["online_fwd"] = serialize_dag(outputs, args)
+
+    # online_fwd_epilogue
+    online_rowscales = deepcopy(online_func.online_rowscales)
+    args = _index_args()
+    args["o"] = SymbolicArray("acc_o", Var("acc_o"), shape_idx=["block_M", "dimv"])
+    args.update(_rowscale_args("online_rowscales", online_rowscales))
+    outputs = online_func.online_fwd_epilogue(args["o"], online_rowscales,
+                                              args["b"], args["h"], args["q_idx"])
+    data["online_fwd_epilogue"] = serialize_dag(outputs, args)
+
+    # forward & backward recompute
+    final_rowscales = {k: SymbolScalar(f"{k}_shared", Var(k), shape_idx=["1", "block_N"])
+                       for k in online_func.final_rowscales.keys()}
+    args = _index_args()
+    args["scores"] = SymbolScalar("qkT", Var("qkT"), shape_idx=["block_M", "block_N"])
+    args.update(_rowscale_args("final_rowscales", final_rowscales))
+    outputs = online_func.forward(args["scores"], final_rowscales,
+                                  args["b"], args["h"], args["q_idx"], args["kv_idx"])
+    data["forward"] = serialize_dag(outputs, args)
+
+    args["scores"].clear_codegen()
+    args["dp"] = SymbolScalar("dsT", Var("dsT"), shape_idx=["block_M", "block_N"])
+    args["doosum"] = SymbolScalar("doosum_shared", Var("doosum_shared"), shape_idx=["1", "block_N"])
+    outputs = online_func.backward(args["dp"], args["scores"], final_rowscales, args["doosum"],
+                                   args["b"], args["h"], args["q_idx"], args["kv_idx"])
+    data["backward"] = serialize_dag(outputs, args)
+    return data
+
+
+def serialize_attention(score_mod, mask_mod, online_func,
+                        custom_fwd_inputs: CustomIO = None, mask_value="-inf") -> dict:
+    """
+    canonical form of an attention definition, user objects are traced on copies
+    """
+    if custom_fwd_inputs is None:
+        custom_fwd_inputs = CustomIO()
+    data = {
+        "version": SERIALIZE_VERSION,
+        "custom_fwd_inputs": [[k, list(v.shape_idx)] for k, v in custom_fwd_inputs.input_tensors.items()],
+        "score_mod": _trace_score_mod(score_mod, custom_fwd_inputs) if score_mod is not None else None,
+        "mask_mod": serialize_fx_graph(fx.symbolic_trace(mask_mod)) if mask_mod is not None else None,
+        "online_func": _trace_online_func(online_func) if online_func is not None else None,
+        "mask_value": mask_value,
+    }
+    return data
+
+
+class GraphOnlineFunc:
+    """
+    OnlineFunc replayed from its serialized graphs
+    """
+
+    def __init__(self, data: dict):
+        self._data = data
+        self.online_rowscales = _leaf_dict_load(data["online_rowscales"])
+        self.final_rowscales = _leaf_dict_load(data["final_rowscales"])
+        self.external_fwd_tensors = CustomIO()
+        self.doosum_rowscales = SymbolicArray(
+            "doosum", Var("doosum"), shape_idx=["block_M"])
+
+    def online_fwd(self, scores, online_rowscales, b, h, q_idx):
+        args = {"scores": scores, "b": b, "h": h, "q_idx": q_idx}
+        args.update(_rowscale_args("online_rowscales", online_rowscales))
+        return replay_dag(self._data["online_fwd"], args)
+
+    def online_fwd_epilogue(self, o, online_rowscales, b, h, q_idx):
+        args = {"o": o, "b": b, "h": h, "q_idx": q_idx}
+        args.update(_rowscale_args("online_rowscales", online_rowscales))
+        return replay_dag(self._data["online_fwd_epilogue"], args)
+
+    def forward(self, scores, final_rowscales, b, h, q_idx, kv_idx):
+        args = {"scores": scores, "b": b, "h": h, "q_idx": q_idx, "kv_idx": kv_idx}
+        args.update(_rowscale_args("final_rowscales", final_rowscales))
+        return replay_dag(self._data["forward"], args)
+
+    def backward(self, dp, scores, final_rowscales, doosum_rowscales, b, h, q_idx, kv_idx):
+        args = {"dp": dp, "scores": scores, "doosum": doosum_rowscales,
+                "b": b, "h": h, "q_idx": q_idx, "kv_idx": kv_idx}
+        args.update(_rowscale_args("final_rowscales", final_rowscales))
+        return replay_dag(self._data["backward"], args)
+
+
+def deserialize_attention(data: dict):
+    """
+    return score_mod, mask_mod, online_func, custom_fwd_inputs that lower
+    to the same kernel as the serialized definition
+    """
+    if data["version"] != SERIALIZE_VERSION:
+        raise ValueError(f"unsupported serialize version {data['version']}")
+    custom_fwd_inputs = CustomIO({k: tuple(shape) for k, shape in data["custom_fwd_inputs"]})
+
+    score_mod = None
+    if data["score_mod"] is not None:
+        score_mod_data = data["score_mod"]
+
+        def score_mod(score, custom_fwd_inputs, b, h, q_idx, kv_idx):
+            args = {"scores": score, "b": b, "h": h, "q_idx": q_idx, "kv_idx": kv_idx}
+            for k, v in custom_fwd_inputs.input_tensors.items():
+                args[f"custom_fwd_inputs.{k}"] = v
+            return replay_dag(score_mod_data, args)
+
+    mask_mod = deserialize_fx_graph(data["mask_mod"]) if data["mask_mod"] is not None else None
+    online_func = GraphOnlineFunc(data["online_func"]) if data["online_func"] is not None else None
+    return score_mod, mask_mod, online_func, custom_fwd_inputs
+
+
+def dumps(data: dict) -> str:
+    return json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+
+def structural_hash(data: dict) -> str:
+    return hashlib.sha256(dumps(data).encode()).hexdigest()
@@ -5,13 +5,22 @@ class IndentedCode:
     def __init__(self, indent=0):
 
         self.indent = indent
-        self.code = ""
+        # lines are joined lazily, repeated str concat is quadratic for large graphs
+        self.lines = []
+
+    @property
+    def code(self):
+        return "".join(self.lines)
+
+    @code.setter
+    def code(self, code):
+        self.lines = [code] if code else []
 
     def __str__(self):
         return self.code
 
     def add_line(self, line):
-        self.code += "    " * self.indent + line + "\n"
+        self.lines.append("    " * self.indent + line + "\n")
 
     def __iadd__(self, other):
         assert (isinstance(other, IndentedCode) or isinstance(other, str))
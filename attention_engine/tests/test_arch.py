@@ -0,0 +1,61 @@
+import json
+import math
+import pytest
+import torch
+from types import SimpleNamespace
+from core.utils import meta_tensor
+from autotuner.arch import A100, H100, RTX4090, VirtualArch, VIRTUAL_ARCHS, load_arch, save_arch, \
+    arch_from_device_properties
+from autotuner.cost_model import AttnProblem, estimate_latency, prune_configs
+from autotuner.decider import decider
+
+qkv_meta = [meta_tensor(2, 1024, 8, 128, dtype=torch.float16)] * 3
+
+
+@pytest.mark.parametrize("arch", [A100(), H100(), RTX4090()] + [load_arch(name) for name in VIRTUAL_ARCHS])
+def test_arch_schema(arch):
+    assert arch.validate() is arch
+    assert load_arch(arch.name).to_dict() == arch.to_dict()
+
+
+def test_virtual_archs(tmp_path):
+    assert {"L40S", "H200", "B200"} <= set(VIRTUAL_ARCHS)
+    problem = AttnProblem.from_qkv_meta(qkv_meta)
+    config = {"block_M": 128, "block_N": 64, "thread_num": 128, "num_stages": 2}
+    latencies = {name: estimate_latency(config, problem, load_arch(name)) for name in ["H100", "H200", "B200"]}
+    assert all(latency < math.inf for latency in latencies.values())
+    assert latencies["B200"] < latencies["H200"] <= latencies["H100"]
+    # config generators run for archs this machine does not have
+    for name in ["L40S", "B200"]:
+        _, configs = decider(qkv_meta, load_arch(name))
+        assert configs and prune_configs(configs, problem, load_arch(name), 4)
+
+    save_arch(load_arch("B200"), tmp_path / "b200.json")
+    assert load_arch(str(tmp_path / "b200.json")).to_dict() == load_arch("B200").to_dict()
+
+
+def test_arch_validation(tmp_path):
+    fields = load_arch("L40S").to_dict()
+    with pytest.raises(ValueError, match="smem_cap"):
+        VirtualArch({k: v for k, v in fields.items() if k != "smem_cap"})
+    with pytest.raises(ValueError, match="mma_primitive"):
+        VirtualArch({**fields, "mma_primitive": [16, 8]})
+    with pytest.raises(ValueError, match="compute_max_core"):
+        VirtualArch({**fields, "compute_max_core": "142"})
+    with pytest.raises(ValueError, match="unknown"):
+        VirtualArch({**fields, "smem_per_sm": 0})
+
+
+def test_arch_from_device_properties():
+    props = SimpleNamespace(name="NVIDIA L40S", major=8, minor=9, multi_processor_count=142,
+                            shared_memory_per_block_optin=101376, regs_per_multiprocessor=65536, warp_size=32,
+                            memory_clock_rate=9001000, memory_bus_width=384)
+    arch = arch_from_device_properties(props)
+    assert (arch.name, arch.compute_max_core, arch.smem_cap, arch.compute_capability) == ("NVIDIA L40S", 142, 101376, "89")
+    assert arch.bandwidth[0] == 864
+    assert arch.mma_primitive == RTX4090().mma_primitive
+    assert math.isclose(arch.tensor_core_tflops, RTX4090().tensor_core_tflops * 142 / 128, rel_tol=1e-3)
+    # unknown capability: unreported fields from the nearest lower arch, others from the device
+    props = SimpleNamespace(name="B200", major=10, minor=0, multi_processor_count=148)
+    arch = arch_from_device_properties(props)
+    assert (arch.compute_capability, arch.smem_cap, arch.threads_per_mma) == ("100", H100().smem_cap, 128)
@@ -0,0 +1,81 @@
+import torch
+from core.transform.block_mask_cache import BlockMaskCache
+from core.transform.core import create_block_mask
+
+B, H, S = 2, 4, 512
+Q_BLOCK_SIZE = 128
+K_BLOCK_SIZE = 64
+
+doc_ids = torch.arange(S) // 100
+
+
+def causal_mask(b, h, q_idx, kv_idx):
+    return q_idx >= kv_idx
+
+
+def causal_mask_copy(b, h, q_idx, kv_idx):
+    return q_idx >= kv_idx
+
+
+def sliding_window_mask(b, h, q_idx, kv_idx):
+    return (q_idx >= kv_idx) & (q_idx - kv_idx < 100 * (h + 1))
+
+
+def document_mask(b, h, q_idx, kv_idx):
+    return doc_ids[q_idx] == doc_ids[kv_idx]
+
+
+def test_block_mask_cache_hit():
+    cache = BlockMaskCache()
+    block_mask = cache.get_or_create(causal_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    assert torch.equal(block_mask, create_block_mask(causal_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE))
+    # same structure, other function
+    assert cache.get_or_create(causal_mask_copy, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE) is block_mask
+    # other shape, block size or kinds
+    cache.get_or_create(causal_mask, B, H, 2 * S, 2 * S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    cache.get_or_create(causal_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, Q_BLOCK_SIZE)
+    cache.get_or_create(causal_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE, separate_full_blocks=True)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 4, 4)
+
+
+def test_block_mask_cache_eviction():
+    # sliding_window_mask is independent of b, block masks are [1, H, 4, 8] int8, 128 bytes
+    cache = BlockMaskCache(max_bytes=300)
+    first = cache.get_or_create(sliding_window_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    cache.get_or_create(sliding_window_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE, True)
+    # hit moves the first entry to the end
+    assert cache.get_or_create(sliding_window_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE) is first
+    # [1, H, 4, 4], 64 bytes
+    cache.get_or_create(sliding_window_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, Q_BLOCK_SIZE)
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["bytes"] <= 300
+    assert cache.get_or_create(sliding_window_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE) is first
+
+
+def test_block_mask_cache_unused_batch_head():
+    cache = BlockMaskCache()
+    # causal_mask ignores b and h, one [1, 1, ...] entry for every batch size and head count
+    block_mask = cache.get_or_create(causal_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    assert block_mask.shape[:2] == (1, 1)
+    assert cache.get_or_create(causal_mask, 2 * B, 1, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE) is block_mask
+    # sliding_window_mask reads h
+    cache.get_or_create(sliding_window_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    cache.get_or_create(sliding_window_mask, B, 2 * H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 3, 3)
+
+
+def test_block_mask_cache_uncacheable():
+    cache = BlockMaskCache()
+    cache.get_or_create(document_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    cache.get_or_create(document_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (0, 2, 0)
+
+
+if __name__ == "__main__":
+    test_block_mask_cache_hit()
+    test_block_mask_cache_eviction()
+    test_block_mask_cache_unused_batch_head()
+    test_block_mask_cache_uncacheable()
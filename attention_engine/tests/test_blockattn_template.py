@@ -0,0 +1,85 @@
+import sys
+import types
+import torch
+from attn_engine import AttentionEngine
+from core.transform.core import CustomIO
+from core.utils import meta_tensor
+from test_torch_backend import score_mod_softmax, OnlineSoftmax
+
+B, H, S, D = 2, 2, 512, 64
+
+
+def document_mask(b, h, q_idx, kv_idx, custom_fwd_inputs):
+    doc_ids = custom_fwd_inputs["doc_ids"]
+    return doc_ids[b, q_idx] == doc_ids[b, kv_idx]
+
+
+def packed_doc_ids(doc_len):
+    return (torch.arange(S) // doc_len).repeat(B, 1).float()
+
+
+def fake_tilelang(monkeypatch):
+    """
+    tilelang whose kernels return zeros, compiles records the compile args of tl.profiler.cached
+    """
+    compiles = []
+
+    def cached(func, out_idx, *args):
+        compiles.append((func.__name__, args))
+
+        def mod(*inputs):
+            outputs = [torch.zeros_like(inputs[0]) for _ in out_idx]
+            return outputs[0] if len(outputs) == 1 else tuple(outputs)
+        return mod
+
+    def compile(*args, **kargs):
+        raise AssertionError("kernels are compiled through tl.profiler.cached")
+
+    tl = types.ModuleType("tilelang")
+    tl.profiler = types.SimpleNamespace(cached=cached)
+    tl.compile = compile
+    tl.language = types.ModuleType("tilelang.language")
+    monkeypatch.setitem(sys.modules, "tilelang", tl)
+    monkeypatch.setitem(sys.modules, "tilelang.language", tl.language)
+    return compiles
+
+
+def test_dynamic_mask_compiled_once(monkeypatch):
+    compiles = fake_tilelang(monkeypatch)
+    monkeypatch.setattr(AttentionEngine, "compile_cache_size", 0)
+    mod = AttentionEngine(
+        [meta_tensor(B, H, S, D, dtype=torch.float16)] * 3, CustomIO({"doc_ids": (B, S)}),
+        score_mod=score_mod_softmax, mask_mod=document_mask,
+        online_func=OnlineSoftmax(), backend="tl", infer_mask=True)
+    q, k, v = [torch.randn(B, S, H, D, dtype=torch.float16, requires_grad=True) for _ in range(3)]
+    # a batch of one long document, then a batch of short documents
+    for doc_len in [S, 64]:
+        mod(q, k, v, packed_doc_ids(doc_len)).sum().backward()
+    kernels = {name for name, _ in compiles}
+    assert kernels == {"kernel", "flashattn_bwd", "flashattn_bwd_preprocess", "flashattn_bwd_postprocess"}
+    for name in kernels:
+        assert len({args for func, args in compiles if func == name}) == 1, name
+
+
+def window_mask(b, h, q_idx, kv_idx):
+    return (q_idx >= kv_idx) & (q_idx - kv_idx < 64)
+
+
+def test_block_index_compiled_once(monkeypatch):
+    compiles = fake_tilelang(monkeypatch)
+    monkeypatch.setattr(AttentionEngine, "compile_cache_size", 0)
+    seq_len = 2048
+    mod = AttentionEngine(
+        [meta_tensor(B, H, seq_len, D, dtype=torch.float16)] * 3, CustomIO(),
+        score_mod=score_mod_softmax, mask_mod=window_mask,
+        online_func=OnlineSoftmax(), backend="tl", infer_mask=True)
+    # sparse enough for the csr loop of the block attention template
+    assert "KVIndices" in mod.tl_code and "BlockSparseMask" not in mod.tl_code
+    q, k, v = [torch.randn(B, seq_len, H, D, dtype=torch.float16) for _ in range(3)]
+    for _ in range(2):
+        mod(q, k, v)
+    fwd_args = {args for func, args in compiles if func == "kernel"}
+    assert len(fwd_args) == 1
+    # static index width, every kv block of a row
+    num_kv_blocks = mod.block_mask[0].kv_indices.shape[-1]
+    assert fwd_args.pop()[5] == num_kv_blocks
@@ -1,4 +1,7 @@
+import torch
 from core.transform.core import create_block_mask, is_causal_mask, is_less_causal_mask
+from core.transform.core import create_mask, _convert_mask_to_block_mask, mask_mod_uses_batch_head, create_block_idx, \
+    classify_block_mask, create_block_idx_bwd
 # mask on attention score
 def causal_mask(b, h, q_idx, kv_idx):
     return q_idx >= kv_idx
@@ -25,3 +28,118 @@ test_mask(causal_mask)
 test_mask(causal_mask_1)
 test_mask(causal_mask_2)
 
+
+
+def sliding_window_mask(b, h, q_idx, kv_idx):
+    return (q_idx >= kv_idx) & (q_idx - kv_idx < 100 * (h + 1) + b)
+
+
+def dense_block_mask(mask_mod, B, H, QLen, KVLen, Q_BLOCK_SIZE, KV_BLOCK_SIZE):
+    mask_tensor = create_mask(mask_mod, B, H, QLen, KVLen, "cpu")
+    block_mask, _ = _convert_mask_to_block_mask(mask_tensor, Q_BLOCK_SIZE, KV_BLOCK_SIZE)
+    return block_mask
+
+
+def test_block_mask_strips():
+    for mask_mod in [causal_mask, causal_mask_2, sliding_window_mask]:
+        for QLen, KVLen in [(512, 512), (300, 200), (100, 700)]:
+            block_mask = create_block_mask(
+                mask_mod, B, H, QLen, KVLen, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE)
+            ref = dense_block_mask(mask_mod, B, H, QLen, KVLen, Q_BLOCK_SIZE, K_BLOCK_SIZE)
+            assert block_mask.dtype == ref.dtype
+            assert torch.equal(block_mask.expand_as(ref), ref)
+
+
+def head_mask(b, h, q_idx, kv_idx):
+    return q_idx - kv_idx < 64 * (h + 1)
+
+
+def test_block_mask_broadcast():
+    assert mask_mod_uses_batch_head(causal_mask) == (False, False)
+    assert mask_mod_uses_batch_head(head_mask) == (False, True)
+    assert mask_mod_uses_batch_head(sliding_window_mask) == (True, True)
+    assert create_block_mask(causal_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE).shape == \
+        (1, 1, S // Q_BLOCK_SIZE, S // K_BLOCK_SIZE)
+    assert create_block_mask(head_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE).shape == \
+        (1, H, S // Q_BLOCK_SIZE, S // K_BLOCK_SIZE)
+    assert create_block_mask(sliding_window_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE).shape == \
+        (B, H, S // Q_BLOCK_SIZE, S // K_BLOCK_SIZE)
+
+
+def test_block_mask_full_blocks():
+    for mask_mod in [causal_mask, sliding_window_mask]:
+        block_mask = create_block_mask(mask_mod, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE,
+                                       separate_full_blocks=True)
+        mask_tensor = create_mask(mask_mod, B, H, S, S, "cpu")
+        partial, full = _convert_mask_to_block_mask(
+            mask_tensor, Q_BLOCK_SIZE, K_BLOCK_SIZE, separate_full_blocks=True)
+        assert block_mask.dtype == torch.int8
+        assert torch.equal(block_mask.expand_as(partial), partial + 2 * full)
+    # causal: blocks below the diagonal are full
+    block_mask = create_block_mask(causal_mask, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE,
+                                   separate_full_blocks=True)
+    assert block_mask[0, 0, 1, 0] == 2 and block_mask[0, 0, 1, 2] == 1 and block_mask[0, 0, 1, 4] == 0
+
+
+def test_block_idx():
+    for mask_mod in [causal_mask_2, sliding_window_mask]:
+        block_mask = create_block_mask(mask_mod, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE,
+                                       separate_full_blocks=True)
+        block_idx = create_block_idx(mask_mod, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE)
+        assert block_idx.kv_indices.dtype == torch.int32
+        # static width, independent of the longest row
+        assert block_idx.kv_indices.shape == block_mask.shape
+        assert torch.equal(block_idx.kv_num_blocks, (block_mask != 0).sum(dim=-1, dtype=torch.int32))
+        # scatter the listed blocks back to a dense block mask
+        dense = torch.zeros_like(block_mask)
+        for b, h, m in torch.nonzero(torch.ones_like(block_idx.kv_num_blocks)).tolist():
+            n = block_idx.kv_num_blocks[b, h, m]
+            cols = block_idx.kv_indices[b, h, m, :n].long()
+            assert torch.all(cols[1:] > cols[:-1])
+            dense[b, h, m, cols] = block_idx.kv_kinds[b, h, m, :n]
+        assert torch.equal(dense, block_mask)
+
+
+def prefix_empty_mask(b, h, q_idx, kv_idx):
+    # first q block attends nothing, the rest attends two disjoint ranges
+    return (q_idx >= 128) & ((kv_idx < 64) | ((kv_idx >= 256) & (kv_idx < 320)))
+
+
+def test_classify_block_mask():
+    expected = {
+        # is_causal, is_less_causal, max_kv_blocks, empty_rows
+        # of the [1, 1, ...] block mask when batch/head are unused
+        causal_mask: (True, True, 8, 0),
+        causal_mask_2: (False, True, 6, 1),
+        sliding_window_mask: (False, True, 8, 0),
+        prefix_empty_mask: (False, False, 2, 1),
+    }
+    for mask_mod, values in expected.items():
+        block_mask = create_block_mask(mask_mod, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE,
+                                       separate_full_blocks=True)
+        info = classify_block_mask(block_mask, Q_BLOCK_SIZE, K_BLOCK_SIZE)
+        assert (info.is_causal, info.is_less_causal, info.max_kv_blocks, info.empty_rows) == values, \
+            mask_mod.__name__
+        assert info.is_causal == is_causal_mask(block_mask, Q_BLOCK_SIZE, K_BLOCK_SIZE)
+        assert info.is_less_causal == is_less_causal_mask(block_mask, Q_BLOCK_SIZE, K_BLOCK_SIZE)
+        assert abs(info.density - (block_mask != 0).double().mean().item()) < 1e-6
+        assert abs(info.full_density - (block_mask == 2).double().mean().item()) < 1e-6
+
+
+def test_block_idx_bwd():
+    # bwd tiles: 64 q rows, 128 kv rows
+    for mask_mod in [causal_mask_2, sliding_window_mask, prefix_empty_mask]:
+        block_idx = create_block_idx_bwd(mask_mod, B, H, S, S, "cpu", 64, 128)
+        block_mask = create_block_mask(mask_mod, B, H, S, S, "cpu", 64, 128, separate_full_blocks=True)
+        # rows are kv blocks, entries are their nonzero q blocks
+        assert block_idx.kv_num_blocks.shape == block_mask.shape[:2] + (S // 128,)
+        for b in range(block_mask.shape[0]):
+            for h in range(block_mask.shape[1]):
+                for kv_block in range(S // 128):
+                    num_blocks = int(block_idx.kv_num_blocks[b, h, kv_block])
+                    q_blocks = block_idx.kv_indices[b, h, kv_block, :num_blocks]
+                    column = block_mask[b, h, :, kv_block]
+                    assert torch.equal(q_blocks.long(), torch.nonzero(column).flatten())
+                    assert torch.equal(block_idx.kv_kinds[b, h, kv_block, :num_blocks], column[q_blocks.long()])
+        # work of bwd is the number of nonzero blocks
+        assert int(block_idx.kv_num_blocks.sum()) == int((block_mask != 0).sum())
@@ -0,0 +1,73 @@
+import itertools
+import torch
+from core.utils import meta_tensor
+from autotuner.arch import A100, H100
+from autotuner.config_space import ConfigSpace
+from autotuner.decider import attn_fwd_space, decider, memory_usage, fits_memory, MAX_BLOCK
+from core.lower.lower import TunnerOutput, decide_fwd_tile
+
+
+def test_config_space():
+    space = ConfigSpace({
+        "block_M": [32, 64, 128],
+        "mem_level": [[1, 0], [1, 1]],
+        "num_threads": [128, 256],
+    })
+    space.add_derived("smem", lambda c: c["block_M"] * 64 * c["mem_level"][..., 1], integer=True)
+    space.add_constraint("smem", lambda c: c["smem"] <= 4096)
+    space.add_constraint("warps", lambda c: c["block_M"] % (c["num_threads"] // 128 * 64) == 0)
+    expected = [{"block_M": bm, "mem_level": mem, "num_threads": nt, "smem": bm * 64 * mem[1]}
+                for bm, mem, nt in itertools.product([32, 64, 128], [[1, 0], [1, 1]], [128, 256])
+                if bm * 64 * mem[1] <= 4096 and bm % (nt // 128 * 64) == 0]
+    assert space.size == 12
+    assert space.configs() == expected
+    assert all(isinstance(config["smem"], int) for config in expected)
+    assert space.counts() == {"smem": 2, "warps": 6}
+    assert ConfigSpace({"block_M": []}).configs() == []
+
+
+def test_decider_matches_loop():
+    qkv_meta = [meta_tensor(2, 192, 8, 96, dtype=torch.float16)] * 2 + [meta_tensor(2, 192, 8, 128, dtype=torch.float16)]
+    for arch in [H100(), A100()]:
+        space = attn_fwd_space(qkv_meta, arch, num_score_fragments=2)
+        expected = []
+        for bm, bn, bk, qk_mem, acco_mem, nt, stage in itertools.product(*space.axes.values()):
+            shared_mem, reg_num = memory_usage(bm, bn, bk, 128, qk_mem, acco_mem, nt, stage, torch.float16, 2)
+            # the model get_configs of the tl template prunes by
+            if fits_memory(shared_mem, reg_num, nt, arch) and bm % ((nt / arch.threads_per_mma) * arch.mma_primitive[0]) == 0:
+                expected.append((bm, bn, bk, qk_mem, acco_mem, nt, stage, shared_mem, reg_num))
+        _, configs = decider(qkv_meta, arch, num_score_fragments=2)
+        assert [tuple(config.values()) for config in configs] == expected
+
+
+def test_decider_block_cap():
+    qkv_meta = [meta_tensor(1, 32768, 16, 128, dtype=torch.float16)] * 3
+    space = attn_fwd_space(qkv_meta, A100())
+    assert max(space.axes["block_M"]) == MAX_BLOCK and max(space.axes["block_N"]) == MAX_BLOCK
+    _, configs = decider(qkv_meta, A100())
+    assert configs and all(config["block_M"] <= MAX_BLOCK for config in configs)
+
+
+def test_decide_fwd_tile():
+    arch = H100()
+    # the default tile fits with one live scores fragment
+    tile = decide_fwd_tile(TunnerOutput(num_score_fragments="1"), arch, 4, 16, 4096, 128, 128, "float16")
+    assert (tile.block_M, tile.block_N, tile.stages, tile.thread_num) == ("128", "128", "2", "256")
+    # 3 live fragments of 128x128 spill the registers of 256 threads
+    tile = decide_fwd_tile(TunnerOutput(num_score_fragments="3"), arch, 4, 16, 4096, 128, 128, "float16")
+    assert (tile.block_M, tile.block_N) != ("128", "128")
+    _, reg_num = memory_usage(int(tile.block_M), int(tile.block_N), 128, 128, [1, 0], [1, 0],
+                              int(tile.thread_num), int(tile.stages), torch.float16, 3)
+    assert reg_num <= arch.register_per_thread
+
+
+def test_lower_tl_device():
+    from core.lower.lower import lower_tl
+    from core.transform.core import CustomIO
+    from test_torch_backend import score_mod_softmax, OnlineSoftmax
+    code, _ = lower_tl(score_mod_softmax, None, OnlineSoftmax(), CustomIO(), 1, 2, 256, 64, 64, "float16", "-inf",
+                       hardware_meta=A100())
+    # get_configs prunes the tuned tiles for the device decider chose the default tile for
+    assert f"TUNE_DEVICE = {A100().to_dict()!r}" in code
+    code, _ = lower_tl(score_mod_softmax, None, OnlineSoftmax(), CustomIO(), 1, 2, 256, 64, 64, "float16", "-inf")
+    assert "TUNE_DEVICE = None" in code
@@ -0,0 +1,85 @@
+import math
+import torch
+from core.utils import meta_tensor
+from autotuner.arch import H100
+from autotuner.decider import decider
+from autotuner.cost_model import AttnProblem, estimate_latency, rank_configs, prune_configs, \
+    spearman, load_tune_log, evaluate
+
+arch = H100()
+qkv_meta = [meta_tensor(2, 1024, 8, 128, dtype=torch.float16)] * 3
+
+
+def test_prune_configs():
+    _, configs = decider(qkv_meta, arch)
+    problem = AttnProblem.from_qkv_meta(qkv_meta)
+    ranked = rank_configs(configs, problem, arch)
+    latencies = [estimate_latency(config, problem, arch) for config in ranked]
+    assert latencies == sorted(latencies) and all(latency < math.inf for latency in latencies)
+    top = prune_configs(configs, problem, arch, 8)
+    assert top == ranked[:8]
+    _, top_decider = decider(qkv_meta, arch, top_k=8)
+    assert top_decider == top
+    assert prune_configs(configs, problem, arch, None) is configs
+
+
+def test_block_mask_density():
+    from core.transform.core import create_block_mask, classify_block_mask
+
+    def window_mask(b, h, q_idx, kv_idx):
+        return (q_idx >= kv_idx) & (q_idx - kv_idx < 128)
+
+    def causal_mask(b, h, q_idx, kv_idx):
+        return q_idx >= kv_idx
+
+    config = {"block_M": 128, "block_N": 64, "thread_num": 128, "num_stages": 2}
+    dense = estimate_latency(config, AttnProblem.from_qkv_meta(qkv_meta), arch)
+    latencies = {}
+    for mask_mod in [window_mask, causal_mask]:
+        info = classify_block_mask(create_block_mask(mask_mod, 1, 1, 1024, 1024, "cpu", 128, 64), 128, 64)
+        problem = AttnProblem.from_qkv_meta(qkv_meta, block_mask_info=info)
+        assert problem.is_causal == info.is_causal
+        latencies[mask_mod] = estimate_latency(config, problem, arch)
+    # the window visits 3 of 16 kv blocks of a tile, causal half of them
+    assert latencies[window_mask] < latencies[causal_mask] < dense
+    assert latencies[causal_mask] == estimate_latency(config, AttnProblem.from_qkv_meta(qkv_meta, True), arch)
+
+
+def test_wave_quantization():
+    # one tile per head, latency steps every full wave of SMs
+    config = {"block_M": 128, "block_N": 64, "thread_num": 128, "num_stages": 2}
+    latencies = [estimate_latency(config, AttnProblem(1, heads, 128, 1024, 128, 128), arch)
+                 for heads in range(1, 4 * arch.compute_max_core + 2)]
+    jump = next(i for i, latency in enumerate(latencies) if latency != latencies[0])
+    assert jump % arch.compute_max_core == 0
+    assert math.isclose(latencies[jump], 2 * latencies[0])
+    assert latencies[jump:2 * jump] == [latencies[jump]] * jump
+
+
+def test_spearman():
+    assert math.isclose(spearman([1, 2, 3, 4], [10, 20, 30, 40]), 1)
+    assert math.isclose(spearman([1, 2, 3, 4], [4, 3, 2, 1]), -1)
+    assert math.isclose(spearman([1, 1, 2], [1, 2, 3]), math.sqrt(3) / 2)
+    assert math.isnan(spearman([1, 1, 1], [1, 2, 3]))
+
+
+def test_evaluate_tune_log(tmp_path):
+    problem_keys = {"B": 2, "H": 8, "N_CTX": 1024, "D_HEAD": 128, "D_HEADV": 128, "causal": True}
+    problem = AttnProblem.from_problem_keys(problem_keys)
+    configs = [{"block_M": bm, "block_N": bn, "stages": 2, "thread_num": 128, "shared_fuse": False}
+               for bm in [64, 128] for bn in [32, 64]]
+    log = tmp_path / "tuned_result.log"
+    with open(log, "w") as f:
+        # lines of tl_tune before problem keys were logged
+        f.write(f"Latency: 0.5, Config: {configs[0]}\n")
+        for config in configs:
+            f.write(f"Latency: {2 * estimate_latency(config, problem, arch)}, "
+                    f"Config: {config}, Problem: {problem_keys}\n")
+        f.write(f"Latency: 1000000.0, Config: {configs[0]}, Problem: {problem_keys}\n")
+    records = load_tune_log(log)
+    assert len(records) == len(configs) + 1
+    results = evaluate(records, arch, top_k=1)
+    assert len(results) == 1
+    assert results[0]["num_configs"] == len(configs)
+    assert math.isclose(results[0]["spearman"], 1)
+    assert results[0]["best_in_top_k"]
@@ -0,0 +1,91 @@
+import sys
+import torch
+from core.transform.core import SymbolScalar, topo_sort
+from core.transform.graph import Var
+from core.codegen.tl_gen import generate_tl_from_dag
+
+
+def run_pytorch_code(x, env):
+    code, _ = generate_tl_from_dag([x], to_tl=False)
+    exec(str(code), env)
+    return env[x.varname]
+
+
+def test_shared_subgraph_backward():
+    # y = (s+1)*(s+1), dy/ds = 2*(s+1)
+    s = SymbolScalar("s", Var("s"), shape_idx=["block_M"])
+    dy = SymbolScalar("dy", Var("dy"), shape_idx=["block_M"])
+    t = s + 1
+    y = t * t
+    y.backward(dy)
+
+    s_value = torch.randn(16)
+    env = {"torch": torch, "s": s_value, "dy": torch.ones(16)}
+    ds = run_pytorch_code(s.grad, env)
+    assert torch.allclose(ds, 2 * (s_value + 1))
+
+
+def test_topo_sort_visit_once():
+    s = SymbolScalar("s", Var("s"), shape_idx=["block_M"])
+    x = s
+    for _ in range(64):
+        x = x * x + x
+    order = topo_sort([x])
+    assert len(order) == len(set(id(node) for node in order))
+    # inputs before users
+    position = {id(node): i for i, node in enumerate(order)}
+    for node in order:
+        for prev in node.prev:
+            assert position[id(prev)] < position[id(node)]
+
+
+def test_liveness_buffer_reuse():
+    # s is used by every term, terms are not inplace but share freed buffers
+    s = SymbolScalar("s", Var("s"), shape_idx=["block_M", "block_N"])
+    acc = s * 1.0
+    for i in range(2, 8):
+        acc = acc + (s * float(i)).exp()
+    code, _, liveness = generate_tl_from_dag(
+        [acc], to_tl=False, return_liveness=True)
+    assert liveness.peak(["block_M", "block_N"]) <= 3
+    assert liveness.num_buffers[("block_M", "block_N")] <= 2
+
+    s_value = torch.randn(16, 16)
+    env = {"torch": torch, "s": s_value}
+    exec(str(code), env)
+    ref = s_value * 1.0
+    for i in range(2, 8):
+        ref = ref + (s_value * float(i)).exp()
+    assert torch.allclose(env[acc.varname], ref)
+
+
+def test_liveness_live_out():
+    s = SymbolScalar("s", Var("s"), shape_idx=["block_M", "block_N"])
+    t = s.exp()
+    t.set_allow_reuse(False)
+    # extra reference outside the graph
+    s.count += 1
+    y = t * 2.0
+    generate_tl_from_dag([y])
+    assert t.varname != "s"
+    assert y.varname != t.varname
+
+
+def test_deep_graph_no_recursion_limit():
+    depth = sys.getrecursionlimit() * 2
+    scores = SymbolScalar("scores", Var("scores"), shape_idx=["block_M", "block_N"])
+    dscores = SymbolScalar("dscores", Var("dscores"), shape_idx=["block_M", "block_N"])
+    x = scores
+    for _ in range(depth):
+        x = x * 2.0
+    x.backward(dscores)
+    generate_tl_from_dag([x])
+    generate_tl_from_dag([scores.grad])
+
+
+if __name__ == "__main__":
+    test_shared_subgraph_backward()
+    test_topo_sort_visit_once()
+    test_liveness_buffer_reuse()
+    test_liveness_live_out()
+    test_deep_graph_no_recursion_limit()
@@ -0,0 +1,100 @@
+import torch
+import torch.fx as fx
+from core.codegen.common import tl_codegen_from_torchfx
+from core.transform.core import create_block_mask, create_block_idx_bwd, mask_mod_custom_inputs
+from core.transform.dynamic_mask import DynamicBlockMask, document_block_mask
+
+B, H, S, D = 2, 3, 1000, 8
+Q_BLOCK_SIZE = 128
+K_BLOCK_SIZE = 64
+
+# packed documents of every batch
+doc_lens = [[130, 400, 470], [64, 64, 872]]
+doc_ids = torch.stack([torch.repeat_interleave(torch.arange(len(lens)), torch.tensor(lens))
+                       for lens in doc_lens]).float()
+
+
+def document_mask(b, h, q_idx, kv_idx, custom_fwd_inputs):
+    doc_ids = custom_fwd_inputs["doc_ids"]
+    return doc_ids[b, q_idx] == doc_ids[b, kv_idx]
+
+
+def document_causal_mask(b, h, q_idx, kv_idx, custom_fwd_inputs):
+    doc_ids = custom_fwd_inputs["doc_ids"]
+    return (doc_ids[b, q_idx] == doc_ids[b, kv_idx]) & (q_idx >= kv_idx)
+
+
+def document_window_mask(b, h, q_idx, kv_idx, custom_fwd_inputs):
+    doc_ids = custom_fwd_inputs["doc_ids"]
+    return (doc_ids[b, q_idx] == doc_ids[b, kv_idx]) & (q_idx - kv_idx < 50 * (h + 1))
+
+
+def shared_document_mask(b, h, q_idx, kv_idx, custom_fwd_inputs):
+    # one doc_ids for all batches
+    doc_ids = custom_fwd_inputs["doc_ids"]
+    return doc_ids[q_idx] == doc_ids[kv_idx]
+
+
+def document_prefix_mask(b, h, q_idx, kv_idx, custom_fwd_inputs):
+    # no fast path
+    doc_ids = custom_fwd_inputs["doc_ids"]
+    return doc_ids[b, q_idx] >= doc_ids[b, kv_idx]
+
+
+def reference_block_mask(mask_mod, doc_ids):
+    return create_block_mask(mask_mod, B, H, S, S, "cpu", Q_BLOCK_SIZE, K_BLOCK_SIZE,
+                             separate_full_blocks=True, mask_inputs={"doc_ids": doc_ids})
+
+
+def test_document_block_mask():
+    block_mask = document_block_mask(doc_ids, Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    assert torch.equal(block_mask, reference_block_mask(document_mask, doc_ids))
+    # unsorted ids: nonzero blocks are a superset, full blocks are exact
+    shuffled_ids = doc_ids[:, torch.randperm(S)]
+    block_mask = document_block_mask(shuffled_ids, Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    reference = reference_block_mask(document_mask, shuffled_ids)
+    assert torch.all((block_mask != 0) | (reference == 0))
+    assert torch.equal(block_mask == 2, reference == 2)
+
+
+def test_dynamic_block_mask():
+    assert mask_mod_custom_inputs(document_causal_mask) == ["doc_ids"]
+    q = torch.randn(B, S, H, D)
+    scale = torch.ones(1)
+    for mask_mod in [document_mask, document_causal_mask, document_window_mask, document_prefix_mask]:
+        dynamic_block_mask = DynamicBlockMask(mask_mod, ["scale", "doc_ids"], Q_BLOCK_SIZE, K_BLOCK_SIZE)
+        assert (dynamic_block_mask.document_ids is None) == (mask_mod is document_prefix_mask)
+        # a new batch of documents without recompiling
+        for ids in [doc_ids, doc_ids.flip(1)]:
+            block_mask = dynamic_block_mask(q, q, q, scale, ids)
+            assert torch.equal(block_mask, reference_block_mask(mask_mod, ids)), mask_mod.__name__
+
+    dynamic_block_mask = DynamicBlockMask(shared_document_mask, ["doc_ids"], Q_BLOCK_SIZE, K_BLOCK_SIZE)
+    block_mask = dynamic_block_mask(q, q, q, doc_ids[1])
+    assert block_mask.shape == (1, 1, 8, 16)
+    assert torch.equal(block_mask, document_block_mask(doc_ids[1:], Q_BLOCK_SIZE, K_BLOCK_SIZE))
+
+
+def test_dynamic_block_mask_bwd():
+    q = torch.randn(B, S, H, D)
+    # bwd tiles: 128 kv rows, 64 q rows
+    dynamic_block_mask = DynamicBlockMask(document_causal_mask, ["doc_ids"], Q_BLOCK_SIZE, K_BLOCK_SIZE, 128, 64)
+    block_mask, block_idx_bwd = dynamic_block_mask(q, q, q, doc_ids)
+    assert torch.equal(block_mask, reference_block_mask(document_causal_mask, doc_ids))
+    reference = create_block_idx_bwd(document_causal_mask, B, H, S, S, "cpu", 64, 128,
+                                     mask_inputs={"doc_ids": doc_ids})
+    assert torch.equal(block_idx_bwd.kv_num_blocks, reference.kv_num_blocks)
+    assert torch.equal(block_idx_bwd.kv_indices, reference.kv_indices)
+    assert torch.equal(block_idx_bwd.kv_kinds, reference.kv_kinds)
+
+
+def test_dynamic_mask_codegen():
+    mask_code = str(tl_codegen_from_torchfx(fx.symbolic_trace(document_causal_mask)))
+    assert "g_doc_ids[b, q_idx]" in mask_code and "g_doc_ids[b, kv_idx]" in mask_code
+
+
+if __name__ == "__main__":
+    test_document_block_mask()
+    test_dynamic_block_mask()
+    test_dynamic_block_mask_bwd()
+    test_dynamic_mask_codegen()
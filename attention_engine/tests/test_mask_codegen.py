@@ -0,0 +1,60 @@
+import pytest
+import torch
+import torch.fx as fx
+from core.codegen import common
+from core.codegen.common import tl_codegen_from_torchfx
+from core.codegen.mask_verify import verify_mask_codegen
+
+
+def where_mask(b, h, q_idx, kv_idx):
+    return torch.where(q_idx >= kv_idx, torch.abs(q_idx - kv_idx) < 64, kv_idx % 16 == 0)
+
+
+def logical_mask(b, h, q_idx, kv_idx):
+    return torch.logical_or(torch.logical_not(q_idx < kv_idx), torch.remainder(kv_idx, 7) == h)
+
+
+def method_mask(b, h, q_idx, kv_idx):
+    return (q_idx - kv_idx).abs().le(40) & ~(kv_idx > q_idx)
+
+
+def min_max_mask(b, h, q_idx, kv_idx):
+    return torch.maximum(q_idx - 100, kv_idx * 0) <= torch.minimum(kv_idx, q_idx)
+
+
+def fmod_mask(b, h, q_idx, kv_idx):
+    return torch.fmod(q_idx - kv_idx, 5) == -1
+
+
+def document_mask(b, h, q_idx, kv_idx, custom_fwd_inputs):
+    doc_ids = custom_fwd_inputs["doc_ids"]
+    return (doc_ids[b, q_idx] == doc_ids[b, kv_idx]) & (q_idx >= kv_idx)
+
+
+def packed_doc_ids(B, H, Q, KV):
+    return {"doc_ids": torch.randint(0, 4, (B, max(Q, KV))).sort(dim=-1).values}
+
+
+def test_mask_codegen():
+    for mask_mod in [where_mask, logical_mask, method_mask, min_max_mask, fmod_mask]:
+        verify_mask_codegen(mask_mod)
+    verify_mask_codegen(document_mask, make_inputs=packed_doc_ids)
+
+
+def test_mask_codegen_mismatch(monkeypatch):
+    # floormod instead of truncmod differs for negative q_idx - kv_idx
+    monkeypatch.setitem(common.torch_supported_ops, torch.fmod, "operator.mod({0}, {1})")
+    with pytest.raises(ValueError):
+        verify_mask_codegen(fmod_mask)
+
+
+def test_mask_codegen_torch():
+    mask_code = str(tl_codegen_from_torchfx(fx.symbolic_trace(method_mask), backend="torch"))
+    assert "T." not in mask_code and ".abs()" in mask_code
+    mask_code = str(tl_codegen_from_torchfx(fx.symbolic_trace(where_mask)))
+    assert "T.if_then_else(" in mask_code and "T.abs(" in mask_code
+
+
+if __name__ == "__main__":
+    test_mask_codegen()
+    test_mask_codegen_torch()
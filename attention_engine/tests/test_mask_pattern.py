@@ -0,0 +1,103 @@
+import torch
+from types import SimpleNamespace
+from core.transform.core import create_mask, _convert_mask_to_block_mask
+from core.transform.mask_pattern import analyze_mask_mod
+
+B, H, S = 2, 4, 512
+block_M, block_N = 64, 32
+
+doc_ids = torch.arange(S) // 100
+
+
+def causal_mask(b, h, q_idx, kv_idx):
+    return q_idx >= kv_idx
+
+
+def causal_offset_mask(b, h, q_idx, kv_idx):
+    return q_idx - 100 >= kv_idx
+
+
+def sliding_window_mask(b, h, q_idx, kv_idx):
+    return torch.logical_and(q_idx >= kv_idx, q_idx < kv_idx + 128)
+
+
+def head_window_mask(b, h, q_idx, kv_idx):
+    return (q_idx >= kv_idx) & (q_idx - kv_idx < 40 * (h + 1))
+
+
+def prefix_lm_mask(b, h, q_idx, kv_idx):
+    return (kv_idx < 150) | (q_idx >= kv_idx)
+
+
+def chunked_mask(b, h, q_idx, kv_idx):
+    return (q_idx // 96) == (kv_idx // 96)
+
+
+def chunked_causal_mask(b, h, q_idx, kv_idx):
+    return ((q_idx // 96) == (kv_idx // 96)) & (q_idx >= kv_idx)
+
+
+def document_mask(b, h, q_idx, kv_idx):
+    return doc_ids[q_idx] == doc_ids[kv_idx]
+
+
+def mod_mask(b, h, q_idx, kv_idx):
+    # causal for q_idx < 4096 only
+    return kv_idx <= q_idx % 4096
+
+
+def loop_bounds(mask_pattern, bx, by):
+    # evaluate the generated tl bounds in python
+    env = {
+        "T": SimpleNamespace(max=max, min=min, ceildiv=lambda a, b: -(-a // b)),
+        "bx": bx, "by": by, "bz": 0,
+        "block_M": block_M, "block_N": block_N, "seq_len": S,
+        "is_casual": mask_pattern.is_causal,
+    }
+    loop_start, loop_end = mask_pattern.tl_kv_loop_bounds()
+    loop_start = "0" if loop_start is None else loop_start
+    if loop_end is None:
+        loop_end = "T.ceildiv((bx + 1) * block_M, block_N) if is_casual else T.ceildiv(seq_len, block_N)"
+    return eval(loop_start, env), eval(loop_end, env)
+
+
+def test_mask_pattern_kind():
+    expected = {
+        causal_mask: ("causal", True),
+        causal_offset_mask: ("causal", True),
+        sliding_window_mask: ("sliding_window", True),
+        head_window_mask: ("sliding_window", True),
+        prefix_lm_mask: ("prefix_lm", False),
+        chunked_mask: ("chunked", False),
+        chunked_causal_mask: ("chunked", True),
+        document_mask: ("document", False),
+        mod_mask: ("unknown", False),
+    }
+    for mask_mod, (kind, is_causal) in expected.items():
+        mask_pattern = analyze_mask_mod(mask_mod)
+        assert (mask_pattern.kind, mask_pattern.is_causal) == (kind, is_causal), mask_mod.__name__
+    # no closed form bounds, the kernel runs the dense loop
+    assert analyze_mask_mod(mod_mask).tl_kv_loop_bounds() == (None, None)
+
+
+def test_mask_pattern_loop_bounds():
+    for mask_mod in [causal_mask, causal_offset_mask, sliding_window_mask, head_window_mask,
+                     prefix_lm_mask, chunked_mask, chunked_causal_mask]:
+        mask_pattern = analyze_mask_mod(mask_mod)
+        mask = create_mask(mask_mod, B, H, S, S, "cpu")
+        block_mask, _ = _convert_mask_to_block_mask(mask, block_M, block_N)
+        num_loops = 0
+        for by in range(H):
+            for bx in range(S // block_M):
+                loop_start, loop_end = loop_bounds(mask_pattern, bx, by)
+                # every nonzero block is inside the loop
+                nonzero = torch.nonzero(block_mask[0, by, bx]).flatten().tolist()
+                assert all(loop_start <= k < loop_end for k in nonzero), mask_mod.__name__
+                num_loops += max(loop_end - loop_start, 0)
+        # bounds are tight for these families
+        assert num_loops == int((block_mask[0] != 0).sum()), mask_mod.__name__
+
+
+if __name__ == "__main__":
+    test_mask_pattern_kind()
+    test_mask_pattern_loop_bounds()
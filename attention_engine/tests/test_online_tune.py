@@ -0,0 +1,114 @@
+import torch
+from attn_engine import AttentionEngine
+from core.transform.core import CustomIO
+from core.utils import meta_tensor
+from autotuner.online_tune import OnlineTuner, online_tuner
+from autotuner.tune_db import TuneDB
+from test_torch_backend import qkv_meta, random_qkv, score_mod_softmax, causal_mask, OnlineSoftmax
+
+
+class FakeTimer:
+    """
+    latency of a candidate fn from a table, with a ms of noise per timing
+    """
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self.timed = []
+
+    def __call__(self, fn, *args, **kwargs):
+        self.timed.append(fn)
+        noise = 1.0 if len(self.timed) % 7 == 0 else 0.0
+        return fn(*args, **kwargs), self.latencies[fn] + noise
+
+
+def make_candidates(latencies):
+    # candidate fns return their config
+    candidates = [(config, lambda config=config: config) for config in latencies]
+    return candidates, FakeTimer({fn: latencies[config] for config, fn in candidates})
+
+
+def test_online_tuner_sampling():
+    candidates, timer = make_candidates({"a": 10.0, "b": 5.0, "c": 9.8})
+    tuner = OnlineTuner(candidates, sample_rate=0.05, min_samples=4, timer=timer)
+    outputs = [tuner() for _ in range(100)]
+    # every 20th call is timed, calls in between run the incumbent
+    assert tuner.timed_calls == len(timer.timed) == 5
+    assert outputs[:19] == ["a"] * 19
+    for _ in range(900):
+        tuner()
+    assert tuner.incumbent.config == "b" and tuner.done
+    # c is within win_margin of b
+    assert [(config, decision) for config, _, _, decision in tuner.history] == [("b", "promoted"), ("c", "kept")]
+    timed_calls = tuner.timed_calls
+    assert [tuner() for _ in range(100)] == ["b"] * 100
+    assert tuner.timed_calls == timed_calls
+
+
+def test_online_tuner_failing_challenger():
+    def failing():
+        raise RuntimeError("launch failed")
+    timer = FakeTimer({})
+    tuner = OnlineTuner([("a", lambda: "a"), ("b", failing)], sample_rate=1.0, min_samples=2,
+                        timer=lambda fn: timer(fn) if fn is failing else (fn(), 1.0))
+    # the call routed to the failing challenger is served by the incumbent
+    assert [tuner() for _ in range(4)] == ["a"] * 4
+    assert tuner.done and tuner.history == [("b", None, None, "failed")]
+
+
+def test_online_tuner_persist(tmp_path):
+    db = TuneDB(str(tmp_path / "tune.jsonl"))
+    key = dict(kind="attn_online", problem={"shapes": [[1, 2, 3]]}, arch="sm_90", dtype="float16")
+    candidates, timer = make_candidates({"a": 10.0, "b": 5.0, "c": 4.0})
+    tuner = online_tuner(candidates, 1.0, db, min_samples=3, timer=timer, **key)
+    while not tuner.done:
+        tuner()
+    record = db.lookup(**key)
+    assert record.config == "c" and record.latency == 4.0 and record.extra == {"online": True, "complete": True}
+    assert len(db.records()) == 1
+    # a new process starts from the persisted config and times nothing
+    tuner = online_tuner(candidates, 1.0, db, min_samples=3, timer=timer, **key)
+    assert tuner.incumbent.config == "c" and tuner.done and tuner() == "c"
+    # a new candidate is timed against the persisted config
+    candidates, timer = make_candidates({"a": 10.0, "c": 4.0, "d": 6.0})
+    tuner = online_tuner(candidates, 1.0, db, min_samples=3, timer=timer, **key)
+    assert tuner.incumbent.config == "c" and tuner.done
+
+
+def test_engine_online_tuning(tmp_path):
+    torch.manual_seed(0)
+    B, H, HKV, S, DV = 1, 2, 2, 64, 8
+    online_configs = [{"block_M": "32", "block_N": "32"}, {"block_M": "16", "block_N": "16"}]
+    tune_file = str(tmp_path / "tune.jsonl")
+    mod = AttentionEngine(
+        qkv_meta(B, H, HKV, S, DV), CustomIO(),
+        score_mod=score_mod_softmax, mask_mod=causal_mask,
+        online_func=OnlineSoftmax(), backend="torch",
+        tune_online=0.5, online_configs=online_configs, tune_file=tune_file)
+    tuner = mod.online_tuner
+    fns = [tuner.incumbent.fn] + [challenger.fn for challenger in tuner.challengers]
+    tuner.timer = FakeTimer(dict(zip(fns, [3.0, 2.0, 1.0])))
+    tuner.min_samples = 2
+    q, k, v = random_qkv(B, H, HKV, S, DV)
+    ref = mod.attention(q, k, v)
+    for _ in range(16):
+        assert torch.allclose(mod(q, k, v), ref, atol=1e-4, rtol=1e-4)
+    assert tuner.done and tuner.incumbent.config == online_configs[1]
+    assert TuneDB(tune_file).records("attn_online")[-1].config == online_configs[1]
+
+
+def test_engine_online_tuning_tl_incumbent(tmp_path, monkeypatch):
+    import types
+    from attn_engine import attn_engine
+    # tilelang modules can not be loaded here, a tuned module compiled the 64x64 tile
+    tuned = {"block_M": 64, "block_N": 64, "num_stages": 1, "thread_num": 128, "shared_fuse": False}
+    monkeypatch.setattr(attn_engine, "load_generated_module", lambda code, name: types.SimpleNamespace(
+        attention=lambda *args: None, tuned_config=tuned))
+    online_configs = [{"block_M": "128", "block_N": "64"}]
+    mod = AttentionEngine(
+        [meta_tensor(1, 2, 256, 64, dtype=torch.float16)] * 3, CustomIO(),
+        score_mod=score_mod_softmax, mask_mod=causal_mask,
+        online_func=OnlineSoftmax(), backend="tl", tune=True,
+        tune_online=0.5, online_configs=online_configs, tune_file=str(tmp_path / "tune.jsonl"))
+    incumbent = {"block_M": "64", "block_N": "64", "stages": "1", "thread_num": "128", "shared_fuse": "False"}
+    assert mod.online_tuner.incumbent.config == incumbent and mod.tuned_config == incumbent
+    assert [challenger.config for challenger in mod.online_tuner.challengers] == online_configs
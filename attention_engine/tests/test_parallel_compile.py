@@ -0,0 +1,47 @@
+import os
+import pytest
+from autotuner.parallel_compile import compile_configs, compile_cache_root
+
+
+def compile_fn(config, cache_dir):
+    if config["fail"]:
+        raise RuntimeError(f"config {config['id']} does not compile")
+    path = os.path.join(cache_dir, f"{config['id']}.so")
+    with open(path, "w") as f:
+        f.write(str(os.getpid()))
+    return path, os.environ.get("TMPDIR") == cache_dir
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_compile_configs(tmp_path, num_workers):
+    configs = [{"id": i, "fail": i % 3 == 1} for i in range(7)]
+    results = compile_configs(compile_fn, configs, num_workers, cache_root=str(tmp_path))
+    assert [result.config for result in results] == configs
+    for result in results:
+        if result.config["fail"]:
+            assert result.artifact is None and "does not compile" in result.error
+            continue
+        path, isolated = result.artifact
+        assert result.error is None and os.path.exists(path)
+        assert os.path.dirname(path) != str(tmp_path)
+        # workers keep their temporary files in their cache dir, this process is untouched
+        assert isolated == (num_workers > 0)
+    workers = {os.path.dirname(result.artifact[0]) for result in results if result.error is None}
+    assert len(workers) <= max(num_workers, 1)
+
+
+def test_compile_configs_unpicklable(tmp_path):
+    with pytest.warns(UserWarning):
+        results = compile_configs(lambda config, cache_dir: config * 2, [1, 2], 2, cache_root=str(tmp_path))
+    assert [result.artifact for result in results] == [2, 4]
+
+
+def test_compile_configs_temporary_root():
+    # without cache_root the temporary worker dirs are removed before returning
+    results = compile_configs(compile_fn, [{"id": 0, "fail": False}], 0)
+    path, _ = results[0].artifact
+    assert results[0].error is None and not os.path.exists(os.path.dirname(path))
+    with compile_cache_root() as cache_root:
+        path, _ = compile_configs(compile_fn, [{"id": 0, "fail": False}], 0, cache_root)[0].artifact
+        assert os.path.exists(path)
+    assert not os.path.exists(cache_root)
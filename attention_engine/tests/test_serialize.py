@@ -0,0 +1,106 @@
+import torch
+from core.transform.core import SymbolScalar, CustomIO, create_mask
+from core.transform.graph import Var
+from core.transform.serialize import serialize_attention, deserialize_attention, \
+    structural_hash, serialize_dag, replay_dag
+from core.codegen.tl_gen import generate_tl_from_dag
+from attn_engine.attn_engine import attention_hash
+
+
+def causal_mask(b, h, q_idx, kv_idx):
+    return q_idx >= kv_idx
+
+
+def causal_mask_renamed(batch, head, q, kv):
+    return q >= kv
+
+
+def window_mask(b, h, q_idx, kv_idx):
+    return torch.logical_and(q_idx >= kv_idx, q_idx - kv_idx < 64)
+
+
+def score_mod(score, custom_fwd_inputs, b, h, q_idx, kv_idx):
+    bias = custom_fwd_inputs.input_tensors["bias"]
+    return (score + bias) * 0.125
+
+
+def score_mod_renamed(s, inputs, b, h, q, kv):
+    tmp = s + inputs.input_tensors["bias"]
+    return tmp * 0.125
+
+
+def score_mod_scale(score, custom_fwd_inputs, b, h, q_idx, kv_idx):
+    bias = custom_fwd_inputs.input_tensors["bias"]
+    return (score + bias) * 0.5
+
+
+window = torch.tensor(64)
+
+
+def tensor_window_mask(b, h, q_idx, kv_idx):
+    return (q_idx >= kv_idx) & (q_idx - kv_idx < window)
+
+
+def custom_inputs():
+    return CustomIO({"bias": ("heads", "seq_len", "seq_len_kv")})
+
+
+def test_structural_hash_stable():
+    h0 = structural_hash(serialize_attention(score_mod, causal_mask, None, custom_inputs()))
+    h1 = structural_hash(serialize_attention(score_mod_renamed, causal_mask_renamed, None, custom_inputs()))
+    h2 = structural_hash(serialize_attention(score_mod_scale, causal_mask, None, custom_inputs()))
+    h3 = structural_hash(serialize_attention(score_mod, window_mask, None, custom_inputs()))
+    assert h0 == h1
+    assert h0 != h2
+    assert h0 != h3
+
+
+def test_trace_on_copy():
+    custom_fwd_inputs = custom_inputs()
+    serialize_attention(score_mod, causal_mask, None, custom_fwd_inputs)
+    assert custom_fwd_inputs.input_tensors["bias"].count == 0
+
+
+def test_roundtrip():
+    data = serialize_attention(score_mod, window_mask, None, custom_inputs())
+    score_mod1, mask_mod1, _, custom_fwd_inputs1 = deserialize_attention(data)
+    data1 = serialize_attention(score_mod1, mask_mod1, None, custom_fwd_inputs1)
+    assert structural_hash(data) == structural_hash(data1)
+
+    mask = create_mask(window_mask, 1, 1, 256, 256, "cpu")
+    mask1 = create_mask(mask_mod1, 1, 1, 256, 256, "cpu")
+    assert torch.equal(mask, mask1)
+
+
+def test_replay_codegen():
+    scores = SymbolScalar("scores", Var("scores"), shape_idx=["block_M", "block_N"])
+    out = ((scores * 0.5).tanh() + 1) * 0.5
+    data = serialize_dag(out, {"scores": scores})
+    code, _ = generate_tl_from_dag([out])
+
+    scores1 = SymbolScalar("scores", Var("scores"), shape_idx=["block_M", "block_N"])
+    out1 = replay_dag(data, {"scores": scores1})
+    code1, _ = generate_tl_from_dag([out1])
+    assert str(code) == str(code1)
+
+
+def branching_mask(b, h, q_idx, kv_idx):
+    if q_idx > kv_idx:
+        return q_idx - kv_idx < 64
+    return q_idx == kv_idx
+
+
+def test_attention_hash_best_effort():
+    assert attention_hash(score_mod, causal_mask, None, custom_inputs()) == \
+        structural_hash(serialize_attention(score_mod, causal_mask, None, custom_inputs()))
+    # captured tensors are get_attr nodes, engines are built without a hash
+    assert attention_hash(score_mod, tensor_window_mask, None, custom_inputs()) is None
+    # data dependent control flow can not be traced by fx
+    assert attention_hash(score_mod, branching_mask, None, custom_inputs()) is None
+
+
+if __name__ == "__main__":
+    test_structural_hash_stable()
+    test_trace_on_copy()
+    test_roundtrip()
+    test_replay_codegen()
@@ -0,0 +1,314 @@
+import torch
+from attn_engine import AttentionEngine, LinearAttentionEngine, OnlineFunc
+from core.transform.core import SymbolScalar, CustomIO
+from core.transform.graph import Var
+from core.utils import meta_tensor
+from autotuner.arch import CPU
+
+D = 16
+softmax_scale = 1 / D ** 0.5
+
+
+def causal_mask(b, h, q_idx, kv_idx):
+    return q_idx >= kv_idx
+
+
+def window_mask(b, h, q_idx, kv_idx):
+    return torch.logical_and(q_idx >= kv_idx, q_idx - kv_idx < 48)
+
+
+def score_mod_softmax(score, custom_fwd_inputs, b, h, q_idx, kv_idx):
+    return score * softmax_scale
+
+
+def score_mod_sigmoid(score, custom_fwd_inputs, b, h, q_idx, kv_idx):
+    score = score + custom_fwd_inputs.input_tensors["bias"]
+    return ((score * 0.5).tanh() + 1) * 0.5
+
+
+def score_mod_retention(score, custom_fwd_inputs, b, h, q_idx, kv_idx):
+    return score * custom_fwd_inputs.input_tensors["mask"]
+
+
+class OnlineSoftmax(OnlineFunc):
+    def __init__(self):
+        online_rowscales = {
+            "m": SymbolScalar("m", Var("-inf")),
+            "r": SymbolScalar("r", Var("0.0")),
+        }
+        final_rowscales = {
+            "lse": SymbolScalar("lse", Var("0.0")),
+        }
+        super().__init__(online_rowscales, final_rowscales, CustomIO())
+
+    @staticmethod
+    def online_fwd(scores, online_rowscales, b, h, q_idx):
+        m, r = online_rowscales["m"], online_rowscales["r"]
+        m_new = m.max(scores.get_reduce("max"))
+        scale_tmp = (m - m_new).exp()
+        r = r * scale_tmp
+        scores = (scores - m_new).exp()
+        r = r + scores.get_reduce("sum")
+        return scores, {"m": m_new, "r": r}, scale_tmp
+
+    @staticmethod
+    def online_fwd_epilogue(o, online_rowscales, b, h, q_idx):
+        o_new = o / online_rowscales["r"]
+        lse = (online_rowscales["r"]).log() + online_rowscales["m"]
+        return o_new, {"lse": lse}
+
+    @staticmethod
+    def forward(scores, final_rowscales, b, h, q_idx, kv_idx):
+        return (scores - final_rowscales["lse"]).exp()
+
+    @staticmethod
+    def backward(dp, scores, final_rowscales, doosum_rowscales, b, h, q_idx, kv_idx):
+        return (dp - doosum_rowscales) * scores
+
+
+class OnlineIdentity(OnlineFunc):
+    def __init__(self):
+        super().__init__({}, {}, CustomIO())
+
+    @staticmethod
+    def online_fwd(scores, online_rowscales, b, h, q_idx):
+        o_scale = SymbolScalar("o_scale", Var("1"))
+        return scores, online_rowscales, o_scale
+
+    @staticmethod
+    def online_fwd_epilogue(o, online_rowscales, b, h, q_idx):
+        return o, {}
+
+    @staticmethod
+    def forward(scores, final_rowscales, b, h, q_idx, kv_idx):
+        return scores
+
+    @staticmethod
+    def backward(dp, scores, final_rowscales, doosum_rowscales, b, h, q_idx, kv_idx):
+        return dp
+
+
+class OnlineRetention(OnlineFunc):
+    def __init__(self):
+        online_rowscales = {
+            "r_wo_clamp": SymbolScalar("r_wo_clamp", Var("0.0")),
+            "r": SymbolScalar("r", Var("0.0")),
+        }
+        final_rowscales = {
+            "r": SymbolScalar("r", Var("0.0")),
+        }
+        super().__init__(online_rowscales, final_rowscales, CustomIO())
+
+    @staticmethod
+    def online_fwd(scores, online_rowscales, b, h, q_idx):
+        r_wo_clamp = online_rowscales["r_wo_clamp"] + scores.get_reduce("abssum")
+        r_new = r_wo_clamp.max(1.0)
+        o_scale = online_rowscales["r"] / r_new
+        scores = scores / r_new
+        return scores, {"r_wo_clamp": r_wo_clamp, "r": r_new}, o_scale
+
+    @staticmethod
+    def online_fwd_epilogue(o, online_rowscales, b, h, q_idx):
+        return o, {"r": online_rowscales["r"]}
+
+    @staticmethod
+    def forward(scores, final_rowscales, b, h, q_idx, kv_idx):
+        return scores / final_rowscales["r"]
+
+    @staticmethod
+    def backward(dp, scores, final_rowscales, doosum_rowscales, b, h, q_idx, kv_idx):
+        return dp / final_rowscales["r"]
+
+
+def qkv_meta(B, H, HKV, S, DV):
+    return (
+        meta_tensor(B, H, S, D, dtype=torch.float32),
+        meta_tensor(B, HKV, S, D, dtype=torch.float32),
+        meta_tensor(B, HKV, S, DV, dtype=torch.float32),
+    )
+
+
+def random_qkv(B, H, HKV, S, DV):
+    # [batch, seq_len, heads, dim]
+    q = torch.randn(B, S, H, D, dtype=torch.float64, requires_grad=True)
+    k = torch.randn(B, S, HKV, D, dtype=torch.float64, requires_grad=True)
+    v = torch.randn(B, S, HKV, DV, dtype=torch.float64, requires_grad=True)
+    return q, k, v
+
+
+def dense_scores(q, k, mask_mod):
+    H, HKV, S = q.shape[2], k.shape[2], q.shape[1]
+    k = k.repeat_interleave(H // HKV, dim=2)
+    scores = torch.einsum("bqhd,bkhd->bhqk", q, k)
+    idx = torch.arange(S)
+    mask = mask_mod(None, None, idx[:, None], idx[None, :])
+    return scores, mask
+
+
+def dense_output(p, v, H):
+    v = v.repeat_interleave(H // v.shape[2], dim=2)
+    return torch.einsum("bhqk,bkhd->bqhd", p, v)
+
+
+def assert_close_with_grad(o, ref, inputs):
+    assert torch.allclose(o, ref, atol=1e-4, rtol=1e-4)
+    do = torch.randn_like(o)
+    grads = torch.autograd.grad(o, inputs, do)
+    grads_ref = torch.autograd.grad(ref, inputs, do)
+    for grad, grad_ref in zip(grads, grads_ref):
+        assert torch.allclose(grad, grad_ref, atol=1e-4, rtol=1e-4)
+
+
+def test_softmax_attention_gqa():
+    torch.manual_seed(0)
+    B, H, HKV, S, DV = 2, 4, 2, 150, 8
+    mod = AttentionEngine(
+        qkv_meta(B, H, HKV, S, DV), CustomIO(),
+        score_mod=score_mod_softmax, mask_mod=causal_mask,
+        online_func=OnlineSoftmax(), backend="torch")
+    q, k, v = random_qkv(B, H, HKV, S, DV)
+    o = mod(q, k, v)
+
+    scores, mask = dense_scores(q, k, causal_mask)
+    p = (scores * softmax_scale).masked_fill(~mask, float("-inf")).softmax(dim=-1)
+    assert_close_with_grad(o, dense_output(p, v, H), (q, k, v))
+
+
+def test_softmax_attention_window():
+    torch.manual_seed(0)
+    B, H, HKV, S, DV = 1, 2, 2, 256, 8
+    # tiles with rows masked in the whole kv tile next to unmasked rows
+    mod = AttentionEngine(
+        qkv_meta(B, H, HKV, S, DV), CustomIO(),
+        score_mod=score_mod_softmax, mask_mod=window_mask,
+        online_func=OnlineSoftmax(), backend="torch")
+    q, k, v = random_qkv(B, H, HKV, S, DV)
+    o = mod(q, k, v)
+
+    scores, mask = dense_scores(q, k, window_mask)
+    p = (scores * softmax_scale).masked_fill(~mask, float("-inf")).softmax(dim=-1)
+    assert_close_with_grad(o, dense_output(p, v, H), (q, k, v))
+
+
+def test_compile_cache_lru():
+    cache_size = AttentionEngine.compile_cache_size
+    AttentionEngine._compile_cache.clear()
+    AttentionEngine.compile_cache_size = 2
+    try:
+        mods = [AttentionEngine(qkv_meta(1, 2, 2, 64, dv), CustomIO(), score_mod=score_mod_softmax,
+                                mask_mod=causal_mask, online_func=OnlineSoftmax(), backend="torch")
+                for dv in [8, 16, 8, 32]]
+        assert mods[2].attention is mods[0].attention
+        # dv=8 was used after dv=16, dv=16 is evicted
+        assert len(AttentionEngine._compile_cache) == 2
+        assert sorted(key[3] for key in AttentionEngine._compile_cache) == [8, 32]
+        AttentionEngine.compile_cache_size = 0
+        AttentionEngine._compile_cache.clear()
+        AttentionEngine(qkv_meta(1, 2, 2, 64, 8), CustomIO(), score_mod=score_mod_softmax,
+                        mask_mod=causal_mask, online_func=OnlineSoftmax(), backend="torch")
+        assert not AttentionEngine._compile_cache
+    finally:
+        AttentionEngine.compile_cache_size = cache_size
+
+
+def test_sigmoid_attention_custom_input():
+    torch.manual_seed(0)
+    B, H, S, DV = 1, 2, 200, 16
+    custom_fwd_inputs = CustomIO({"bias": (1,)})
+    mod = AttentionEngine(
+        qkv_meta(B, H, H, S, DV), custom_fwd_inputs,
+        score_mod=score_mod_sigmoid, mask_mod=window_mask,
+        online_func=OnlineIdentity(), backend="torch")
+    # lowering works on copies of the definition
+    assert custom_fwd_inputs.input_tensors["bias"].shape_idx == ["1"]
+    q, k, v = random_qkv(B, H, H, S, DV)
+    bias = torch.randn(1, dtype=torch.float64)
+    o = mod(q, k, v, bias)
+
+    scores, mask = dense_scores(q, k, window_mask)
+    p = torch.sigmoid(scores + bias) * mask
+    assert_close_with_grad(o, dense_output(p, v, H), (q, k, v))
+
+
+def test_retention_custom_mask():
+    torch.manual_seed(0)
+    B, H, S, DV = 2, 2, 130, 16
+    custom_fwd_inputs = CustomIO({"mask": (1, "heads", "seq_len", "seq_len_kv")})
+    mod = AttentionEngine(
+        qkv_meta(B, H, H, S, DV), custom_fwd_inputs,
+        score_mod=score_mod_retention, mask_mod=causal_mask,
+        online_func=OnlineRetention(), mask_value="0", backend="torch")
+    q, k, v = random_qkv(B, H, H, S, DV)
+    idx = torch.arange(S)
+    decay = torch.tensor([0.9, 0.99], dtype=torch.float64)
+    decay_mask = (decay[:, None, None] ** (idx[:, None] - idx[None, :]).clamp(min=0)) \
+        * (idx[:, None] >= idx[None, :])
+    o = mod(q, k, v, decay_mask[None])
+
+    scores, _ = dense_scores(q, k, causal_mask)
+    scores = scores * decay_mask
+    r = scores.abs().sum(dim=-1, keepdim=True).clamp(min=1.0)
+    assert torch.allclose(o, dense_output(scores / r, v, H), atol=1e-4, rtol=1e-4)
+
+
+def test_cpu_grid():
+    torch.manual_seed(0)
+    B, H, HKV, S, DV = 2, 4, 2, 150, 8
+    # small L2 -> several q&kv tiles per head
+    device = CPU(num_cores=3, l2_cache_bytes=64 * 1024)
+    custom_fwd_inputs = CustomIO({"mask": (1, "heads", "seq_len", "seq_len_kv")})
+    mod = AttentionEngine(
+        qkv_meta(B, H, HKV, S, DV), custom_fwd_inputs,
+        score_mod=score_mod_retention, mask_mod=causal_mask,
+        online_func=OnlineSoftmax(), device=device, backend="cpu")
+    q, k, v = random_qkv(B, H, HKV, S, DV)
+    decay_mask = torch.rand(1, H, S, S, dtype=torch.float64)
+    num_threads = torch.get_num_threads()
+    o = mod(q, k, v, decay_mask)
+    assert torch.get_num_threads() == num_threads
+
+    scores, mask = dense_scores(q, k, causal_mask)
+    p = (scores * decay_mask).masked_fill(~mask, float("-inf")).softmax(dim=-1)
+    assert_close_with_grad(o, dense_output(p, v, H), (q, k, v))
+
+
+def k_mod_dt(k, custom_io):
+    return k * custom_io.input_tensors["dt"]
+
+
+def q_mod_scale(q, custom_io):
+    return q * softmax_scale
+
+
+def test_linear_attention():
+    torch.manual_seed(0)
+    B, H, T, DV = 2, 2, 100, 8
+    meta = (
+        meta_tensor(B, H, T, D, dtype=torch.float32),
+        meta_tensor(B, H, T, D, dtype=torch.float32),
+        meta_tensor(B, H, T, DV, dtype=torch.float32),
+    )
+    mod = LinearAttentionEngine(
+        meta, q_mod=q_mod_scale, k_mod=k_mod_dt,
+        custom_io=CustomIO({"dt": (B, H, T)}), backend="torch")
+    q = torch.randn(B, H, T, D, dtype=torch.float64, requires_grad=True)
+    k = torch.randn(B, H, T, D, dtype=torch.float64, requires_grad=True)
+    v = torch.randn(B, H, T, DV, dtype=torch.float64, requires_grad=True)
+    decay = torch.nn.functional.logsigmoid(torch.randn(B, H, T, dtype=torch.float64)) * 0.1
+    dt = torch.rand(B, H, T, dtype=torch.float64)
+    o = mod(q, k, v, decay, dt)
+
+    g = decay.cumsum(dim=-1)
+    causal = torch.ones(T, T, dtype=torch.bool).tril()
+    decay_matrix = (g[..., :, None] - g[..., None, :]).masked_fill(~causal, float("-inf")).exp()
+    scores = (q * softmax_scale) @ (k * dt[..., None]).transpose(-1, -2) * decay_matrix
+    assert_close_with_grad(o, scores @ v, (q, k, v))
+
+
+if __name__ == "__main__":
+    test_softmax_attention_gqa()
+    test_softmax_attention_window()
+    test_sigmoid_attention_custom_input()
+    test_retention_custom_mask()
+    test_cpu_grid()
+    test_linear_attention()
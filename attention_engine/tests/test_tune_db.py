@@ -0,0 +1,258 @@
+import json
+import multiprocessing
+import pytest
+import threading
+from autotuner.tune_db import TuneDB, source_hash, function_hash, code_hashes, lookup_or_tune, joint_tune, \
+    join_background_tuning, main, toolchain_version
+
+problem = {"batch": 4, "heads": 32, "seq_len": 2048, "dim": 128, "dimv": 128}
+
+
+def test_tune_db_lookup(tmp_path):
+    db = TuneDB(str(tmp_path / "tune.jsonl"))
+    assert db.lookup("attn_fwd", problem, "sm_90", "float16") is None
+    db.append("attn_fwd", problem, [128, 128, 2, 256, False], 0.5, "sm_90", "float16")
+    db.append("attn_bwd", problem, [128, 64, 256], 1.0, "sm_90", "float16")
+    db.append("attn_fwd", problem, [64, 64, 1, 128, True], 0.7, "sm_80", "float16")
+    record = db.lookup("attn_fwd", dict(reversed(problem.items())), "sm_90", "float16")
+    assert (record.config, record.latency) == ([128, 128, 2, 256, False], 0.5)
+    assert db.lookup("attn_fwd", problem, "sm_80", "float16").config == [64, 64, 1, 128, True]
+    assert db.lookup("attn_fwd", problem, "sm_90", "bfloat16") is None
+    assert db.lookup("attn_fwd", problem, "sm_90", "float16", code_hash="other") is None
+    # the last record of a key wins, also for other handles of the file
+    other = TuneDB(db.path)
+    assert other.lookup("attn_fwd", problem, "sm_90", "float16").latency == 0.5
+    db.append("attn_fwd", problem, [128, 64, 2, 256, False], 0.4, "sm_90", "float16")
+    assert other.lookup("attn_fwd", problem, "sm_90", "float16").latency == 0.4
+    assert len(other.records()) == 3
+    assert len(other.records("attn_bwd")) == 1
+
+
+def test_tune_db_partial_line(tmp_path):
+    db = TuneDB(str(tmp_path / "tune.jsonl"))
+    db.append("linear_h", problem, [64, 64, 2, 128], 0.1)
+    with open(db.path, "a") as f:
+        f.write('{"kind": "linear_o", "problem"')
+    assert len(db.records()) == 1
+    with open(db.path, "a") as f:
+        f.write(': {}, "config": null}\n')
+    assert len(db.records()) == 2
+
+
+def _append_records(path, worker):
+    db = TuneDB(path)
+    for i in range(50):
+        db.append("attn_fwd", {**problem, "batch": i}, [worker, i], float(worker), arch=f"w{worker}")
+
+
+def test_tune_db_concurrent_appends(tmp_path):
+    path = str(tmp_path / "tune.jsonl")
+    processes = [multiprocessing.Process(target=_append_records, args=(path, worker)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    with open(path) as f:
+        lines = f.readlines()
+    assert len(lines) == 200 and all(json.loads(line) for line in lines)
+    db = TuneDB(path)
+    assert len(db.records()) == 200
+    assert db.lookup("attn_fwd", {**problem, "batch": 7}, "w3").config == [3, 7]
+
+
+def test_tune_db_import_export(tmp_path):
+    db = TuneDB(str(tmp_path / "tune.jsonl"))
+    db.append("attn_fwd", problem, [128, 128, 2, 256, False], 0.5, "sm_90")
+    db.append("attn_fwd", problem, [128, 64, 2, 256, False], 0.4, "sm_90")
+    db.export_records(str(tmp_path / "export.jsonl"))
+    with open(tmp_path / "export.jsonl") as f:
+        assert len(f.readlines()) == 1
+
+    fleet = TuneDB(str(tmp_path / "fleet.jsonl"))
+    fleet.append("attn_bwd", problem, [128, 64, 256], 1.0, "sm_90")
+    assert fleet.import_records(str(tmp_path / "export.jsonl")) == 1
+    assert fleet.import_records(str(tmp_path / "export.jsonl")) == 0
+    assert fleet.lookup("attn_fwd", problem, "sm_90").latency == 0.4
+
+    legacy = tmp_path / "tuned_result.json"
+    with open(legacy, "w") as f:
+        json.dump([{**problem, "tuned_config": [64, 64, 2, 128], "tuned_latency": 0.2}], f, indent=4)
+    with pytest.raises(ValueError):
+        TuneDB(str(legacy)).records()
+    assert fleet.import_legacy(str(legacy), "linear_h", "sm_90") == 1
+    record = fleet.lookup("linear_h", problem, "sm_90")
+    assert (record.config, record.latency) == ([64, 64, 2, 128], 0.2)
+
+
+def test_tune_db_nearest(tmp_path):
+    db = TuneDB(str(tmp_path / "tune.jsonl"))
+    for batch, seq_len, config in [(4, 2048, "a"), (4, 4096, "a"), (8, 4096, "a"), (1, 512, "b"), (1, 1024, "b")]:
+        db.append("attn_fwd", {**problem, "batch": batch, "seq_len": seq_len}, config, 0.1, "sm_90", "float16")
+    # other head dim, arch or kind never transfer
+    db.append("attn_fwd", {**problem, "seq_len": 3000, "dim": 64}, "c", 0.1, "sm_90", "float16")
+    db.append("attn_fwd", {**problem, "seq_len": 3000}, "d", 0.1, "sm_80", "float16")
+    db.append("attn_bwd", {**problem, "seq_len": 3000}, "e", 0.1, "sm_90", "float16")
+    # failed tuning
+    db.append("attn_fwd", {**problem, "seq_len": 3000}, None, -1, "sm_90", "float16")
+
+    assert db.nearest("attn_fwd", {**problem, "seq_len": 3000}, "sm_90", "float16").config == "a"
+    assert db.nearest("attn_fwd", {**problem, "batch": 1, "seq_len": 700}, "sm_90", "float16").config == "b"
+    assert db.nearest("attn_fwd", {**problem, "dim": 96}, "sm_90", "float16") is None
+    assert db.nearest("attn_fwd", problem, "sm_75", "float16") is None
+    # configs of other code are never transferred
+    assert db.nearest("attn_fwd", {**problem, "seq_len": 3000}, "sm_90", "float16", code_hash="other") is None
+    db.append("attn_fwd", {**problem, "seq_len": 4096}, "f", 0.1, "sm_90", "float16", code_hash="other")
+    assert db.nearest("attn_fwd", {**problem, "seq_len": 3000}, "sm_90", "float16", code_hash="other").config == "f"
+    # 2 votes of "b" outweigh the nearest "a"
+    db = TuneDB(str(tmp_path / "vote.jsonl"))
+    for seq_len, config in [(4096, "a"), (724, "b"), (674, "b")]:
+        db.append("attn_fwd", {**problem, "seq_len": seq_len}, config, 0.1, "sm_90", "float16")
+    assert db.nearest("attn_fwd", problem, "sm_90", "float16").config == "b"
+    assert db.nearest("attn_fwd", problem, "sm_90", "float16", k=1).config == "a"
+
+
+def test_lookup_or_tune(tmp_path):
+    db = TuneDB(str(tmp_path / "tune.jsonl"))
+    db.append("attn_fwd", problem, "tuned", 0.1)
+    unseen = {**problem, "seq_len": 8192}
+    calls = []
+
+    def tune_fn():
+        calls.append(threading.current_thread())
+        return "measured", 0.2
+
+    assert lookup_or_tune(db, "attn_fwd", problem, tune_fn).config == "tuned"
+    assert lookup_or_tune(db, "attn_fwd", unseen, tune_fn, tune=False) is None
+    assert lookup_or_tune(db, "attn_fwd", unseen, tune_fn, tune=False, transfer="nearest").config == "tuned"
+    assert not calls
+    # tuned in a thread, the nearest config is used meanwhile
+    assert lookup_or_tune(db, "attn_fwd", unseen, tune_fn, tune=False, transfer="background").config == "tuned"
+    join_background_tuning()
+    assert len(calls) == 1 and calls[0] is not threading.current_thread()
+    assert lookup_or_tune(db, "attn_fwd", unseen, tune_fn, transfer="background").config == "measured"
+    assert lookup_or_tune(db, "attn_bwd", unseen, tune_fn, transfer="nearest").config == "measured"
+    assert len(calls) == 2
+
+
+def test_joint_tune(tmp_path):
+    db = TuneDB(str(tmp_path / "tune.jsonl"))
+    # per BT: h is fastest at 128, o at 32, the step (h runs twice) at 64; dv fails at 128
+    latencies = {
+        "linear_h": {32: 3.0, 64: 2.0, 128: 1.5},
+        "linear_o": {32: 1.0, 64: 1.5, 128: 4.0},
+        "linear_dv": {32: 1.0, 64: 1.0, 128: -1},
+    }
+    calls = []
+
+    def tune_kernels(shared):
+        calls.append(shared["BT"])
+        return {kind: (f"{kind}_{shared['BT']}", latency[shared["BT"]]) for kind, latency in latencies.items()}
+
+    record = joint_tune(db, "linear_step", problem, {"BT": [32, 64, 128]}, tune_kernels, {"linear_h": 2})
+    assert record.config["shared"] == {"BT": 64} and record.latency == 6.5
+    assert record.config["configs"]["linear_o"] == "linear_o_64"
+    assert record.config["latencies"] == {"linear_h": 2.0, "linear_o": 1.5, "linear_dv": 1.0}
+    assert calls == [32, 64, 128]
+    # recorded, not tuned again
+    assert joint_tune(db, "linear_step", problem, {"BT": [32, 64, 128]}, tune_kernels).latency == 6.5
+    assert len(calls) == 3
+    # without shared parameters the kernels are tuned once
+    record = joint_tune(db, "attn_step", problem, {}, lambda shared: {"attn_fwd": ("f", 1.0), "attn_bwd": ("b", 2.5)})
+    assert record.config["shared"] == {} and record.latency == 3.5
+    record = joint_tune(db, "attn_step", {**problem, "dim": 64}, {}, lambda shared: {"attn_fwd": ("f", -1)})
+    assert record.config is None and record.latency == -1
+
+
+def test_source_hash(tmp_path):
+    code = "import torch\n\nTUNE = {}\nTUNE_FILE = \"{}\"\n\ndef kernel():\n    pass\n"
+    (tmp_path / "a.py").write_text(code.format(True, "a.jsonl"))
+    (tmp_path / "b.py").write_text(code.format(False, "b.jsonl"))
+    (tmp_path / "c.py").write_text(code.format(True, "a.jsonl").replace("pass", "return"))
+    assert source_hash(tmp_path / "a.py") == source_hash(tmp_path / "b.py")
+    assert source_hash(tmp_path / "a.py") != source_hash(tmp_path / "c.py")
+
+
+def test_function_hash(tmp_path):
+    (tmp_path / "a.py").write_text("TUNE = True\n\ndef kernel():\n    pass\n")
+    namespace = {}
+    exec(compile((tmp_path / "a.py").read_text(), str(tmp_path / "a.py"), "exec"), namespace)
+    assert function_hash(namespace["kernel"]) == source_hash(tmp_path / "a.py")
+    assert code_hashes([str(tmp_path)]) == {source_hash(tmp_path / "a.py")}
+    # no source file: hash of the bytecode
+    exec("def kernel():\n    return 1\n", namespace)
+    assert function_hash(namespace["kernel"]) != function_hash(test_function_hash)
+
+
+def test_tune_db_toolchain(tmp_path):
+    db = TuneDB(str(tmp_path / "tune.jsonl"), toolchain="tilelang==0.1.0")
+    db.append("attn_fwd", problem, "a", 0.5, "sm_90", "float16", "code")
+    upgraded = TuneDB(db.path, toolchain="tilelang==0.1.1")
+    # records of another compiler version are neither looked up nor transferred
+    assert upgraded.lookup("attn_fwd", problem, "sm_90", "float16", "code") is None
+    assert upgraded.nearest("attn_fwd", {**problem, "batch": 8}, "sm_90", "float16", "code") is None
+    record = lookup_or_tune(upgraded, "attn_fwd", problem, lambda: ("b", 0.4), "sm_90", "float16", "code")
+    assert record.config == "b" and record.toolchain == "tilelang==0.1.1"
+    assert db.lookup("attn_fwd", problem, "sm_90", "float16", "code").config == "a"
+
+
+def test_toolchain_version_source_checkout(tmp_path, monkeypatch):
+    import importlib.metadata
+    import subprocess
+    import sys
+    # tilelang on PYTHONPATH like the 3rd_parties/tilelang submodule, no package metadata
+    checkout = tmp_path / "tilelang_src"
+    (checkout / "tilelang").mkdir(parents=True)
+    (checkout / "tilelang" / "__init__.py").write_text('__version__ = "0.1.2"\n')
+    git = ["git", "-C", str(checkout), "-c", "user.name=t", "-c", "user.email=t@t"]
+    subprocess.run(git[:3] + ["init", "-q"], check=True)
+    subprocess.run(git + ["add", "-A"], check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "tilelang"], check=True)
+    revision = subprocess.run(git[:3] + ["rev-parse", "--short=12", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+
+    def no_metadata(name):
+        raise importlib.metadata.PackageNotFoundError(name)
+    monkeypatch.setattr(importlib.metadata, "version", no_metadata)
+    monkeypatch.syspath_prepend(str(checkout))
+    monkeypatch.delitem(sys.modules, "tilelang", raising=False)
+    toolchain_version.cache_clear()
+    try:
+        assert toolchain_version() == f"tilelang==0.1.2+g{revision}"
+        assert TuneDB(str(tmp_path / "tune.jsonl")).toolchain == f"tilelang==0.1.2+g{revision}"
+    finally:
+        sys.modules.pop("tilelang", None)
+        toolchain_version.cache_clear()
+
+
+def test_tune_db_gc(tmp_path, capsys):
+    db = TuneDB(str(tmp_path / "tune.jsonl"), toolchain="tilelang==0.1.1")
+    old = TuneDB(db.path, toolchain="tilelang==0.1.0")
+    old.append("attn_fwd", problem, "old", 0.5, "sm_90", "float16", "code")
+    db.append("attn_fwd", problem, "a", 0.5, "sm_90", "float16", "code")
+    db.append("attn_fwd", problem, "b", 0.4, "sm_90", "float16", "code")
+    db.append("attn_bwd", problem, "c", 1.0, "sm_90", "float16", "stale")
+    with open(db.path, "a") as f:
+        f.write("not json\n")
+    # records of every toolchain are kept by default, e.g. of hosts without tilelang
+    assert TuneDB(db.path, toolchain="").gc(dry_run=True) == (3, 2)
+    assert db.gc(toolchains=["tilelang==0.1.1"], dry_run=True) == (2, 3)
+    assert len(open(db.path).readlines()) == 5
+    # superseded, other toolchain and unparsable lines
+    reader = TuneDB(db.path, toolchain="tilelang==0.1.1")
+    assert len(reader.records()) == 3
+    assert [r.config for r in db.unreachable(toolchains=["tilelang==0.1.1"])] == ["old"]
+    assert db.gc(toolchains=["tilelang==0.1.1"]) == (2, 3)
+    assert len(open(db.path).readlines()) == 2
+    # other handles see the rewritten file and append to it
+    assert len(reader.records()) == 2 and reader.lookup("attn_fwd", problem, "sm_90", "float16", "code").config == "b"
+    old.append("attn_fwd", problem, "old", 0.5, "sm_90", "float16", "code")
+    assert len(reader.records()) == 3
+    # records of code that is not generated any more, the cli only lists them without --apply
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / "mod.py").write_text("def kernel():\n    pass\n")
+    db.append("attn_fwd", problem, "d", 0.3, "sm_90", "float16", source_hash(tmp_path / "cache" / "mod.py"))
+    main(["gc", db.path, "--code", str(tmp_path / "cache")])
+    assert "unreachable: attn_bwd" in capsys.readouterr().out
+    assert len(TuneDB(db.path).records()) == 4
+    main(["gc", db.path, "--code", str(tmp_path / "cache"), "--apply"])
+    assert [r.config for r in TuneDB(db.path).records()] == ["d"]
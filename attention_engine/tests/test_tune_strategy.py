@@ -0,0 +1,85 @@
+import math
+import random
+import pytest
+from autotuner.tune_strategy import Exhaustive, SuccessiveHalving, Hyperband, make_strategy
+
+# synthetic latency of 81 configs, config 37 is the fastest
+configs = [{"block_M": i} for i in range(81)]
+
+
+def true_latency(config):
+    return 1.0 + abs(config["block_M"] - 37) / 10
+
+
+class SyntheticMeasure:
+    """
+    true latency with noise that shrinks with rep, records the benchmarked ms
+    """
+    def __init__(self, noise=0.05, seed=0):
+        self.noise = noise
+        self.rng = random.Random(seed)
+        self.total_rep = 0
+
+    def __call__(self, config, rep):
+        self.total_rep += rep
+        return true_latency(config) * (1 + self.rng.gauss(0, self.noise / math.sqrt(rep)))
+
+
+def test_exhaustive():
+    measure = SyntheticMeasure()
+    result = Exhaustive(max_rep=100).run(configs, measure)
+    assert result.config == configs[37]
+    assert len(result.trials) == 81 and measure.total_rep == 81 * 100
+
+
+@pytest.mark.parametrize("strategy", [SuccessiveHalving(min_rep=4, max_rep=100, eta=3),
+                                      Hyperband(min_rep=1, max_rep=100, eta=3)])
+def test_early_stopping(strategy):
+    measure = SyntheticMeasure()
+    result = strategy.run(configs, measure)
+    assert result.config == configs[37]
+    assert measure.total_rep < 81 * 100 / 2
+    # the result is one of the longest measurements
+    assert max(trial.rep for trial in result.trials) == 100
+    assert any(trial.rep == 100 and trial.config == result.config for trial in result.trials)
+
+
+def test_successive_halving_rungs():
+    measure = SyntheticMeasure(noise=0)
+    result = SuccessiveHalving(min_rep=4, max_rep=100, eta=3).run(configs, measure)
+    reps = [trial.rep for trial in result.trials]
+    assert [reps.count(rep) for rep in [4, 12, 36, 100]] == [81, 27, 9, 3]
+    assert result.latency == 1.0
+
+
+def test_budget():
+    now = [0.0]
+
+    def measure(config, rep):
+        # every measurement takes 1s on the fake clock
+        now[0] += 1
+        return true_latency(config)
+
+    result = SuccessiveHalving(min_rep=4, max_rep=100, budget_s=10, clock=lambda: now[0]).run(configs, measure)
+    assert len(result.trials) == 10
+    assert result.config == min(configs[:10], key=true_latency)
+
+
+def test_failed_configs():
+    def measure(config, rep):
+        if config["block_M"] % 2:
+            raise RuntimeError("does not compile")
+        return math.nan if config["block_M"] == 36 else true_latency(config)
+
+    result = SuccessiveHalving(min_rep=4, max_rep=100).run(configs, measure)
+    assert result.config in (configs[34], configs[38])
+    assert Exhaustive().run(configs[1:2], measure).config is None
+
+
+def test_make_strategy():
+    assert make_strategy("") is None
+    strategy = make_strategy("hyperband:budget_s=300,max_rep=50")
+    assert isinstance(strategy, Hyperband) and (strategy.budget_s, strategy.max_rep) == (300, 50)
+    assert make_strategy(strategy) is strategy
+    with pytest.raises(ValueError):
+        make_strategy("random")
@@ -104,7 +104,7 @@ if __name__ == "__main__":
         qkv_meta,
         custom_fwd_inputs, score_mod=score_mod, mask_mod=block_sparse_mask,
         online_func=online,
-        tune=False, tune_file="mha_tune.json",
+        tune=False, tune_file="mha_tune.jsonl",
         infer_mask=True
     )
     # TODO: input mask的方式，tune mask的方式。
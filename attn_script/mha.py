@@ -110,9 +110,9 @@ if __name__ == "__main__":
         qkv_meta,
         custom_fwd_inputs, score_mod=score_mod, mask_mod=causal_mask,
         online_func=online,
-        tune=True, tune_file="attn_tl.json",
+        tune=True, tune_file="attn_tl.jsonl",
         tune_bwd=True,
-        tune_file_bwd="attn_tl_bwd.json",
+        tune_file_bwd="attn_tl_bwd.jsonl",
     )
 
     from benchmark.bench_utils import do_bench_attention
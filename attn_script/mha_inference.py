@@ -119,7 +119,7 @@ if __name__ == "__main__":
         qkv_meta,
         custom_fwd_inputs, score_mod=score_mod, mask_mod=None,
         online_func=online,
-        # tune=False, tune_file="mha_tune.json"
+        # tune=False, tune_file="mha_tune.jsonl"
     )
 
     from benchmark.bench_utils import do_bench_attention
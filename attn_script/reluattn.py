@@ -70,7 +70,7 @@ def eval():
             qkv_meta,
             custom_fwd_inputs, score_mod=score_mod, mask_mod=None,
             online_func=OnlineIdentity(),
-            tune = True, tune_file = "reluattn_tune.json"
+            tune = True, tune_file = "reluattn_tune.jsonl"
         )
         with open("reluattn_tl_code.py", "w") as f:
             f.write(mod.tl_code)
@@ -88,7 +88,7 @@ if __name__ == "__main__":
         qkv_meta,
         custom_fwd_inputs, score_mod=score_mod, mask_mod=None,
         online_func=OnlineIdentity(),
-        tune = True, tune_file = "reluattn_tune.json"
+        tune = True, tune_file = "reluattn_tune.jsonl"
     )
     from benchmark.bench_utils import do_bench_reluattn
     do_bench_reluattn(mod, B, H, S, D, D, requires_grad=True)